@@ -0,0 +1,197 @@
+# -------------------------------------------------------------
+# Chạy lô (không giao diện): phân tích CRM4 / CRM32 cho nhiều chi nhánh
+# Đọc đầu vào một lần, chia dữ liệu theo chi nhánh một lần, chạy song song
+# và ghi một workbook kết quả cho mỗi chi nhánh.
+# Chạy:  python crm_batch.py --crm4 CRM4_*.xls --crm32 RPT_CRM_32*.xls \
+#            --code-tsbd "CODE_LOAI TSBD.xlsx" --code-mdsd CODE_MDSDV4.xlsx \
+#            --sol 001 002 --out-dir ket_qua
+# -------------------------------------------------------------
+
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+import streamlit.logger
+from streamlit import config as st_config
+
+from crm_core import (
+    BRANCH_MATCH_MODES,
+    CRITERIA,
+    ENGINES,
+    INPUT_KINDS,
+    MULTI_FILE_INPUTS,
+    NAM_CHAM_TRA,
+    TC3_SO_NGAY,
+    TOP_N,
+    build_branch_index,
+    load_inputs,
+    run_pipeline,
+    select_branch,
+    write_excel_streaming,
+)
+from crm_incremental import run_incremental
+from crm_profile import StageProfiler
+
+# Bảng dùng chung cho mọi chi nhánh (gán một lần cho mỗi tiến trình con)
+_SHARED: Dict[str, object] = {}
+
+
+def quiet_streamlit() -> None:
+    """Chạy ngoài `streamlit run`: tắt cảnh báo "missing ScriptRunContext" của các lệnh st.*."""
+    st_config.set_option("logger.level", "error")
+    streamlit.logger.set_log_level("error")
+
+
+def _init_worker(shared: Dict[str, object]) -> None:
+    quiet_streamlit()
+    _SHARED.update(shared)
+
+
+def _run_branch(job: Tuple[str, pd.DataFrame, pd.DataFrame]) -> Tuple[str, dict, Optional[str]]:
+    sol, df_crm4, df_crm32 = job
+    prof = StageProfiler(enabled=_SHARED["profile"])
+    inputs = {**_SHARED["inputs"], "crm4": df_crm4, "crm32": df_crm32}
+    if _SHARED["incremental"]:
+        # Trạng thái kỳ trước lưu riêng cho từng chi nhánh (dữ liệu đã lọc sẵn, lọc lại không đổi)
+        result = run_incremental(inputs, _SHARED["ngay_danh_gia"], _SHARED["dia_ban_kt"],
+                                 chi_nhanh=sol, branch_match=_SHARED["match"], prof=prof,
+                                 nam_cham_tra=_SHARED["nam_cham_tra"], engine=_SHARED["engine"],
+                                 criteria=_SHARED["criteria"], tc3_so_ngay=_SHARED["tc3_so_ngay"],
+                                 top_n=_SHARED["top_n"])
+    else:
+        result = run_pipeline(inputs, _SHARED["ngay_danh_gia"], _SHARED["dia_ban_kt"], prof=prof,
+                              nam_cham_tra=_SHARED["nam_cham_tra"], engine=_SHARED["engine"],
+                              criteria=_SHARED["criteria"], tc3_so_ngay=_SHARED["tc3_so_ngay"],
+                              top_n=_SHARED["top_n"])
+    if result["pivot_full"].empty:
+        return sol, {}, None
+    stem = re.sub(r"[^0-9A-Za-z_-]+", "_", sol)
+    path = Path(_SHARED["out_dir"]) / f"KQ_phan_tich_CRM_{stem}.xlsx"
+    with prof.stage("xuất Excel (streaming)"):
+        write_excel_streaming(result, path, include=_SHARED["sheets"])
+    if prof.enabled:
+        (Path(_SHARED["out_dir"]) / f"hieu_nang_{stem}.json").write_text(
+            prof.to_json(sol=sol, so_dong_crm4=len(df_crm4), so_dong_crm32=len(df_crm32)), encoding="utf-8"
+        )
+    kpi = {k: v for k, v in result["kpi"].items() if not isinstance(v, pd.DataFrame)}
+    return sol, kpi, str(path)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Phân tích CRM4/CRM32 theo lô cho nhiều chi nhánh.")
+    p.add_argument("--crm4", nargs="+", required=True, help="File CRM4 (có thể nhiều file)")
+    p.add_argument("--crm32", nargs="*", default=[], help="File RPT_CRM_32 (có thể nhiều file)")
+    p.add_argument("--code-mdsd", help="CODE_MDSDV4.xlsx")
+    p.add_argument("--code-tsbd", help="CODE_LOAI TSBD.xlsx")
+    p.add_argument("--giai-ngan-tm", help="Giai_ngan_tien_mat_1_ty.xls/xlsx")
+    p.add_argument("--muc17", help="MUC17.xlsx")
+    p.add_argument("--muc55", help="Muc55_*.xlsx")
+    p.add_argument("--muc56", help="Muc56_*.xlsx")
+    p.add_argument("--muc57", help="Muc57_*.xlsx")
+    p.add_argument("--sol", nargs="*", default=[],
+                   help="Tên chi nhánh hoặc mã SOL; bỏ trống = mọi chi nhánh có trong CRM4")
+    p.add_argument("--match", choices=BRANCH_MATCH_MODES, default="contains",
+                   help="Cách so khớp --sol với tên chi nhánh/mã SOL (mặc định: chứa chuỗi)")
+    p.add_argument("--ngay-danh-gia", default="2025-08-31")
+    p.add_argument("--nam-cham-tra", nargs=2, type=int, default=list(NAM_CHAM_TRA), metavar=("TU_NAM", "DEN_NAM"),
+                   help="Khoảng năm đến hạn xét chậm trả ở tiêu chí 4 (mặc định: %(default)s)")
+    p.add_argument("--tc3-so-ngay", type=int, default=TC3_SO_NGAY, metavar="N",
+                   help="Ghép Giải ngân – Tất toán lệch nhau ≤ N ngày ở tiêu chí 3 (mặc định: %(default)s = cùng ngày)")
+    p.add_argument("--dia-ban", default="Hồ Chí Minh, Long An",
+                   help="Tỉnh/thành của đơn vị kiểm toán (phân cách dấu phẩy)")
+    p.add_argument("--out-dir", default="ket_qua")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--sheets", nargs="*", help="Chỉ xuất các sheet này (mặc định: tất cả)")
+    p.add_argument("--all-columns", action="store_true", help="Giữ toàn bộ cột gốc (không chiếu cột)")
+    p.add_argument("--engine", choices=ENGINES, default="pandas",
+                   help="Engine tính pivot & tiêu chí theo dòng (duckdb cần cài duckdb)")
+    p.add_argument("--top-n", type=int, default=TOP_N, metavar="N",
+                   help="Số hạng giữ lại ở các cột xếp hạng Top N (mặc định: %(default)s)")
+    p.add_argument("--criteria", nargs="+", choices=list(CRITERIA), metavar="TIEU_CHI",
+                   help=f"Chỉ chạy các tiêu chí này (mặc định: tất cả — {', '.join(CRITERIA)})")
+    p.add_argument("--profile", action="store_true",
+                   help="Ghi hieu_nang_<chi nhánh>.json (thời gian/bộ nhớ từng bước) cạnh file kết quả")
+    p.add_argument("--stream", action="store_true",
+                   help="Đọc CRM4/CRM32 theo khối, chỉ giữ dòng của các chi nhánh --sol (file rất lớn)")
+    p.add_argument("--incremental", action="store_true",
+                   help="Dùng lại kết quả kỳ trước, chỉ tính lại CIF thay đổi (trạng thái ở CRM_STATE_DIR)")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    quiet_streamlit()
+
+    if args.stream and not args.sol:
+        print("--stream cần --sol: không chọn chi nhánh nên đọc toàn bộ CRM4/CRM32 như bình thường", file=sys.stderr)
+    prof = StageProfiler(enabled=args.profile)
+    # Đóng mọi file đầu vào ngay sau khi đọc, trước khi tạo tiến trình con
+    with ExitStack() as stack:
+        files = {}
+        for kind in INPUT_KINDS:
+            value = getattr(args, kind)
+            if kind in MULTI_FILE_INPUTS:
+                files[kind] = [stack.enter_context(open(f, "rb")) for f in value]
+            elif value:
+                files[kind] = stack.enter_context(open(value, "rb"))
+        # --stream: lọc ngay khi đọc theo danh sách --sol
+        inputs = load_inputs(files, project=not args.all_columns, prof=prof, stream=args.stream,
+                             chi_nhanh=",".join(s.upper().strip() for s in args.sol), branch_match=args.match)
+
+    # Chỉ mục chi nhánh tính một lần, mỗi chi nhánh chỉ là phép lấy theo vị trí
+    index = build_branch_index(inputs)
+    if args.sol:
+        sols, match = [s.upper().strip() for s in args.sol], args.match
+    else:
+        sols, match = sorted(index["crm4"]), "exact"  # mọi chi nhánh có trong CRM4
+    jobs = [
+        (
+            sol,
+            select_branch(inputs, "crm4", sol, match, index),
+            select_branch(inputs, "crm32", sol, match, index),
+        )
+        for sol in sols
+    ]
+
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    if prof.enabled:
+        (Path(args.out_dir) / "hieu_nang_doc_file.json").write_text(prof.to_json(so_chi_nhanh=len(jobs)), encoding="utf-8")
+    shared = {
+        "inputs": {k: v for k, v in inputs.items() if k not in MULTI_FILE_INPUTS},
+        "ngay_danh_gia": pd.to_datetime(args.ngay_danh_gia),
+        "dia_ban_kt": [t.strip().lower() for t in args.dia_ban.split(",") if t.strip()],
+        "out_dir": args.out_dir,
+        "sheets": args.sheets or None,
+        "profile": args.profile,
+        "nam_cham_tra": tuple(sorted(args.nam_cham_tra)),
+        "incremental": args.incremental,
+        "match": match,
+        "engine": args.engine,
+        "criteria": args.criteria,
+        "tc3_so_ngay": max(0, args.tc3_so_ngay),
+        "top_n": max(1, args.top_n),
+    }
+    workers = max(1, min(args.workers, len(jobs)))
+    if workers == 1:
+        _init_worker(shared)
+        results = [_run_branch(j) for j in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(shared,)) as ex:
+            results = list(ex.map(_run_branch, jobs))
+
+    for sol, kpi, path in results:
+        if path is None:
+            print(f"[{sol}] không có dữ liệu")
+        else:
+            print(f"[{sol}] {kpi.get('Số KH', 0):,} KH, dư nợ {kpi.get('Tổng dư nợ', 0):,.0f} → {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
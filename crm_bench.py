@@ -0,0 +1,327 @@
+# -------------------------------------------------------------
+# Benchmark pipeline CRM4 / CRM32 trên dữ liệu tổng hợp (tái lập theo seed)
+# Sinh CRM4, CRM32, bảng mã, Mục 17/55/56/57 ở nhiều quy mô, đo thời gian &
+# bộ nhớ từng bước (StageProfiler) và so với baseline JSON đã lưu.
+# Chạy:  python crm_bench.py --rows 10k 100k 1M --save-baseline bench_baseline.json
+#        python crm_bench.py --rows 10k 100k 1M --baseline bench_baseline.json
+# -------------------------------------------------------------
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import crm_io
+from crm_batch import quiet_streamlit
+from crm_core import EXCEL_MAX_ROWS, EXPORT_FORMATS, INPUT_KINDS, MULTI_FILE_INPUTS, export_bytes, load_inputs, run_pipeline
+from crm_io import apply_schema
+from crm_profile import STAGE_COLUMNS, StageProfiler
+
+NGAY_DANH_GIA = pd.Timestamp("2025-08-31")
+DIA_BAN_KT = ["hồ chí minh", "long an"]
+
+# ============================ SYNTHETIC DATA ============================ #
+# Phân phối gần với dữ liệu thật: số CIF ~ 12% số dòng CRM4, vài KH lớn chiếm
+# nhiều dòng (lệch theo luỹ thừa), LOAI/LOAI_TS lệch mạnh về Cho vay/BĐS,
+# chi nhánh và thông tin KH cố định theo CIF.
+LOAI_P = {"Cho vay": 0.78, "Bao lanh": 0.12, "LC": 0.06, "Khac": 0.04}
+LOAI_TS_P = {"BĐS": 0.55, "PTVT": 0.12, "MMTB": 0.09, "GTCG": 0.07, "HTK": 0.06, "Khác": 0.11}
+TINH_TP = ["Hồ Chí Minh", "Long An", "Bình Dương", "Đồng Nai", "Hà Nội", "Cần Thơ", "Tây Ninh", "Đà Nẵng"]
+TINH_TP_P = [0.72, 0.2, 0.02, 0.02, 0.01, 0.01, 0.01, 0.01]
+MA_CO_CAU = ["ACOV1", "BCOV1", "BTT01", "CCOV2", "RTT03"]
+
+
+def parse_scale(text: str) -> int:
+    """'10k' → 10_000, '5M' → 5_000_000, '2500' → 2500."""
+    text = text.strip().lower().replace("_", "")
+    mult = {"k": 10**3, "m": 10**6}.get(text[-1:], 1)
+    return int(float(text[:-1] if mult > 1 else text) * mult)
+
+
+def _skewed(r: np.random.Generator, n_keys: int, size: int, power: float = 2.0) -> np.ndarray:
+    """Chỉ số 0..n_keys-1, chỉ số nhỏ xuất hiện nhiều hơn (u**power)."""
+    return np.minimum((r.random(size) ** power * n_keys).astype(np.int64), n_keys - 1)
+
+
+def _pick(r: np.random.Generator, probs: Dict[str, float], size: int) -> np.ndarray:
+    keys = list(probs)
+    p = np.array([probs[k] for k in keys])
+    return np.array(keys, dtype=object)[r.choice(len(keys), size, p=p / p.sum())]
+
+
+def make_dataset(rows: int, seed: int = 0, cif_ratio: float = 0.12, n_branches: int = 40) -> Dict[str, pd.DataFrame]:
+    """Sinh đủ các đầu vào của ``load_inputs`` (đã qua ``apply_schema`` như khi đọc file thật).
+
+    ``rows`` là số dòng CRM4; CRM32 ~ rows/2, Mục 55/56 ~ rows/5 mỗi bảng, Mục 57 ~ rows.
+    """
+    r = np.random.default_rng(seed)
+    n_cif = max(10, int(rows * cif_ratio))
+
+    # Thông tin cố định theo CIF
+    cif_ids = 10_000_000 + r.permutation(n_cif * 7)[:n_cif]
+    cif_branch = _skewed(r, n_branches, n_cif, 1.5)
+    branches = np.array([f"{i + 1:03d} - CN SỐ {i + 1}" for i in range(n_branches)], dtype=object)
+    cif_tp = np.where(r.random(n_cif) < 0.7, "Ca nhan", "Doanh nghiep").astype(object)
+    cif_nhom = r.choice([1, 2, 3, 4, 5], n_cif, p=[0.9, 0.05, 0.02, 0.02, 0.01])
+
+    # Bảng mã TSBĐ: nhiều mã cấp 2 cho mỗi loại, thêm mã TCTD và mã chưa khai báo
+    code_rows = [(f"{ts[:3].upper()}{j:02d}", ts) for ts in LOAI_TS_P for j in range(5)]
+    code_rows += [("TCTD01", "GTCG"), ("TCTD02", "GTCG")]
+    code_tsbd = pd.DataFrame(code_rows, columns=["CODE CAP 2", "CODE"])
+    cap2_p = {c: LOAI_TS_P[ts] / 5 for c, ts in code_rows if not c.startswith("TCTD")}
+    cap2_p.update({"TCTD01": 0.01, "TCTD02": 0.005, "MOI99": 0.005})
+
+    # CRM4
+    ci = _skewed(r, n_cif, rows)
+    n_secu = max(1, rows // 3)
+    cap2 = _pick(r, cap2_p, rows)
+    cap2[r.random(rows) < 0.05] = None  # không có TSBĐ
+    crm4 = pd.DataFrame({
+        "CIF_KH_VAY": cif_ids[ci],
+        "TEN_KH_VAY": np.char.add("KH ", cif_ids[ci].astype(str)).astype(object),
+        "CUSTTPCD": cif_tp[ci],
+        "NHOM_NO": cif_nhom[ci],
+        "LOAI": _pick(r, LOAI_P, rows),
+        "CAP_2": cap2,
+        "TS_KW_VND": np.round(r.lognormal(20, 1.2, rows), -3),
+        "DU_NO_PHAN_BO_QUY_DOI": np.round(r.lognormal(19, 1.4, rows), -3),
+        "BRANCH_VAY": branches[cif_branch[ci]],
+        "SECU_SRL_NUM": (1_000_000 + r.integers(0, n_secu, rows)).astype(str).astype(object),
+        "VALUATION_DATE": NGAY_DANH_GIA - pd.to_timedelta(r.integers(0, 4 * 365, rows), "D"),
+    })
+
+    # CRM32 + bảng mã mục đích
+    n32 = max(1, rows // 2)
+    cj = _skewed(r, n_cif, n32)
+    ma_md = [f"MD{i:03d}" for i in range(60)]
+    code_mdsd = pd.DataFrame({
+        "CODE_MDSDV4": ma_md[:55],  # 5 mã không có trong bảng → "(blank)"
+        "GROUP": r.choice(["SXKD", "Tiêu dùng", "BĐS", "Cầm cố GTCG", "Khác"], 55),
+    })
+    khe_uoc = np.char.add("KU", np.arange(n32).astype(str)).astype(object)
+    crm32 = pd.DataFrame({
+        "CUSTSEQLN": cif_ids[cj],
+        "BRCD": branches[cif_branch[cj]],
+        "KHE_UOC": khe_uoc,
+        "MUC_DICH_VAY_CAP_4": np.array(ma_md, dtype=object)[_skewed(r, 60, n32, 1.5)],
+        "CAP_PHE_DUYET": np.char.add(np.char.zfill(r.integers(1, 36, n32).astype(str), 2), "-PD").astype(object),
+        "SCHEME_CODE": np.where(r.random(n32) < 0.05, r.choice(MA_CO_CAU, n32), "NORM1").astype(object),
+        "DU_NO_QUY_DOI": np.round(r.lognormal(19, 1.4, n32), -3),
+    })
+    giai_ngan_tm = pd.DataFrame({"FORACID": khe_uoc[r.random(n32) < 0.01]})
+
+    # Mục 17: một dòng cho mỗi TSBĐ, địa chỉ kết thúc bằng tỉnh/thành
+    secu = np.arange(1_000_000, 1_000_000 + n_secu).astype(str).astype(object)
+    tinh = np.array(TINH_TP, dtype=object)[r.choice(len(TINH_TP), n_secu, p=TINH_TP_P)]
+    muc17 = pd.DataFrame({
+        "C01": secu,
+        "C02": np.where(r.random(n_secu) < 0.6, "Bat dong san", "Dong san").astype(object),
+        "C19": np.char.add(np.char.add("Số ", np.arange(n_secu).astype(str)), ", Phường 1, ").astype(object) + tinh,
+    })
+
+    # Mục 55/56: tất toán & giải ngân trong 1 năm → có KH cùng ngày có cả hai
+    n5x = max(1, rows // 5)
+    ngay0 = NGAY_DANH_GIA - pd.Timedelta(days=365)
+    cif55, cif56 = cif_ids[_skewed(r, n_cif, n5x)], cif_ids[_skewed(r, n_cif, n5x)]
+    muc55 = pd.DataFrame({
+        "CUSTSEQLN": cif55,
+        "NMLOC": np.char.add("KH ", cif55.astype(str)).astype(object),
+        "KHE_UOC": khe_uoc[r.integers(0, n32, n5x)],
+        "SOTIENGIAINGAN": np.round(r.lognormal(19, 1, n5x), -3),
+        "NGAYGN": ngay0 - pd.to_timedelta(r.integers(30, 720, n5x), "D"),
+        "NGAYDH": ngay0 + pd.to_timedelta(r.integers(30, 720, n5x), "D"),
+        "NGAY_TT": ngay0 + pd.to_timedelta(r.integers(0, 365, n5x), "D"),
+        "LOAITIEN": np.where(r.random(n5x) < 0.95, "VND", "USD").astype(object),
+    })
+    muc56 = pd.DataFrame({
+        "CIF": cif56,
+        "TEN_KHACH_HANG": np.char.add("KH ", cif56.astype(str)).astype(object),
+        "KHE_UOC": khe_uoc[r.integers(0, n32, n5x)],
+        "SO_TIEN_GIAI_NGAN_VND": np.round(r.lognormal(19, 1, n5x), -3),
+        "NGAY_GIAI_NGAN": ngay0 + pd.to_timedelta(r.integers(0, 365, n5x), "D"),
+        "NGAY_DAO_HAN": ngay0 + pd.to_timedelta(r.integers(365, 1500, n5x), "D"),
+        "LOAI_TIEN_HD": np.where(r.random(n5x) < 0.95, "VND", "USD").astype(object),
+    })
+
+    # Mục 57: lịch trả nợ 2022–2025, đa số trả đúng hạn, ~2% chưa trả
+    den_han = pd.Timestamp("2022-01-01") + pd.to_timedelta(r.integers(0, 4 * 365, rows), "D")
+    tre = np.where(r.random(rows) < 0.95, 0, r.integers(1, 30, rows))
+    thanh_toan = pd.Series(den_han + pd.to_timedelta(tre, "D")).where(r.random(rows) > 0.02)
+    muc57 = pd.DataFrame({
+        "CIF_ID": cif_ids[_skewed(r, n_cif, rows)],
+        "NGAY_DEN_HAN_TT": den_han,
+        "NGAY_THANH_TOAN": thanh_toan,
+    })
+
+    raw = {
+        "crm4": crm4, "crm32": crm32, "code_mdsd": code_mdsd, "code_tsbd": code_tsbd,
+        "giai_ngan_tm": giai_ngan_tm, "muc17": muc17, "muc55": muc55, "muc56": muc56, "muc57": muc57,
+    }
+    inputs = {kind: apply_schema(raw[kind], kind) for kind in INPUT_KINDS}
+    for kind in MULTI_FILE_INPUTS:
+        # Như load_and_concat: cột category của schema giữ kiểu category
+        for c in crm_io.SCHEMAS[kind].get("category", []):
+            inputs[kind][c] = inputs[kind][c].astype("category")
+    return inputs
+
+
+# ============================ RUNNERS ============================ #
+def write_inputs_xlsx(inputs: Dict[str, pd.DataFrame], folder: Path) -> Dict[str, Path]:
+    """Ghi mỗi bảng ra ``<kind>.xlsx`` để đo bước đọc file như khi upload."""
+    paths = {}
+    for kind, df in inputs.items():
+        paths[kind] = folder / f"{kind}.xlsx"
+        df.to_excel(paths[kind], index=False)
+    return paths
+
+
+def bench_ingest(paths: Dict[str, Path], prof: StageProfiler) -> None:
+    """Đo ``load_inputs``: lần đầu (parse Excel) rồi lần hai (cache Parquet), trên thư mục cache tạm."""
+    files = {kind: [open(p, "rb")] if kind in MULTI_FILE_INPUTS else open(p, "rb") for kind, p in paths.items()}
+    cache_dir = crm_io.CACHE_DIR
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            crm_io.CACHE_DIR = Path(tmp)
+            for lan in ["lần đầu", "từ cache"]:
+                with prof.stage(f"đọc file ({lan})") as out:
+                    loaded = load_inputs(files)
+                    out(rows=sum(len(df) for df in loaded.values()))
+    finally:
+        crm_io.CACHE_DIR = cache_dir
+        for f in files.values():
+            for fh in f if isinstance(f, list) else [f]:
+                fh.close()
+
+
+def bench_once(
+    inputs: Dict[str, pd.DataFrame], export: Optional[str], xlsx_paths: Optional[Dict[str, Path]] = None
+) -> List[Dict[str, object]]:
+    """Một lượt đo: (tuỳ chọn) đọc file, từng bước của run_pipeline, tổng và (tuỳ chọn) xuất file."""
+    prof = StageProfiler()
+    if xlsx_paths:
+        bench_ingest(xlsx_paths, prof)
+    with prof.stage("tổng run_pipeline", len(inputs["crm4"])) as out:
+        result = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN_KT, prof=prof)
+        out(result["pivot_full"])
+    if export:
+        with prof.stage(f"xuất file: {export}") as out:
+            out(rows=len(export_bytes(result, export)))
+    return prof.records
+
+
+def bench_scale(rows: int, repeat: int, seed: int, export: Optional[str], ingest: bool, trace_memory: bool) -> pd.DataFrame:
+    """Đo ``repeat`` lượt; mỗi bước lấy thời gian nhỏ nhất (ít nhiễu nhất), bộ nhớ lấy lớn nhất."""
+    inputs = make_dataset(rows, seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        xlsx_paths = write_inputs_xlsx(inputs, Path(tmp)) if ingest else None
+        runs = [pd.DataFrame(bench_once(inputs, export, xlsx_paths), columns=STAGE_COLUMNS) for _ in range(repeat)]
+        if trace_memory:
+            # Lượt riêng có tracemalloc (chậm hơn) → không lẫn vào số đo thời gian
+            tracemalloc.start()
+            try:
+                traced = pd.DataFrame(bench_once(inputs, export, xlsx_paths), columns=STAGE_COLUMNS)
+            finally:
+                tracemalloc.stop()
+            runs[0]["alloc_peak_mb"] = traced["alloc_peak_mb"].to_numpy()
+    df = pd.concat(runs, keys=range(repeat), names=["run", "pos"]).reset_index()
+    agg = df.groupby("pos").agg(
+        stage=("stage", "first"), seconds=("seconds", "min"), rows_in=("rows_in", "first"),
+        rows_out=("rows_out", "first"), df_mb=("df_mb", "max"), rss_mb=("rss_mb", "max"),
+        rss_delta_mb=("rss_delta_mb", "max"), peak_rss_mb=("peak_rss_mb", "max"), alloc_peak_mb=("alloc_peak_mb", "max"),
+    )
+    return agg.reset_index(drop=True)
+
+
+# ============================ BASELINE ============================ #
+def environment() -> Dict[str, str]:
+    return {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+            "machine": platform.machine(), "processor": platform.processor() or platform.machine()}
+
+
+def compare(current: Dict[str, pd.DataFrame], baseline: dict, tolerance: float, min_seconds: float) -> pd.DataFrame:
+    """Bảng so sánh theo (quy mô, bước); ``CHẬM HƠN`` khi chậm hơn baseline quá ``tolerance``
+    và chênh lệch tuyệt đối > ``min_seconds`` (bỏ qua dao động của các bước rất nhanh)."""
+    rows = []
+    for scale, df in current.items():
+        base = {s["stage"]: s for s in baseline.get("results", {}).get(str(scale), [])}
+        for rec in df.to_dict("records"):
+            b = base.get(rec["stage"])
+            if b is None:
+                continue
+            ratio = rec["seconds"] / b["seconds"] if b["seconds"] else np.nan
+            diff = rec["seconds"] - b["seconds"]
+            if diff > min_seconds and ratio > 1 + tolerance:
+                ket_luan = "CHẬM HƠN"
+            elif -diff > min_seconds and ratio < 1 - tolerance:
+                ket_luan = "nhanh hơn"
+            else:
+                ket_luan = ""
+            rows.append({"rows": scale, "stage": rec["stage"], "baseline_s": b["seconds"], "hien_tai_s": rec["seconds"],
+                         "ty_le": round(ratio, 2), "rss_mb": rec["rss_mb"], "baseline_rss_mb": b.get("rss_mb"),
+                         "ket_luan": ket_luan})
+    return pd.DataFrame(rows)
+
+
+# ============================ CLI ============================ #
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark pipeline CRM4/CRM32 trên dữ liệu tổng hợp.")
+    p.add_argument("--rows", nargs="+", default=["10k", "100k"],
+                   help="Số dòng CRM4 cho mỗi quy mô, ví dụ: 10k 100k 1M 5M")
+    p.add_argument("--repeat", type=int, default=3, help="Số lượt đo mỗi quy mô (lấy thời gian nhỏ nhất)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--export", choices=list(EXPORT_FORMATS), help="Đo thêm bước xuất file theo định dạng này")
+    p.add_argument("--ingest", action="store_true",
+                   help=f"Đo thêm bước đọc .xlsx (chỉ quy mô <= {EXCEL_MAX_ROWS - 1:,} dòng; ghi file mẫu khá lâu)")
+    p.add_argument("--trace-memory", action="store_true",
+                   help="Chạy thêm một lượt với tracemalloc để đo đỉnh cấp phát từng bước")
+    p.add_argument("--out", help="Ghi kết quả lượt này ra JSON")
+    p.add_argument("--save-baseline", help="Lưu kết quả lượt này làm baseline (JSON)")
+    p.add_argument("--baseline", help="So sánh với baseline JSON đã lưu")
+    p.add_argument("--tolerance", type=float, default=0.15, help="Ngưỡng chậm hơn tương đối (mặc định 15%%)")
+    p.add_argument("--min-seconds", type=float, default=0.05, help="Bỏ qua chênh lệch nhỏ hơn số giây này")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    quiet_streamlit()
+
+    results: Dict[int, pd.DataFrame] = {}
+    for rows in sorted(parse_scale(s) for s in args.rows):
+        ingest = args.ingest and rows < EXCEL_MAX_ROWS
+        df = bench_scale(rows, max(1, args.repeat), args.seed, args.export, ingest, args.trace_memory)
+        results[rows] = df
+        print(f"\n=== {rows:,} dòng CRM4 ===")
+        print(df.to_string(index=False))
+
+    report = {
+        "meta": {**environment(), "seed": args.seed, "repeat": args.repeat,
+                 "ngay": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": {str(k): json.loads(v.to_json(orient="records")) for k, v in results.items()},
+    }
+    for path in [args.out, args.save_baseline]:
+        if path:
+            Path(path).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        if baseline.get("meta", {}).get("machine") != report["meta"]["machine"]:
+            print("\n(!) Baseline đo trên máy khác — chỉ nên so sánh tương đối.")
+        cmp = compare(results, baseline, args.tolerance, args.min_seconds)
+        print("\n=== So với baseline ===")
+        print(cmp.to_string(index=False) if not cmp.empty else "Không có bước nào trùng để so sánh.")
+        if (cmp.get("ket_luan", pd.Series(dtype=object)) == "CHẬM HƠN").any():
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
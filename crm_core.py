@@ -0,0 +1,1611 @@
+# -------------------------------------------------------------
+# Lõi xử lý CRM4 / CRM32 — không phụ thuộc giao diện
+# Dùng chung cho app Streamlit (app_crm.py) và chế độ chạy lô (crm_batch.py).
+# -------------------------------------------------------------
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from crm_io import (
+    SCHEMAS,
+    cache_get,
+    cache_key,
+    cache_put,
+    content_hash,
+    file_bytes,
+    iter_chunks,
+    normalize_dtypes,
+    read_excel_any,
+    read_excel_multi,
+)
+from crm_profile import StageProfiler
+from crm_province import resolve_dia_ban, resolve_provinces
+
+# ============================ HELPERS ============================ #
+
+def safe_str(series: pd.Series) -> pd.Series:
+    return series.astype(str).str.strip()
+
+
+def to_str_intlike(series: pd.Series) -> pd.Series:
+    """Coerce số dạng object/float → int → str (giữ nguyên NaN)."""
+    s = pd.to_numeric(series, errors="coerce")
+    s = s.dropna().astype("int64").astype(str)
+    return s
+
+
+def mark_isin(keys: pd.Series, members, mark: str = "x") -> np.ndarray:
+    """Cờ vector hoá: ``mark`` nếu key (so theo str) thuộc ``members``, ngược lại ""."""
+    members = pd.Index(pd.Series(members, dtype=object)).astype(str)
+    return np.where(keys.astype(str).isin(members), mark, "")
+
+
+def mark_codes(codes: np.ndarray, members, size: int, mark: str = "x") -> np.ndarray:
+    """Như ``mark_isin`` nhưng trên mã CIF (``encode_cifs``): tra bảng bool độ dài ``size``.
+
+    Mã -1 (CIF không có trong từ điển) ở cả hai phía không bao giờ được đánh dấu.
+    """
+    members = np.asarray(members, dtype=np.int64)
+    hit = np.zeros(size, dtype=bool)
+    hit[members[members >= 0]] = True
+    return np.where((codes >= 0) & hit[codes], mark, "")
+
+
+def dong_theo_ma(ma_piv: np.ndarray, size: int) -> np.ndarray:
+    """Bảng tra mã CIF → dòng ``piv`` (-1 nếu CIF không có dòng); ô cuối cho mã -1."""
+    dong = np.full(size + 1, -1)
+    dong[ma_piv[ma_piv >= 0]] = np.flatnonzero(ma_piv >= 0)
+    return dong
+
+
+def ensure_cols(df: pd.DataFrame, cols: List[str]) -> bool:
+    missing = [c for c in cols if c not in df.columns]
+    if missing:
+        st.warning(f"Thiếu cột: {', '.join(missing)}")
+        return False
+    return True
+
+# ============================ CORE LOGIC ============================ #
+def load_and_concat(files: List, kind: Optional[str] = None, project: bool = True) -> pd.DataFrame:
+    return _concat_frames(read_excel_multi(files, kind=kind, project=project), kind)
+
+
+def _concat_frames(dfs: List[pd.DataFrame], kind: Optional[str]) -> pd.DataFrame:
+    if not dfs:
+        return pd.DataFrame()
+    df = pd.concat(dfs, ignore_index=True)
+    # concat các category khác tập giá trị sẽ thành object → ép lại theo schema
+    for c in SCHEMAS.get(kind, {}).get("category", []):
+        if c in df.columns and df[c].dtype != "category":
+            df[c] = df[c].astype("category")
+    return df
+
+
+# Bảng mã đã biên dịch (mã → giá trị), nhớ trong tiến trình theo hash nội dung: bảng mã đọc
+# lại từ cache Parquet ở mỗi lần chạy chỉ biên dịch một lần
+CODE_MAPS_MAX = 16
+_CODE_MAPS: Dict[str, Tuple[pd.Series, pd.Index]] = {}
+_CODE_MAPS_LOCK = threading.Lock()  # phiên Streamlit và luồng tiêu chí dùng chung bảng nhớ
+
+
+def compile_code_map(df_code: pd.DataFrame, cot_ma: str, cot_gia_tri: str) -> Tuple[pd.Series, pd.Index]:
+    """Bảng mã → (Series mã → giá trị có chỉ mục duy nhất để ``Series.map``, các mã trùng khác giá trị).
+
+    Mã lặp lại lấy giá trị đầu tiên — merge cũ nhân dòng dữ liệu theo số lần lặp.
+    """
+    bang = df_code[[cot_ma, cot_gia_tri]]
+    key = f"{cot_ma}|{cot_gia_tri}|" + content_hash(pd.util.hash_pandas_object(bang, index=False).to_numpy().tobytes())
+    with _CODE_MAPS_LOCK:
+        da_co = _CODE_MAPS.get(key)
+    if da_co is not None:
+        return da_co
+    # Biên dịch ngoài khoá (hai luồng cùng bảng mã chỉ tính trùng, kết quả như nhau)
+    bang = bang.drop_duplicates()
+    trung = pd.Index(bang.loc[bang[cot_ma].duplicated(), cot_ma].unique())
+    bang = bang.drop_duplicates(cot_ma)
+    ket_qua = (pd.Series(bang[cot_gia_tri].to_numpy(), index=pd.Index(bang[cot_ma].to_numpy())), trung)
+    with _CODE_MAPS_LOCK:
+        _CODE_MAPS[key] = ket_qua
+        while len(_CODE_MAPS) > CODE_MAPS_MAX:
+            _CODE_MAPS.pop(next(iter(_CODE_MAPS)))
+    return ket_qua
+
+
+def _code_map_tsbd(df_code_tsbd: pd.DataFrame) -> Optional[Tuple[pd.Series, pd.Index]]:
+    # Chuẩn tên cột theo yêu cầu script gốc: 'CODE CAP 2' -> 'CAP_2', 'CODE' -> 'LOAI_TS'
+    if "CODE CAP 2" in df_code_tsbd.columns and "CODE" in df_code_tsbd.columns:
+        return compile_code_map(df_code_tsbd, "CODE CAP 2", "CODE")
+    if "CAP_2" in df_code_tsbd.columns and "LOAI_TS" in df_code_tsbd.columns:
+        return compile_code_map(df_code_tsbd, "CAP_2", "LOAI_TS")
+    return None
+
+
+def _code_map_mdsd(df_muc_dich: pd.DataFrame) -> Optional[Tuple[pd.Series, pd.Index]]:
+    # Chuẩn tên: CODE_MDSDV4 -> MUC_DICH_VAY_CAP_4, GROUP -> MUC DICH
+    if "CODE_MDSDV4" in df_muc_dich.columns and "GROUP" in df_muc_dich.columns:
+        return compile_code_map(df_muc_dich, "CODE_MDSDV4", "GROUP")
+    return None
+
+
+def _lookup(series: pd.Series, code_map: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Tra ``code_map`` trên các giá trị khác nhau của ``series`` rồi trải lại theo dòng.
+
+    Trả về (giá trị theo dòng — NaN nếu không có trong bảng mã, mặt nạ mã trống/NaN).
+    """
+    codes, uniques = pd.factorize(series)
+    vi_tri = code_map.index.get_indexer(uniques)
+    gia_tri = np.append(code_map.to_numpy(dtype=object)[vi_tri], np.nan)  # ô cuối cho mã NaN (-1)
+    gia_tri[:-1][vi_tri < 0] = np.nan
+    trong = np.append(pd.Index(uniques).astype(str).str.strip() == "", True)
+    return gia_tri[codes], trong[codes]
+
+
+def add_loai_ts(df_crm4: pd.DataFrame, df_code_tsbd: pd.DataFrame) -> pd.DataFrame:
+    if df_crm4.empty:
+        return df_crm4
+    # Chuẩn hoá & ánh xạ mã loại TSBĐ (tra mã theo dòng, không merge → không nhân dòng)
+    if not df_code_tsbd.empty:
+        ma = _code_map_tsbd(df_code_tsbd)
+        if ma is None:
+            st.warning("Bảng mã TSBĐ không có cột 'CODE CAP 2'/'CAP_2' và 'CODE'/'LOAI_TS'. Bỏ qua ánh xạ.")
+        elif "CAP_2" in df_crm4.columns:
+            loai_ts, thieu_ma = _lookup(df_crm4["CAP_2"], ma[0])
+            df_crm4 = df_crm4.reset_index(drop=True)
+            # Gán 'Không TS' nếu thiếu mã
+            df_crm4["LOAI_TS"] = np.where(thieu_ma, "Không TS", loai_ts)
+            # Ghi chú 'MỚI' nếu có CAP_2 nhưng không tìm thấy loại TS
+            df_crm4["GHI_CHU_TSBD"] = np.where(~thieu_ma & pd.isna(loai_ts), "MỚI", "")
+    return df_crm4
+
+
+def add_muc_dich_crm32(df_crm32: pd.DataFrame, df_muc_dich: pd.DataFrame) -> pd.DataFrame:
+    if df_crm32.empty:
+        return df_crm32
+    if not df_muc_dich.empty:
+        ma = _code_map_mdsd(df_muc_dich)
+        if ma is None:
+            st.warning("Bảng CODE_MDSDV4 thiếu cột 'CODE_MDSDV4'/'GROUP'. Bỏ qua ánh xạ mục đích vay.")
+        elif "MUC_DICH_VAY_CAP_4" in df_crm32.columns:
+            muc_dich, _ = _lookup(df_crm32["MUC_DICH_VAY_CAP_4"], ma[0])
+            df_crm32 = df_crm32.reset_index(drop=True)
+            df_crm32["MUC DICH"] = np.where(pd.isna(muc_dich), "(blank)", muc_dich)
+    return df_crm32
+
+
+def unmapped_codes(
+    df_crm4: pd.DataFrame, df_crm32: pd.DataFrame, df_code_tsbd: pd.DataFrame, df_muc_dich: pd.DataFrame
+) -> pd.DataFrame:
+    """Báo cáo mã CAP_2 (CRM4) / MUC_DICH_VAY_CAP_4 (CRM32) chưa có trong bảng mã và mã trùng trong bảng mã.
+
+    Một dòng mỗi mã: BANG, COT_MA, MA, SO_DONG (số dòng dữ liệu dùng mã), GHI_CHU.
+    """
+    parts = []
+    for bang, df, cot, df_code, compile_ in [
+        ("CRM4", df_crm4, "CAP_2", df_code_tsbd, _code_map_tsbd),
+        ("CRM32", df_crm32, "MUC_DICH_VAY_CAP_4", df_muc_dich, _code_map_mdsd),
+    ]:
+        if df.empty or df_code.empty or cot not in df.columns:
+            continue
+        ma = compile_(df_code)
+        if ma is None:
+            continue
+        dem = df[cot].value_counts()
+        dem = dem[dem.index.astype(str).str.strip() != ""]
+        for ghi_chu, chon in [
+            ("chưa có trong bảng mã", ~dem.index.isin(ma[0].index)),
+            ("trùng mã trong bảng mã (lấy giá trị đầu tiên)", dem.index.isin(ma[1])),
+        ]:
+            d = dem[chon]
+            parts.append(pd.DataFrame({"BANG": bang, "COT_MA": cot, "MA": d.index.astype(object), "SO_DONG": d.to_numpy(), "GHI_CHU": ghi_chu}))
+    if not parts:
+        return pd.DataFrame(columns=["BANG", "COT_MA", "MA", "SO_DONG", "GHI_CHU"])
+    return pd.concat(parts, ignore_index=True)
+
+
+LOAI_NGOAI_VAY = ["Bao lanh", "LC"]
+NHOM_LOAI = ["Cho vay", "Bao lanh", "LC"]  # các LOAI khác (kể cả trống) gộp vào "(blank)"
+CRM4_PIVOT_COLS = ["CIF_KH_VAY", "LOAI", "LOAI_TS", "TS_KW_VND", "DU_NO_PHAN_BO_QUY_DOI"]
+
+
+def _wide_sum(row_codes: np.ndarray, n_rows: int, col_codes: np.ndarray, n_cols: int, values: np.ndarray) -> np.ndarray:
+    """Cộng dồn values vào ma trận (n_rows × n_cols) theo cặp mã — một lượt np.bincount."""
+    flat = row_codes * n_cols + col_codes
+    return np.bincount(flat, weights=values, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+
+
+def _wide_frame(cifs: pd.Index, keep: np.ndarray, matrix: np.ndarray, labels) -> pd.DataFrame:
+    out = pd.DataFrame(matrix[keep], columns=list(labels))
+    out.insert(0, "CIF_KH_VAY", cifs[keep])
+    return out
+
+
+def aggregate_crm4(
+    df_crm4: pd.DataFrame, cif_codes: Optional[np.ndarray] = None, cif_vocab: Optional[pd.Index] = None
+) -> Dict[str, pd.DataFrame]:
+    """Tổng hợp CRM4 theo CIF trong một lượt (factorize CIF một lần + np.bincount).
+
+    Có ``cif_codes``/``cif_vocab`` (``encode_cifs``) thì nhóm trên mã int64 thay vì chuỗi;
+    từ điển đã sắp xếp nên thứ tự CIF vẫn như pivot_table.
+
+    Trả về các bảng rộng (cột CIF_KH_VAY + một cột mỗi nhóm, sắp xếp như pivot_table):
+      "no"   : DU_NO_PHAN_BO_QUY_DOI theo LOAI_TS, chỉ dòng vay (bỏ Bảo lãnh/LC)
+      "ts"   : TS_KW_VND theo LOAI_TS, chỉ dòng vay
+      "loai" : DU_NO_PHAN_BO_QUY_DOI theo nhóm LOAI (Cho vay/Bao lanh/LC/(blank)), mọi dòng
+    """
+    if cif_codes is not None and cif_vocab is not None:
+        uniq, cif_codes = np.unique(cif_codes, return_inverse=True)
+        cifs = cif_vocab[uniq]
+    else:
+        cif_codes, cifs = pd.factorize(df_crm4["CIF_KH_VAY"], sort=True)
+    has_cif = cif_codes >= 0
+    no = pd.to_numeric(df_crm4["DU_NO_PHAN_BO_QUY_DOI"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    ts = pd.to_numeric(df_crm4["TS_KW_VND"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    loai = df_crm4["LOAI"]
+
+    # Dòng vay có LOAI_TS (pivot_table bỏ các dòng thiếu khoá)
+    m = has_cif & ~loai.isin(LOAI_NGOAI_VAY).to_numpy() & df_crm4["LOAI_TS"].notna().to_numpy()
+    ts_codes, ts_labels = pd.factorize(df_crm4["LOAI_TS"].to_numpy()[m], sort=True)
+    rows = cif_codes[m]
+    keep = np.bincount(rows, minlength=len(cifs)) > 0
+    wide_no = _wide_sum(rows, len(cifs), ts_codes, len(ts_labels), no[m])
+    wide_ts = _wide_sum(rows, len(cifs), ts_codes, len(ts_labels), ts[m])
+
+    nhom = np.where(loai.isin(NHOM_LOAI), loai.astype(object), "(blank)")[has_cif]
+    nhom_codes, nhom_labels = pd.factorize(nhom, sort=True)
+    keep_all = np.bincount(cif_codes[has_cif], minlength=len(cifs)) > 0
+    wide_loai = _wide_sum(cif_codes[has_cif], len(cifs), nhom_codes, len(nhom_labels), no[has_cif])
+
+    return {
+        "no": _wide_frame(cifs, keep, wide_no, ts_labels),
+        "ts": _wide_frame(cifs, keep, wide_ts, ts_labels),
+        "loai": _wide_frame(cifs, keep_all, wide_loai, nhom_labels),
+    }
+
+
+def build_pivots(
+    df_crm4: pd.DataFrame, crm4_agg: Optional[Dict[str, pd.DataFrame]] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Trả về: (pivot_ts, pivot_no, pivot_merge, pivot_final).
+
+    ``crm4_agg`` là kết quả ``aggregate_crm4`` nếu đã tính sẵn (dùng lại cho add_flags_and_joins).
+    """
+    if not ensure_cols(df_crm4, CRM4_PIVOT_COLS):
+        return (pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), pd.DataFrame())
+
+    if crm4_agg is None:
+        crm4_agg = aggregate_crm4(df_crm4)
+    pivot_no = crm4_agg["no"]
+    pivot_ts = pivot_no[["CIF_KH_VAY"]].join(crm4_agg["ts"].drop(columns="CIF_KH_VAY").add_suffix(" (Giá trị TS)"))
+
+    # pivot_no và pivot_ts cùng tập CIF, cùng thứ tự → ghép cột, không cần merge
+    pivot_merge = pd.concat([pivot_no, pivot_ts.drop(columns="CIF_KH_VAY")], axis=1)
+
+    # Tính tổng DƯ NỢ & GIÁ TRỊ TS theo cột
+    debt_cols = [c for c in pivot_no.columns if c != "CIF_KH_VAY"]
+    ts_cols = [c for c in pivot_ts.columns if c != "CIF_KH_VAY"]
+    pivot_merge["DƯ NỢ"] = pivot_merge[debt_cols].sum(axis=1) if debt_cols else 0
+    pivot_merge["GIÁ TRỊ TS"] = pivot_merge[ts_cols].sum(axis=1) if ts_cols else 0
+
+    # Thêm info khách hàng (nếu có)
+    info_cols = [c for c in ["CIF_KH_VAY", "TEN_KH_VAY", "CUSTTPCD", "NHOM_NO"] if c in df_crm4.columns]
+    df_info = df_crm4[info_cols].drop_duplicates(subset="CIF_KH_VAY") if info_cols else pd.DataFrame({"CIF_KH_VAY": pivot_merge["CIF_KH_VAY"]})
+    pivot_final = df_info.merge(pivot_merge, on="CIF_KH_VAY", how="left")
+    pivot_final = pivot_final.reset_index(drop=True)
+    pivot_final.insert(0, "STT", np.arange(1, len(pivot_final) + 1))
+
+    # Sắp xếp cột hiển thị
+    debt_only = sorted([c for c in debt_cols if "(Giá trị TS)" not in c])
+    ts_only = sorted(ts_cols)
+    ordered = (["STT"] + [c for c in ["CUSTTPCD", "CIF_KH_VAY", "TEN_KH_VAY", "NHOM_NO"] if c in pivot_final.columns]
+               + debt_only + ts_only + ["DƯ NỢ", "GIÁ TRỊ TS"])
+    pivot_final = pivot_final[[c for c in ordered if c in pivot_final.columns]]
+
+    return pivot_ts, pivot_no, pivot_merge, pivot_final
+
+
+def enrich_crm32(df_crm32: pd.DataFrame) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    if df_crm32.empty:
+        return df_crm32, np.array([]), np.array([])
+
+    df_crm32 = df_crm32.copy()
+    if "CAP_PHE_DUYET" in df_crm32.columns:
+        df_crm32["MA_PHE_DUYET"] = safe_str(df_crm32["CAP_PHE_DUYET"]).str.split("-").str[0].str.zfill(2)
+    else:
+        df_crm32["MA_PHE_DUYET"] = ""
+
+    # CUSTSEQLN đã chuẩn ở bước chuẩn hoá CIF (prepare_frames)
+    return (df_crm32, *crm32_cif_lists(df_crm32))
+
+
+MA_CAP_C = [f"{i:02d}" for i in range(1, 8)] + [f"{i:02d}" for i in range(28, 32)]
+MA_CO_CAU = [
+    "ACOV1", "ACOV3", "ATT01", "ATT02", "ATT03", "ATT04",
+    "BCOV1", "BCOV2", "BTT01", "BTT02", "BTT03",
+    "CCOV2", "CCOV3", "CTT03", "RCOV3", "RTT03",
+]
+
+
+def crm32_cif_lists(df_crm32: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """(CIF có khoản do chuyên gia PD cấp C duyệt, CIF có khoản cơ cấu) từ CRM32 đã enrich."""
+    list_cif_cap_c = df_crm32[df_crm32["MA_PHE_DUYET"].isin(MA_CAP_C)]["CUSTSEQLN"].unique()
+    if "SCHEME_CODE" in df_crm32.columns:
+        cif_co_cau = df_crm32[df_crm32["SCHEME_CODE"].isin(MA_CO_CAU)]["CUSTSEQLN"].unique()
+    else:
+        cif_co_cau = np.array([])
+    return list_cif_cap_c, cif_co_cau
+
+
+def pivot_muc_dich(df_crm32: pd.DataFrame) -> pd.DataFrame:
+    if df_crm32.empty:
+        return pd.DataFrame()
+    if not ensure_cols(df_crm32, ["CUSTSEQLN", "MUC DICH", "DU_NO_QUY_DOI"]):
+        return pd.DataFrame()
+    p = (
+        df_crm32.pivot_table(index="CUSTSEQLN", columns="MUC DICH", values="DU_NO_QUY_DOI", aggfunc="sum", fill_value=0)
+        .reset_index()
+    )
+    p["DƯ NỢ CRM32"] = p.drop(columns=["CUSTSEQLN"]).sum(axis=1)
+    return p
+
+
+# R34: TSBĐ BĐS/MMTB/PTVT quá hạn định giá khi quá 1 năm + 30 ngày kể từ ngày định giá
+R34_SO_NGAY = 365 + 30
+# Bảng quy tắc R34: loại TS → số ngày tối đa kể từ ngày định giá (loại không có trong bảng: không xét)
+R34_QUY_TAC = {"BĐS": R34_SO_NGAY, "MMTB": R34_SO_NGAY, "PTVT": R34_SO_NGAY}
+R34_LOAI_TS = list(R34_QUY_TAC)
+# Tiêu chí 4: mặc định chỉ xét các kỳ đến hạn trong các năm này (tham số ``nam_cham_tra``)
+NAM_CHAM_TRA = (2023, 2025)
+# Tiêu chí 3: số ngày lệch tối đa giữa Giải ngân và Tất toán được ghép cặp (0 = cùng ngày)
+TC3_SO_NGAY = 0
+# Mức chậm trả theo số ngày: mốc bắt đầu mỗi mức (np.digitize) → nhãn; mức 0 = không chậm
+CAP_CHAM_TRA_MOC = [1, 4, 10]
+CAP_CHAM_TRA = np.array([None, "<4", "4-9", ">=10"], dtype=object)
+
+
+def r34_so_ngay_qua_han(df_crm4: pd.DataFrame, ngay_danh_gia) -> np.ndarray:
+    """Số ngày quá hạn định giá của từng dòng CRM4 theo ``R34_QUY_TAC`` (> 0 là quá hạn).
+
+    Chỉ đọc LOAI_TS/VALUATION_DATE, một lượt numpy cho mọi dòng. ``ngay_danh_gia`` là một ngày
+    → mảng (số dòng,); list ngày → ma trận (số dòng, số ngày). NaN: loại TS ngoài bảng quy tắc
+    hoặc thiếu ngày định giá.
+    """
+    loai = df_crm4["LOAI_TS"] if "LOAI_TS" in df_crm4.columns else pd.Series(None, index=df_crm4.index, dtype=object)
+    han = np.asarray(loai.map(R34_QUY_TAC), dtype=float)
+    dinh_gia = pd.to_datetime(df_crm4["VALUATION_DATE"], errors="coerce").to_numpy(dtype="datetime64[ns]")
+    ngay = pd.to_datetime(np.atleast_1d(ngay_danh_gia)).to_numpy(dtype="datetime64[ns]")
+    # Số ngày nguyên (làm tròn xuống như Timedelta.days) giữa ngày đánh giá và ngày định giá
+    thieu = np.isnat(dinh_gia)
+    dinh_gia = np.where(thieu, ngay[0], dinh_gia)
+    so_ngay = ((ngay[None, :] - dinh_gia[:, None]) // np.timedelta64(1, "D")).astype(float)
+    so_ngay[thieu] = np.nan
+    out = so_ngay - han[:, None]
+    return out if np.ndim(ngay_danh_gia) else out[:, 0]
+
+
+def r34_qua_han(df_crm4: pd.DataFrame, ngay_danh_gia) -> np.ndarray:
+    """Mặt nạ dòng CRM4 có TSBĐ thuộc R34 quá hạn định giá tại ``ngay_danh_gia`` (một ngày hoặc list ngày)."""
+    return r34_so_ngay_qua_han(df_crm4, ngay_danh_gia) > 0
+
+
+def mark_top10(piv: pd.DataFrame) -> pd.DataFrame:
+    """Gắn cờ Top 10 dư nợ KHCN/KHDN (xếp hạng trên toàn bảng, sửa tại chỗ).
+
+    Mỗi CIF một dòng → đánh dấu theo nhãn dòng được chọn, không so chuỗi CIF.
+    """
+    for col, flags in top10_flags(piv).items():
+        piv[col] = flags
+    return piv
+
+
+def top10_flags(piv: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """Cột cờ Top 10 dư nợ KHCN/KHDN theo dòng ``piv`` (không sửa ``piv``); thiếu cột → {}."""
+    if "CUSTTPCD" not in piv.columns or "DƯ NỢ" not in piv.columns:
+        return {}
+    top = rank_top_n(piv, "DƯ NỢ", "CUSTTPCD", 10, na_cuoi=True) > 0  # như nlargest(10) bản gốc
+    loai_kh = piv["CUSTTPCD"].to_numpy()
+    return {
+        "Top 10 dư nợ KHCN": np.where(top & (loai_kh == "Ca nhan"), "x", ""),
+        "Top 10 dư nợ KHDN": np.where(top & (loai_kh == "Doanh nghiep"), "x", ""),
+    }
+
+
+# Xếp hạng Top N: mỗi mục một cột hạng "Hạng <chỉ số>[ theo <nhóm>]"; nhom=None → xếp trên toàn bảng.
+# Chạy lô theo chi nhánh: mỗi chi nhánh là một bảng kết quả riêng nên hạng đã là hạng trong chi nhánh.
+TOP_N = 10
+RANKINGS = [
+    {"chi_so": "DƯ NỢ", "nhom": "CUSTTPCD"},
+    {"chi_so": "LECH", "nhom": None},
+    {"chi_so": "GIÁ TRỊ TS", "nhom": None},
+]
+
+
+def rank_col(chi_so: str, nhom: Optional[str] = None) -> str:
+    return f"Hạng {chi_so}" + (f" theo {nhom}" if nhom else "")
+
+
+def rank_top_n(
+    piv: pd.DataFrame, chi_so: str, nhom: Optional[str] = None, n: int = TOP_N, na_cuoi: bool = False
+) -> np.ndarray:
+    """Hạng (1 = lớn nhất) của từng dòng ``piv`` theo ``chi_so`` trong từng nhóm ``nhom``; 0 nếu ngoài top ``n``.
+
+    Một lần sắp xếp ổn định (nhóm, −chỉ số) cho mọi nhóm: bằng nhau thì dòng đứng trước xếp trên
+    như ``nlargest(keep="first")``; nhóm NaN không được xếp hạng. Chỉ số NaN không được xếp hạng,
+    trừ khi ``na_cuoi``: khi đó NaN đứng sau mọi giá trị (nhóm ít hơn ``n`` dòng có số liệu thì
+    ``nlargest`` lấy thêm các dòng NaN theo thứ tự xuất hiện).
+    """
+    v = pd.to_numeric(piv[chi_so], errors="coerce").to_numpy(dtype=float)
+    if na_cuoi:
+        v = np.where(np.isnan(v), -np.inf, v)
+    g = pd.factorize(piv[nhom])[0] if nhom else np.zeros(len(piv), dtype=np.int64)
+    dong = np.flatnonzero(~np.isnan(v) & (g >= 0))
+    dong = dong[np.lexsort((-v[dong], g[dong]))]
+    g = g[dong]
+    dau_nhom = np.flatnonzero(np.r_[True, g[1:] != g[:-1]]) if len(g) else np.zeros(0, dtype=np.int64)
+    vi_tri = np.arange(len(g)) - np.repeat(dau_nhom, np.diff(np.r_[dau_nhom, len(g)]))
+    hang = np.zeros(len(piv), dtype=np.int64)
+    trong_top = vi_tri < n
+    hang[dong[trong_top]] = vi_tri[trong_top] + 1
+    return hang
+
+
+def ranking_columns(
+    piv: pd.DataFrame, n: int = TOP_N, rankings: Optional[List[Dict[str, object]]] = None
+) -> Dict[str, pd.arrays.IntegerArray]:
+    """Các cột hạng Top ``n`` theo ``rankings`` (mặc định ``RANKINGS``); bỏ mục thiếu cột. Ngoài top → ô trống."""
+    cols = {}
+    for r in RANKINGS if rankings is None else rankings:
+        chi_so, nhom = r["chi_so"], r.get("nhom")
+        if chi_so not in piv.columns or (nhom and nhom not in piv.columns):
+            continue
+        hang = rank_top_n(piv, chi_so, nhom, n)
+        cols[rank_col(chi_so, nhom)] = pd.array(np.where(hang > 0, hang, None), dtype="Int64")
+    return cols
+
+
+def mark_rankings(piv: pd.DataFrame, n: int = TOP_N) -> pd.DataFrame:
+    """Ghi lại các cột hạng trên toàn bảng (sửa tại chỗ) — như ``mark_top10`` sau khi ghép kết quả."""
+    for col, hang in ranking_columns(piv, n).items():
+        piv[col] = hang
+    return piv
+
+
+def kpi_summary(piv: pd.DataFrame) -> Dict[str, object]:
+    return {
+        "Số KH": int(piv.shape[0]),
+        "Tổng dư nợ": float(piv.get("DƯ NỢ", pd.Series(dtype=float)).sum()) if "DƯ NỢ" in piv.columns else 0.0,
+        "Lệch dương (count)": int((piv.get("LECH", 0) > 0).sum()) if "LECH" in piv.columns else 0,
+        "Nợ xấu (count)": int((piv.get("Nợ xấu", "") == "x").sum()) if "Nợ xấu" in piv.columns else 0,
+    }
+
+
+# Cột Mục 55 (Tất toán) → tên chung với Mục 56 (Giải ngân) trong bảng gộp tiêu chí 3
+TC3_COT_55 = {
+    "CUSTSEQLN": "CIF", "NMLOC": "TEN_KHACH_HANG", "KHE_UOC": "KHE_UOC", "SOTIENGIAINGAN": "SO_TIEN_GIAI_NGAN_VND",
+    "NGAYGN": "NGAY_GIAI_NGAN", "NGAYDH": "NGAY_DAO_HAN", "NGAY_TT": "NGAY_TT", "LOAITIEN": "LOAI_TIEN_HD",
+}
+TC3_COT_56 = ["CIF", "TEN_KHACH_HANG", "KHE_UOC", "SO_TIEN_GIAI_NGAN_VND", "NGAY_GIAI_NGAN", "NGAY_DAO_HAN", "LOAI_TIEN_HD"]
+
+
+def tc3_col(so_ngay: int = TC3_SO_NGAY) -> str:
+    """Tên cột cờ tiêu chí 3 theo cửa sổ ``so_ngay``."""
+    return "KH có cả GNG và TT trong 1 ngày" if so_ngay == 0 else f"KH có GNG và TT cách nhau ≤ {so_ngay} ngày"
+
+
+def _bang_tc3(
+    df_muc55: Optional[pd.DataFrame], df_muc56: Optional[pd.DataFrame]
+) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """(Tất toán, Giải ngân) đã chuẩn tên cột, có GIAI_NGAN_TT và NGAY; bảng rỗng/thiếu cột → None.
+
+    NGAY cắt về đầu ngày để bảng đếm và bộ ghép cặp cùng so theo ngày. Giữ nguyên số dòng và thứ tự của bảng gốc (dòng i ↔ mã CIF ``cif_codes[...][i]``).
+    """
+    df_tt = df_gn = None
+    if df_muc55 is not None and not df_muc55.empty and all(c in df_muc55.columns for c in TC3_COT_55):
+        df_tt = df_muc55[list(TC3_COT_55)]
+        df_tt.columns = list(TC3_COT_55.values())
+        df_tt["GIAI_NGAN_TT"] = "Tất toán"
+        df_tt["NGAY"] = pd.to_datetime(df_tt["NGAY_TT"], errors="coerce").dt.normalize()
+    if df_muc56 is not None and not df_muc56.empty and all(c in df_muc56.columns for c in TC3_COT_56):
+        df_gn = df_muc56[TC3_COT_56].copy()
+        df_gn["GIAI_NGAN_TT"] = "Giải ngân"
+        df_gn["NGAY_GIAI_NGAN"] = pd.to_datetime(df_gn["NGAY_GIAI_NGAN"], errors="coerce")
+        df_gn["NGAY_DAO_HAN"] = pd.to_datetime(df_gn["NGAY_DAO_HAN"], errors="coerce")
+        df_gn["NGAY"] = df_gn["NGAY_GIAI_NGAN"].dt.normalize()
+    return df_tt, df_gn
+
+
+def _gop_tc3(df_tt: Optional[pd.DataFrame], df_gn: Optional[pd.DataFrame]) -> pd.DataFrame:
+    bang = [df for df in (df_tt, df_gn) if df is not None]
+    if not bang:
+        return pd.DataFrame(columns=["CIF", "GIAI_NGAN_TT", "NGAY"])  # rỗng an toàn
+    df_gop = pd.concat(bang, ignore_index=True)
+    co_ngay = df_gop["NGAY"].notna()
+    return df_gop if co_ngay.all() else df_gop[co_ngay]
+
+
+def gop_tieu_chi_3(df_muc55: Optional[pd.DataFrame], df_muc56: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """Bảng gộp tiêu chí 3: mọi dòng Tất toán rồi Giải ngân có NGAY; nhãn dòng = vị trí trong bảng ghép."""
+    return _gop_tc3(*_bang_tc3(df_muc55, df_muc56))
+
+
+def _su_kien(df: Optional[pd.DataFrame], ma: Optional[np.ndarray]):
+    """Sự kiện (GN hoặc TT) hợp lệ của bảng ``_bang_tc3``: (dòng, mã CIF, NGAY datetime64[ns]) hoặc None."""
+    if df is None or ma is None:
+        return None
+    ngay = df["NGAY"].to_numpy(dtype="datetime64[ns]")
+    dong = np.flatnonzero((ma >= 0) & ~np.isnat(ngay))
+    return dong, ma[dong], ngay[dong]
+
+
+def _dem_tc3(df_tt, df_gn, tt, gn, cif_vocab: pd.Index, kieu_ngay) -> pd.DataFrame:
+    """Số lần Giải ngân / Tất toán theo (CIF, NGAY) từ các sự kiện, như groupby().size().unstack().
+
+    Sắp một lần theo khoá (mã CIF, NGAY) trên cả hai phía; từ điển CIF đã sắp xếp nên thứ tự
+    dòng trùng thứ tự groupby. CIF NaN không được đếm (groupby bỏ khoá NaN).
+    """
+    ben = {"Giải ngân": (df_gn, gn), "Tất toán": (df_tt, tt)}  # thứ tự cột như unstack
+    ma, ngay, cot = [], [], []
+    for k, (df, ev) in enumerate(ben.values()):
+        if ev is None:
+            continue
+        co_cif = df["CIF"].notna().to_numpy()[ev[0]]
+        ma.append(ev[1][co_cif])
+        ngay.append(ev[2][co_cif])
+        cot.append(np.full(co_cif.sum(), k))
+    if not ma or not sum(map(len, ma)):
+        return pd.DataFrame()
+    ma, cot = np.concatenate(ma), np.concatenate(cot)
+    # Khoá đơn (mã CIF, thứ hạng NGAY) → một lần argsort thay cho sắp hai khoá
+    ma_ngay, ngay = pd.factorize(np.concatenate(ngay), sort=True)
+    khoa = ma * len(ngay) + ma_ngay
+    thu_tu = np.argsort(khoa)
+    khoa, cot = khoa[thu_tu], cot[thu_tu]
+    dau = np.r_[True, khoa[1:] != khoa[:-1]]
+    nhom = np.cumsum(dau) - 1
+    dem = np.bincount(nhom * len(ben) + cot, minlength=(nhom[-1] + 1) * len(ben)).reshape(-1, len(ben))
+
+    khoa = khoa[dau]
+    df_count = pd.DataFrame({
+        "CIF": cif_vocab.to_numpy()[khoa // len(ngay)],
+        "NGAY": pd.Series(ngay[khoa % len(ngay)]).astype(kieu_ngay),
+    })
+    for k, ten in enumerate(ben):
+        if (cot == k).any():
+            df_count[ten] = dem[:, k]
+    df_count.columns.name = "GIAI_NGAN_TT"
+    df_count["CO_CA_GN_VA_TT"] = ((df_count.get("Giải ngân", 0) > 0) & (df_count.get("Tất toán", 0) > 0)).astype(int)
+    return df_count
+
+
+def _cap_tc3(df_tt, df_gn, tt, gn, cif_vocab: pd.Index, so_ngay: int) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Mọi cặp Giải ngân – Tất toán của cùng CIF lệch nhau ≤ ``so_ngay`` ngày: (mã CIF theo cặp, bảng cặp).
+
+    Sắp các lần tất toán một lần theo khoá (mã CIF, ngày) rồi tìm nhị phân khoảng
+    [ngày GN − so_ngay, ngày GN + so_ngay] cho mọi lần giải ngân cùng lúc — không nhóm theo
+    (CIF, ngày) trên toàn bộ lịch sử. So theo ngày (bỏ giờ). Bảng sắp theo CIF, ngày GN, ngày TT.
+    """
+    cot = ["CIF", "KHE_UOC_GN", "SO_TIEN_GN", "NGAY_GIAI_NGAN", "KHE_UOC_TT", "SO_TIEN_TT", "NGAY_TT", "SO_NGAY_LECH"]
+    if gn is None or tt is None or not len(gn[0]) or not len(tt[0]):
+        return np.zeros(0, dtype=np.int64), pd.DataFrame(columns=cot)
+    (dong_gn, ma_gn, ngay_gn), (dong_tt, ma_tt, ngay_tt) = gn, tt
+    ngay_gn = ngay_gn.astype("datetime64[D]").astype(np.int64)
+    ngay_tt = ngay_tt.astype("datetime64[D]").astype(np.int64)
+
+    # Khoá = mã × span + (ngày − gốc): khoảng ±so_ngay của một CIF không tràn sang CIF khác
+    lech = np.int64(so_ngay)
+    goc = min(ngay_gn.min(), ngay_tt.min()) - lech
+    span = max(ngay_gn.max(), ngay_tt.max()) - goc + lech + 1
+    khoa_tt = ma_tt * span + (ngay_tt - goc)
+    thu_tu = np.argsort(khoa_tt, kind="stable")
+    khoa_tt = khoa_tt[thu_tu]
+    khoa_gn = ma_gn * span + (ngay_gn - goc)
+    dau = np.searchsorted(khoa_tt, khoa_gn - lech, side="left")
+    so_cap = np.searchsorted(khoa_tt, khoa_gn + lech, side="right") - dau
+
+    # Trải các khoảng thành cặp (i GN, j TT)
+    i = np.repeat(np.arange(len(khoa_gn)), so_cap)
+    j = thu_tu[np.repeat(dau, so_cap) + np.arange(len(i)) - np.repeat(np.cumsum(so_cap) - so_cap, so_cap)]
+    sap = np.lexsort((ngay_tt[j], ngay_gn[i], ma_gn[i]))
+    i, j = i[sap], j[sap]
+    g, t = df_gn.iloc[dong_gn[i]], df_tt.iloc[dong_tt[j]]
+    return ma_gn[i], pd.DataFrame({
+        "CIF": cif_vocab.to_numpy()[ma_gn[i]],
+        "KHE_UOC_GN": g["KHE_UOC"].to_numpy(),
+        "SO_TIEN_GN": g["SO_TIEN_GIAI_NGAN_VND"].to_numpy(),
+        "NGAY_GIAI_NGAN": ngay_gn[i].astype("datetime64[D]").astype("datetime64[ns]"),
+        "KHE_UOC_TT": t["KHE_UOC"].to_numpy(),
+        "SO_TIEN_TT": t["SO_TIEN_GIAI_NGAN_VND"].to_numpy(),
+        "NGAY_TT": ngay_tt[j].astype("datetime64[D]").astype("datetime64[ns]"),
+        "SO_NGAY_LECH": ngay_tt[j] - ngay_gn[i],
+    }, columns=cot)
+
+
+def tieu_chi_3(
+    df_muc55: Optional[pd.DataFrame],
+    df_muc56: Optional[pd.DataFrame],
+    ma_55: Optional[np.ndarray],
+    ma_56: Optional[np.ndarray],
+    cif_vocab: pd.Index,
+    so_ngay: int = TC3_SO_NGAY,
+) -> Tuple[Optional[np.ndarray], Dict[str, pd.DataFrame]]:
+    """Tiêu chí 3: Tất toán (Mục 55) & Giải ngân (Mục 56) của cùng CIF lệch nhau ≤ ``so_ngay`` ngày.
+
+    ``ma_55``/``ma_56``: mã CIF theo dòng (trong ``cif_vocab``). Lấy sự kiện (CIF, ngày) một lần;
+    bảng đếm và các cặp đều tính từ đó. Trả về (mã CIF có cặp — None nếu không có sự kiện nào
+    để xét, {"df_gop_tieu_chi_3", "df_count_tieu_chi_3" (CO_CA_GN_VA_TT = 1 khi cùng ngày có
+    cả hai), "df_cap_tieu_chi_3" (một dòng mỗi cặp)}).
+    """
+    df_tt, df_gn = _bang_tc3(df_muc55, df_muc56)
+    tt, gn = _su_kien(df_tt, ma_55), _su_kien(df_gn, ma_56)
+
+    df_gop = _gop_tc3(df_tt, df_gn)
+    ma_cap, df_cap = _cap_tc3(df_tt, df_gn, tt, gn, cif_vocab, so_ngay)
+    bang = {
+        "df_gop_tieu_chi_3": df_gop,
+        "df_count_tieu_chi_3": _dem_tc3(df_tt, df_gn, tt, gn, cif_vocab, df_gop["NGAY"].dtype),
+        "df_cap_tieu_chi_3": df_cap,
+    }
+    co_su_kien = any(ev is not None and len(ev[0]) for ev in (tt, gn))
+    return (ma_cap if co_su_kien else None), bang
+
+
+TC4_COT = ["CIF_ID", "NGAY_DEN_HAN_TT", "NGAY_THANH_TOAN"]
+
+
+def tieu_chi_4(
+    df_muc57: pd.DataFrame,
+    ma_57: np.ndarray,
+    cif_vocab: pd.Index,
+    piv: pd.DataFrame,
+    dong_piv: np.ndarray,
+    ngay_danh_gia,
+    nam_cham_tra: Tuple[int, int] = NAM_CHAM_TRA,
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Tiêu chí 4: các kỳ chậm trả (Mục 57) đến hạn trong ``nam_cham_tra`` của KH nợ nhóm 1.
+
+    ``ma_57``: mã CIF theo dòng Mục 57 (trong ``cif_vocab``); ``dong_piv[mã]``: dòng của CIF trong ``piv`` (-1 nếu không có).
+    Trả về (df_delay để xuất, mức chậm trả cao nhất theo từng dòng ``piv``: 0 không có, 1 "<4",
+    2 "4-9", 3 ">=10" ngày). Mức của KH là max trên mọi kỳ, nên không cần khử trùng (CIF, ngày).
+    """
+    den_han = pd.to_datetime(df_muc57["NGAY_DEN_HAN_TT"], errors="coerce")
+    trong_nam = den_han.dt.year.between(*nam_cham_tra).to_numpy()
+    d = df_muc57[trong_nam].copy()
+    d["NGAY_DEN_HAN_TT"] = den_han[trong_nam]
+    d["NGAY_THANH_TOAN"] = pd.to_datetime(d["NGAY_THANH_TOAN"], errors="coerce")
+    d["NGAY_THANH_TOAN_FILL"] = d["NGAY_THANH_TOAN"].fillna(pd.to_datetime(ngay_danh_gia))
+    d["SO_NGAY_CHAM_TRA"] = (d["NGAY_THANH_TOAN_FILL"] - d["NGAY_DEN_HAN_TT"]).dt.days
+
+    # Ghép DƯ NỢ/NHOM_NO theo mã CIF (chuỗi CIF đã chuẩn để xuất)
+    ma_57 = ma_57[trong_nam]
+    d["CIF_ID"] = cif_vocab.to_numpy()[ma_57]
+    dong = dong_piv[ma_57]
+    d = d.reset_index(drop=True)
+    for c in ["DƯ NỢ", "NHOM_NO"]:
+        if c in piv.columns:
+            d[c] = pd.Series(piv[c].to_numpy()[dong], index=d.index).where(dong >= 0)
+    giu = (d["NHOM_NO"] == 1).to_numpy() if "NHOM_NO" in d.columns else np.ones(len(d), dtype=bool)
+
+    so_ngay = d["SO_NGAY_CHAM_TRA"].to_numpy(dtype=float)
+    muc = np.where(np.isnan(so_ngay), 0, np.digitize(np.nan_to_num(so_ngay), CAP_CHAM_TRA_MOC))
+    giu &= muc > 0
+    d, muc, dong = d[giu], muc[giu], dong[giu]
+    d["CAP_CHAM_TRA"] = CAP_CHAM_TRA[muc]
+    d["NGAY"] = d["NGAY_DEN_HAN_TT"].dt.date
+
+    # Mức cao nhất theo dòng piv; bảng xuất sắp theo mức giảm dần (ổn định như trước)
+    muc_piv = np.zeros(len(piv), dtype=np.int8)
+    co_piv = dong >= 0
+    np.maximum.at(muc_piv, dong[co_piv], muc[co_piv].astype(np.int8))
+    df_delay = d.iloc[np.argsort(-muc, kind="stable")]
+    return df_delay, muc_piv
+
+
+MUC17_COL = "KH có TSBĐ khác địa bàn"
+R34_COL = "KH có TSBĐ quá hạn định giá"
+
+
+def muc17_khac_dia_ban(df_crm4: pd.DataFrame, df_muc17: pd.DataFrame, dia_ban_kt: List[str]) -> Optional[np.ndarray]:
+    """Mặt nạ dòng CRM4 có TSBĐ bất động sản (Mục 17) nằm ngoài ``dia_ban_kt``; None nếu thiếu cột."""
+    if not all(c in df_muc17.columns for c in ["C01", "C02", "C19"]) or "SECU_SRL_NUM" not in df_crm4.columns:
+        return None
+    ds_secu = df_crm4["SECU_SRL_NUM"].dropna().unique()
+    df_17 = df_muc17[df_muc17["C01"].isin(ds_secu)]
+    df_bds = df_17[df_17["C02"].astype(str).str.strip() == "Bat dong san"]
+
+    # Tỉnh/thành chuẩn (bỏ dấu, viết tắt "TP.HCM"...) của địa chỉ TSBĐ và của địa bàn kiểm toán
+    tinh = resolve_provinces(df_bds["C19"])
+    khac_dia_ban = (tinh.ne("") & ~tinh.isin(resolve_dia_ban(dia_ban_kt))).to_numpy()
+    ma_ts_canh_bao = df_bds["C01"][khac_dia_ban].unique()
+    return df_crm4["SECU_SRL_NUM"].isin(ma_ts_canh_bao).to_numpy()
+
+
+def recheck_muc17(
+    result: Dict[str, object],
+    df_muc17: Optional[pd.DataFrame],
+    dia_ban_kt: List[str],
+    prof: Optional[StageProfiler] = None,
+) -> Dict[str, object]:
+    """Kết quả mới khi chỉ đổi ``dia_ban_kt``: tính lại riêng cờ Mục 17, giữ nguyên mọi bảng khác.
+
+    Không sửa ``result`` (có thể đang nằm trong bộ nhớ đệm); chỉ chép ``pivot_full``.
+    """
+    prof = prof or StageProfiler(enabled=False)
+    piv = result["pivot_full"]
+    if MUC17_COL not in piv.columns or df_muc17 is None:
+        return dict(result)
+    with prof.stage("cờ: Mục 17 khác địa bàn (chỉ đổi địa bàn)", len(piv)) as out:
+        df_crm4 = result["df_crm4"]
+        dong_canh_bao = muc17_khac_dia_ban(df_crm4, df_muc17, dia_ban_kt)
+        piv = piv.copy()
+        piv[MUC17_COL] = mark_isin(piv["CIF_KH_VAY"], df_crm4["CIF_KH_VAY"][dong_canh_bao].unique())
+        out(piv)
+    return {**result, "pivot_full": piv, "profile": prof.records}
+
+
+# ============================ TIÊU CHÍ ============================ #
+# Mỗi tiêu chí: hàm nhận ``ctx`` (bảng nền đã ghép + đầu vào, chỉ đọc) và trả về
+# ({tên cột: mảng theo dòng piv}, {bảng phụ để xuất}). Thứ tự trong CRITERIA = thứ tự cột.
+CRITERIA_WORKERS = int(os.environ.get("CRM_CRITERIA_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+def _flag_codes(ctx: Dict[str, object], col: str, tinh: Callable[[], Optional[np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Cột cờ ``col`` từ mã CIF thoả tiêu chí: lấy từ ``flag_codes`` của engine nếu có, không thì ``tinh()``.
+
+    Không có mã (thiếu dữ liệu để xét) → không thêm cột.
+    """
+    codes = ctx["flag_codes"].get(col) if ctx["flag_codes"] is not None else tinh()
+    if codes is None:
+        return {}
+    return {col: mark_codes(ctx["ma_piv"], codes, ctx["n_cif"], mark="X" if col == R34_COL else "x")}
+
+
+def _tc_no_nhom(ctx):
+    piv = ctx["piv"]
+    if "NHOM_NO" not in piv.columns:
+        return {}, {}
+    nhom_no = piv["NHOM_NO"].astype(str).str.strip()
+    return {"Nợ nhóm 2": mark_isin(nhom_no, ["2"]), "Nợ xấu": mark_isin(nhom_no, ["3", "4", "5"])}, {}
+
+
+def _tc_cap_c(ctx):
+    return _flag_codes(ctx, "Chuyên gia PD cấp C duyệt", lambda: ctx["cif_vocab"].get_indexer(ctx["list_cif_cap_c"])), {}
+
+
+def _tc_co_cau(ctx):
+    return _flag_codes(ctx, "NỢ CƠ_CẤU", lambda: ctx["cif_vocab"].get_indexer(ctx["cif_co_cau"])), {}
+
+
+def _tc_bao_lanh_lc(ctx):
+    return {"DƯ_NỢ_BẢO_LÃNH": ctx["by_cif"]("Bao lanh").to_numpy(), "DƯ_NỢ_LC": ctx["by_cif"]("LC").to_numpy()}, {}
+
+
+def _tc_giai_ngan_tm(ctx):
+    def tinh():
+        giai_ngan_tm, df_crm32 = ctx["giai_ngan_tm"], ctx["df_crm32"]
+        if giai_ngan_tm is None or giai_ngan_tm.empty or "FORACID" not in giai_ngan_tm.columns:
+            return None
+        foracid = safe_str(giai_ngan_tm["FORACID"])  # chuẩn mã (không sửa bảng đầu vào)
+        if "KHE_UOC" in df_crm32.columns:
+            co_tm = safe_str(df_crm32["KHE_UOC"]).isin(foracid).to_numpy()
+        else:
+            co_tm = np.zeros(len(df_crm32), dtype=bool)
+        return ctx["cif_codes"].get("crm32", np.zeros(0, dtype=np.int64))[co_tm]
+
+    return _flag_codes(ctx, "GIẢI_NGÂN_TIEN_MAT", tinh), {}
+
+
+def _tc_tctd_khac(ctx):
+    def tinh():
+        df_crm4 = ctx["df_crm4"]
+        cc_flag = df_crm4.get("CAP_2", pd.Series("", index=df_crm4.index)).astype(str).str.contains(
+            "TCTD", case=False, na=False
+        ).to_numpy()
+        return ctx["ma_crm4"][cc_flag]
+
+    return _flag_codes(ctx, "Cầm cố tại TCTD khác", tinh), {}
+
+
+def _tc_top10(ctx):
+    return top10_flags(ctx["piv"]), {}
+
+
+def _tc_xep_hang(ctx):
+    return ranking_columns(ctx["piv"], ctx["top_n"]), {}
+
+
+def _tc_r34(ctx):
+    def tinh():
+        if "VALUATION_DATE" not in ctx["df_crm4"].columns:
+            return None
+        return ctx["ma_crm4"][r34_qua_han(ctx["df_crm4"], ctx["ngay_danh_gia"])]
+
+    return _flag_codes(ctx, R34_COL, tinh), {}
+
+
+def _tc_muc17(ctx):
+    df_muc17 = ctx["muc17"]
+    if df_muc17 is None or df_muc17.empty:
+        return {}, {}
+    dong_canh_bao = muc17_khac_dia_ban(ctx["df_crm4"], df_muc17, ctx["dia_ban_kt"])
+    if dong_canh_bao is None:
+        st.info("Mục 17: thiếu các cột bắt buộc (C01, C02, C19) hoặc CRM4 thiếu SECU_SRL_NUM — bỏ qua kiểm tra địa bàn.")
+        return {}, {}
+    return {MUC17_COL: mark_codes(ctx["ma_piv"], ctx["ma_crm4"][dong_canh_bao], ctx["n_cif"])}, {}
+
+
+def _tc_3(ctx):
+    # Giải ngân và Tất toán (Mục 55/56) lệch nhau ≤ tc3_so_ngay ngày — cờ theo các cặp tìm được
+    ma_cap, bang = tieu_chi_3(
+        ctx["muc55"], ctx["muc56"], ctx["cif_codes"].get("muc55"), ctx["cif_codes"].get("muc56"),
+        ctx["cif_vocab"], ctx["tc3_so_ngay"],
+    )
+    if ma_cap is None:  # không có lần GN/TT nào để xét → không thêm cột
+        return {}, bang
+    return {tc3_col(ctx["tc3_so_ngay"]): mark_codes(ctx["ma_piv"], ma_cap, ctx["n_cif"])}, bang
+
+
+def _tc_4(ctx):
+    # Chậm trả (Mục 57)
+    df_muc57, piv, ma_piv = ctx["muc57"], ctx["piv"], ctx["ma_piv"]
+    if df_muc57 is None or df_muc57.empty or not all(c in df_muc57.columns for c in TC4_COT):
+        return {}, {"df_delay_tieu_chi_4": pd.DataFrame()}
+    df_delay, muc = tieu_chi_4(
+        df_muc57, ctx["cif_codes"]["muc57"], ctx["cif_vocab"], piv, dong_theo_ma(ma_piv, ctx["n_cif"]),
+        ctx["ngay_danh_gia"], ctx["nam_cham_tra"],
+    )
+    return {
+        "KH Phát sinh chậm trả > 10 ngày": np.where(muc == 3, "x", ""),
+        "KH Phát sinh chậm trả 4-9 ngày": np.where(muc == 2, "x", ""),
+    }, {"df_delay_tieu_chi_4": df_delay}
+
+
+# khoá → {"ten": nhãn hiển thị, "dau_vao": bảng/cột đọc, "sau": tiêu chí phải xong trước, "fn": hàm}
+CRITERIA: Dict[str, Dict[str, object]] = {
+    "no_nhom": {"ten": "Nợ nhóm 2 / nợ xấu", "dau_vao": ["NHOM_NO"], "sau": [], "fn": _tc_no_nhom},
+    "cap_c": {"ten": "Chuyên gia PD cấp C duyệt", "dau_vao": ["crm32"], "sau": [], "fn": _tc_cap_c},
+    "co_cau": {"ten": "Nợ cơ cấu", "dau_vao": ["crm32"], "sau": [], "fn": _tc_co_cau},
+    "bao_lanh_lc": {"ten": "Dư nợ bảo lãnh & LC", "dau_vao": ["crm4"], "sau": [], "fn": _tc_bao_lanh_lc},
+    "giai_ngan_tm": {"ten": "Giải ngân tiền mặt 1 tỷ", "dau_vao": ["crm32", "giai_ngan_tm"], "sau": [], "fn": _tc_giai_ngan_tm},
+    "tctd_khac": {"ten": "Cầm cố tại TCTD khác", "dau_vao": ["crm4"], "sau": [], "fn": _tc_tctd_khac},
+    "top10": {"ten": "Top 10 dư nợ KHCN/KHDN", "dau_vao": ["DƯ NỢ", "CUSTTPCD"], "sau": [], "fn": _tc_top10},
+    "xep_hang": {"ten": "Xếp hạng Top N (dư nợ, lệch, giá trị TS)", "dau_vao": ["DƯ NỢ", "LECH", "GIÁ TRỊ TS", "CUSTTPCD"],
+                 "sau": [], "fn": _tc_xep_hang},
+    "r34": {"ten": "TSBĐ quá hạn định giá (R34)", "dau_vao": ["crm4"], "sau": [], "fn": _tc_r34},
+    "muc17": {"ten": "TSBĐ khác địa bàn (Mục 17)", "dau_vao": ["crm4", "muc17"], "sau": [], "fn": _tc_muc17},
+    "tieu_chi_3": {"ten": "Tiêu chí 3: GN & TT cùng ngày / trong cửa sổ (Mục 55/56)", "dau_vao": ["muc55", "muc56"], "sau": [], "fn": _tc_3},
+    "tieu_chi_4": {"ten": "Tiêu chí 4: chậm trả (Mục 57)", "dau_vao": ["muc57", "DƯ NỢ", "NHOM_NO"], "sau": [], "fn": _tc_4},
+}
+
+
+def run_criteria(
+    ctx: Dict[str, object], criteria: Optional[List[str]] = None, prof: Optional[StageProfiler] = None
+) -> Tuple[Dict[str, np.ndarray], Dict[str, object]]:
+    """Chạy các tiêu chí ``criteria`` (None = tất cả) trên luồng song song, theo đợt phụ thuộc ``sau``.
+
+    Kết quả của các tiêu chí đã xong nằm trong ``ctx["ket_qua"]`` cho tiêu chí chạy sau. Trả về
+    (các cột cờ theo thứ tự CRITERIA, bảng phụ); ``prof`` ghi thời gian riêng của từng tiêu chí.
+    """
+    prof = prof or StageProfiler(enabled=False)
+    names = [k for k in CRITERIA if criteria is None or k in criteria]
+    unknown = set(criteria or []) - set(CRITERIA)
+    if unknown:
+        raise ValueError(f"Tiêu chí không có: {sorted(unknown)} (chọn trong {list(CRITERIA)})")
+    st_ctx = get_script_run_ctx()  # để st.info/st.warning trong luồng con vẫn hiện trên trang
+
+    def chay(name: str):
+        add_script_run_ctx(threading.current_thread(), st_ctx)
+        t0 = time.perf_counter()
+        out = CRITERIA[name]["fn"](ctx)
+        return out, time.perf_counter() - t0
+
+    done: Dict[str, Tuple[Dict[str, np.ndarray], Dict[str, object]]] = {}
+    ctx = {**ctx, "ket_qua": done}
+    workers = max(1, min(CRITERIA_WORKERS, len(names)))
+    with ThreadPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as ex:
+        while len(done) < len(names):
+            dot = [n for n in names if n not in done and all(d in done or d not in names for d in CRITERIA[n]["sau"])]
+            if not dot:
+                raise ValueError(f"Tiêu chí phụ thuộc vòng tròn: {sorted(set(names) - set(done))}")
+            results = ex.map(chay, dot) if ex is not None else map(chay, dot)
+            for name, (out, seconds) in zip(dot, list(results)):
+                done[name] = out
+                prof.add(f"tiêu chí: {CRITERIA[name]['ten']}", seconds, rows_out=len(ctx["piv"]))
+
+    cols: Dict[str, np.ndarray] = {}
+    extras: Dict[str, object] = {}
+    for name in names:
+        cols.update(done[name][0])
+        extras.update(done[name][1])
+    return cols, extras
+
+
+def add_flags_and_joins(
+    pivot_final: pd.DataFrame,
+    pivot_crm32_by_mucdich: pd.DataFrame,
+    df_crm4_filtered: pd.DataFrame,
+    df_crm32_filtered: pd.DataFrame,
+    list_cif_cap_c: np.ndarray,
+    cif_co_cau: np.ndarray,
+    giai_ngan_tm: Optional[pd.DataFrame],
+    ngay_danh_gia: pd.Timestamp,
+    df_muc17: Optional[pd.DataFrame],
+    dia_ban_kt: List[str],
+    df_muc55: Optional[pd.DataFrame],
+    df_muc56: Optional[pd.DataFrame],
+    df_muc57: Optional[pd.DataFrame],
+    crm4_agg: Optional[Dict[str, pd.DataFrame]] = None,
+    prof: Optional[StageProfiler] = None,
+    cif_vocab: Optional[pd.Index] = None,
+    cif_codes: Optional[Dict[str, np.ndarray]] = None,
+    nam_cham_tra: Tuple[int, int] = NAM_CHAM_TRA,
+    flag_codes: Optional[Dict[str, np.ndarray]] = None,
+    criteria: Optional[List[str]] = None,
+    tc3_so_ngay: int = TC3_SO_NGAY,
+    top_n: int = TOP_N,
+) -> Tuple[pd.DataFrame, dict]:
+    """Bổ sung các cờ & ghép các bảng phụ, trả về pivot_full và dict[kpi].
+
+    ``prof`` ghi thời gian từng bước ghép và từng tiêu chí.
+    ``cif_vocab``/``cif_codes`` (từ ``prepare_frames``): mã CIF int64 của từng bảng; thiếu thì
+    tự mã hoá — mọi phép so khớp CIF bên dưới chạy trên mảng mã, không so chuỗi.
+    ``flag_codes``: {cột cờ: mã CIF} của các tiêu chí theo dòng do engine khác tính sẵn
+    (``crm_duckdb.cif_flag_codes``); None → mỗi tiêu chí tự tính bằng pandas.
+    ``criteria``: khoá trong ``CRITERIA`` cần chạy; None → tất cả.
+    ``tc3_so_ngay``: cửa sổ ghép cặp Giải ngân – Tất toán của tiêu chí 3 (0 = cùng ngày).
+    ``top_n``: số hạng giữ lại ở các cột xếp hạng (``RANKINGS``).
+    """
+    if pivot_final.empty:
+        return pivot_final, {}
+
+    prof = prof or StageProfiler(enabled=False)
+    prof.start()
+    piv = pivot_final.copy()
+
+    if cif_vocab is None or cif_codes is None:
+        bang = {"crm4": df_crm4_filtered, "crm32": df_crm32_filtered, "muc55": df_muc55, "muc56": df_muc56, "muc57": df_muc57}
+        cif_vocab, cif_codes = encode_cifs({
+            kind: df[CIF_COLUMNS[kind]]
+            for kind, df in bang.items()
+            if df is not None and CIF_COLUMNS[kind] in df.columns
+        })
+    n_cif = len(cif_vocab)
+    ma_piv = cif_vocab.get_indexer(piv["CIF_KH_VAY"])
+    ma_crm4 = cif_codes.get("crm4", np.zeros(0, dtype=np.int64))
+
+    # Ghép CRM32 theo mục đích vay (theo mã CIF; trùng tên cột thì để merge thêm hậu tố như cũ)
+    if not pivot_crm32_by_mucdich.empty:
+        p32 = pivot_crm32_by_mucdich.rename(columns={"CUSTSEQLN": "CIF_KH_VAY"})
+        cols32 = p32.columns.drop("CIF_KH_VAY")
+        if cols32.intersection(piv.columns).empty:
+            them = p32[cols32].set_axis(cif_vocab.get_indexer(p32["CIF_KH_VAY"])).reindex(ma_piv)
+            piv = pd.concat([piv, them.set_axis(piv.index)], axis=1).fillna(0)
+        else:
+            piv = piv.merge(p32, on="CIF_KH_VAY", how="left").fillna(0)
+
+    prof.lap("cờ: ghép CRM32 theo mục đích", piv)
+
+    # Lệch dư nợ & bổ sung (blank) từ CRM4 (không gồm Cho vay/Bảo lãnh/LC)
+    if "DƯ NỢ" in piv.columns and "DƯ NỢ CRM32" in piv.columns:
+        piv["LECH"] = piv["DƯ NỢ"] - piv["DƯ NỢ CRM32"]
+    else:
+        piv["LECH"] = 0
+
+    # Dư nợ theo nhóm LOAI (một lượt tổng hợp, dùng chung với build_pivots) → gán theo CIF
+    if crm4_agg is None:
+        crm4_agg = aggregate_crm4(df_crm4_filtered)
+    by_loai = crm4_agg["loai"]
+    vi_tri_loai = pd.Index(cif_vocab.get_indexer(by_loai["CIF_KH_VAY"])).get_indexer(ma_piv)
+
+    def _by_cif(nhom: str) -> pd.Series:
+        if nhom not in by_loai.columns:
+            return pd.Series(0.0, index=piv.index)
+        v = by_loai[nhom].to_numpy()
+        return pd.Series(np.where(vi_tri_loai >= 0, v[vi_tri_loai], 0.0), index=piv.index)
+
+    if "(blank)" in by_loai.columns:
+        du_no_bosung = _by_cif("(blank)")
+        # CRM32 có thể đã có cột mục đích "(blank)" → cộng dồn thay vì ghi đè
+        piv["(blank)"] = piv["(blank)"] + du_no_bosung if "(blank)" in piv.columns else du_no_bosung
+        if "DƯ NỢ CRM32" in piv.columns:
+            piv["DƯ NỢ CRM32"] = piv["DƯ NỢ CRM32"] + du_no_bosung
+        piv["LECH"] = piv.get("DƯ NỢ", 0) - piv.get("DƯ NỢ CRM32", 0)
+
+    prof.lap("cờ: lệch dư nợ & (blank)", piv)
+
+    # Các tiêu chí (CRITERIA) đọc chung bảng nền ở trên, chạy song song; ghép cột một lần
+    ctx = {
+        "piv": piv, "ma_piv": ma_piv, "n_cif": n_cif, "cif_vocab": cif_vocab, "cif_codes": cif_codes,
+        "ma_crm4": ma_crm4, "by_cif": _by_cif, "flag_codes": flag_codes,
+        "df_crm4": df_crm4_filtered, "df_crm32": df_crm32_filtered,
+        "list_cif_cap_c": list_cif_cap_c, "cif_co_cau": cif_co_cau,
+        "giai_ngan_tm": giai_ngan_tm, "muc17": df_muc17, "muc55": df_muc55, "muc56": df_muc56, "muc57": df_muc57,
+        "ngay_danh_gia": ngay_danh_gia, "dia_ban_kt": dia_ban_kt, "nam_cham_tra": nam_cham_tra,
+        "tc3_so_ngay": tc3_so_ngay, "top_n": top_n,
+    }
+    cols, extras = run_criteria(ctx, criteria, prof)
+    if cols:
+        piv = pd.concat([piv.drop(columns=piv.columns.intersection(list(cols))), pd.DataFrame(cols, index=piv.index)], axis=1)
+    for name in ["df_gop_tieu_chi_3", "df_count_tieu_chi_3", "df_cap_tieu_chi_3", "df_delay_tieu_chi_4"]:
+        extras.setdefault(name, pd.DataFrame())  # tiêu chí tắt / thiếu dữ liệu → bảng rỗng
+
+    # KPIs nhanh
+    return piv, {**kpi_summary(piv), **extras}
+
+
+# ============================ PIPELINE ============================ #
+# Các loại đầu vào (khoá trong SCHEMAS); CRM4/CRM32 có thể gồm nhiều file.
+MULTI_FILE_INPUTS = ["crm4", "crm32"]
+INPUT_KINDS = ["crm4", "crm32", "code_mdsd", "code_tsbd", "giai_ngan_tm", "muc17", "muc55", "muc56", "muc57"]
+BRANCH_COLS = {"crm4": "BRANCH_VAY", "crm32": "BRCD"}
+# Engine tính pivot & tiêu chí theo dòng: pandas (mặc định) hoặc DuckDB (tuỳ chọn, cần duckdb)
+ENGINES = ["pandas", "duckdb"]
+
+
+def load_inputs(
+    files: Dict[str, object],
+    project: bool = True,
+    prof: Optional[StageProfiler] = None,
+    stream: bool = False,
+    chi_nhanh: str = "",
+    branch_match: str = "contains",
+) -> Dict[str, pd.DataFrame]:
+    """Đọc mọi đầu vào một lần: ``files[kind]`` là file (hoặc list file với CRM4/CRM32).
+
+    ``stream=True``: CRM4/CRM32 đọc theo khối và chỉ giữ dòng của ``chi_nhanh`` (``load_streaming``).
+    Không chọn chi nhánh thì mọi khối đều được giữ, nên đọc bình thường (cache Parquet toàn bảng).
+    """
+    prof = prof or StageProfiler(enabled=False)
+    if stream and not chi_nhanh.strip():
+        st.warning("Đọc theo khối cần chọn chi nhánh — chưa chọn nên đọc toàn bộ CRM4/CRM32 như bình thường.")
+        stream = False
+    inputs = {}
+    for kind in INPUT_KINDS:
+        f = files.get(kind)
+        with prof.stage(f"đọc: {kind}") as out:
+            if kind in MULTI_FILE_INPUTS and stream:
+                inputs[kind] = load_streaming(f or [], kind, project, chi_nhanh, branch_match)
+            elif kind in MULTI_FILE_INPUTS:
+                inputs[kind] = load_and_concat(f or [], kind, project)
+            else:
+                # Bảng mã không xuất ra Excel → luôn chỉ đọc cột cần dùng
+                inputs[kind] = read_excel_any(f, kind, project or kind.startswith("code_"))
+            out(inputs[kind])
+    return inputs
+
+
+def inputs_fingerprint(
+    files: Dict[str, object], project: bool = True, branch: Optional[Tuple[str, str]] = None
+) -> str:
+    """Dấu vân tay bộ đầu vào: hash nội dung các file + chế độ chiếu cột.
+
+    ``branch`` = (chi nhánh, cách so khớp) khi đọc theo khối (bảng đọc vào đã lọc chi nhánh).
+    """
+    h = hashlib.sha256(f"project={project};branch={branch!r};".encode())
+    for kind in INPUT_KINDS:
+        f = files.get(kind)
+        for one in (f if isinstance(f, list) else [f]):
+            if one is not None:
+                h.update(f"{kind}:{content_hash(file_bytes(one))};".encode())
+    return h.hexdigest()
+
+
+def load_streaming(
+    files: List, kind: str, project: bool = True, chi_nhanh: str = "", branch_match: str = "contains"
+) -> pd.DataFrame:
+    """Đọc CRM4/CRM32 theo khối (``iter_chunks``), lọc chi nhánh ngay trên từng khối rồi ghép.
+
+    Chỉ các dòng của chi nhánh (đã chiếu cột, ép kiểu) nằm trong bộ nhớ. Kết quả đã lọc được
+    cache Parquet theo nội dung file + chi nhánh, lần sau không phải đọc lại file lớn.
+    ``chi_nhanh`` rỗng thì mọi khối đều giữ lại (bộ nhớ gấp đôi lúc ghép) — ``load_inputs`` khi đó
+    đọc bình thường thay vì gọi hàm này.
+    """
+    loc = hashlib.sha256(f"{branch_match}|{chi_nhanh}".encode()).hexdigest()[:12]
+    dfs = []
+    for f in files or []:
+        if f is None:
+            continue
+        data, name = file_bytes(f), getattr(f, "name", "").lower()
+        key = f"{cache_key(data, kind, project)}-b{loc}"
+        df = cache_get(key)
+        if df is None:
+            if name.endswith(".xls"):
+                st.info(f"**{name}**: định dạng .xls không đọc theo khối được — đọc cả file rồi mới lọc chi nhánh.")
+            chunks = []
+            try:
+                for c in iter_chunks(data, name, kind, project):
+                    c = select_branch({kind: c}, kind, chi_nhanh, branch_match)
+                    if not c.empty:
+                        chunks.append(c)
+            except Exception as e:
+                st.error(f"Không đọc được file **{name}**: {e}")
+                continue
+            df = _concat_frames(chunks, kind)
+            cache_put(key, df)
+        if not df.empty:
+            dfs.append(df)
+    return _concat_frames(dfs, kind)
+
+
+def run_fingerprint(inputs_fp: str, **params) -> str:
+    """Dấu vân tay một lần chạy: dấu vân tay đầu vào + tham số."""
+    h = hashlib.sha256(inputs_fp.encode())
+    for k in sorted(params):
+        h.update(f"{k}={params[k]!r};".encode())
+    return h.hexdigest()
+
+
+def normalize_cif(series: pd.Series) -> pd.Series:
+    """CIF dạng số → int → str, còn lại str đã strip (như script gốc)."""
+    try:
+        s = to_str_intlike(series)  # int-like → str
+        out = series.astype(str).str.strip()
+        out.loc[out.index.isin(s.index)] = s
+        return out
+    except Exception:
+        return series.astype(str).str.strip()
+
+
+# Cột mã CIF của từng loại đầu vào — mã hoá chung một từ điển
+CIF_COLUMNS = {"crm4": "CIF_KH_VAY", "crm32": "CUSTSEQLN", "muc55": "CUSTSEQLN", "muc56": "CIF", "muc57": "CIF_ID"}
+
+
+def encode_cifs(columns: Dict[str, Optional[pd.Series]]) -> Tuple[pd.Index, Dict[str, np.ndarray]]:
+    """Từ điển CIF dùng chung cho mọi bảng: trả về (từ điển, {loại: mã int64 theo dòng}).
+
+    Chỉ chuẩn hoá (``normalize_cif``) các giá trị khác nhau của từng cột. Từ điển được
+    sắp xếp nên thứ tự mã trùng thứ tự chuỗi CIF; ``vocab[codes]`` cho lại chuỗi đã chuẩn.
+    """
+    parts = {}
+    for kind, s in columns.items():
+        if s is None:
+            continue
+        codes, uniques = pd.factorize(s, use_na_sentinel=False)
+        parts[kind] = (codes, normalize_cif(pd.Series(uniques, dtype=object)).to_numpy(dtype=object))
+    vocab = pd.Index(np.unique(np.concatenate([u for _, u in parts.values()] + [np.array([], dtype=object)])), dtype=object)
+    return vocab, {kind: vocab.get_indexer(u)[codes].astype(np.int64) for kind, (codes, u) in parts.items()}
+
+
+# Chọn chi nhánh: nhiều giá trị phân cách dấu phẩy; so theo tên chi nhánh (đã upper)
+# hoặc mã SOL (dãy số đầu tên). "contains" giữ cách lọc cũ (chuỗi con).
+BRANCH_MATCH_MODES = ["contains", "exact", "prefix"]
+
+
+def sol_code(name: str) -> str:
+    """Mã SOL = dãy chữ số ở đầu tên chi nhánh ("001 - HANOI" → "001"), không có → ""."""
+    digits = len(name) - len(name.lstrip("0123456789"))
+    return name[:digits]
+
+
+def branch_partition(df: pd.DataFrame, col: str) -> Dict[str, np.ndarray]:
+    """Chỉ mục chi nhánh: tên chi nhánh (đã upper) → vị trí dòng (tăng dần).
+
+    Làm việc trên mã category (hoặc factorize) nên chỉ chuẩn hoá k tên khác nhau,
+    không đổi kiểu cả cột.
+    """
+    if df.empty or col not in df.columns:
+        return {}
+    s = df[col]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        codes, labels = s.cat.codes.to_numpy(), s.cat.categories
+    else:
+        codes, labels = pd.factorize(s)
+    # NaN → "NAN" như astype(str).str.upper(); tên trùng sau khi upper được gộp
+    labels = pd.Index(list(pd.Index(labels).astype(str)) + ["nan"]).str.upper()
+    codes = np.where(codes < 0, len(labels) - 1, codes)
+    name_codes, names = pd.factorize(labels)
+    row_codes = name_codes[codes]
+    order = np.argsort(row_codes, kind="stable")
+    bounds = np.searchsorted(row_codes[order], np.arange(len(names) + 1))
+    return {name: order[bounds[i]:bounds[i + 1]] for i, name in enumerate(names) if bounds[i + 1] > bounds[i]}
+
+
+def build_branch_index(inputs: Dict[str, pd.DataFrame]) -> Dict[str, Dict[str, np.ndarray]]:
+    """Chỉ mục chi nhánh cho CRM4/CRM32 — tính một lần khi đọc dữ liệu, dùng lại cho mọi lần lọc."""
+    return {kind: branch_partition(inputs[kind], col) for kind, col in BRANCH_COLS.items()}
+
+
+def match_branches(names, query: str, mode: str = "contains") -> List[str]:
+    """Các tên chi nhánh khớp ``query`` (nhiều giá trị phân cách dấu phẩy) theo ``mode``."""
+    terms = [t.strip().upper() for t in query.split(",") if t.strip()]
+
+    def _same_sol(a: str, b: str) -> bool:
+        return a.isdigit() and b.isdigit() and int(a) == int(b)
+
+    out = []
+    for name in names:
+        sol = sol_code(name)
+        if mode == "exact":
+            hit = any(name == t or _same_sol(sol, t) for t in terms)
+        elif mode == "prefix":
+            hit = any(name.startswith(t) or (sol and sol.startswith(t)) for t in terms)
+        else:
+            hit = any(t in name for t in terms)
+        if hit:
+            out.append(name)
+    return out
+
+
+def take_branch(
+    df: pd.DataFrame, partition: Dict[str, np.ndarray], query: str, mode: str = "contains"
+) -> pd.DataFrame:
+    """Lấy các dòng của chi nhánh khớp ``query`` từ chỉ mục — O(số dòng lấy ra), giữ thứ tự gốc."""
+    pos = [partition[name] for name in match_branches(partition, query, mode)]
+    if not pos:
+        return df.iloc[0:0]
+    return df.iloc[np.sort(np.concatenate(pos))]
+
+
+def select_branch(
+    inputs: Dict[str, pd.DataFrame],
+    kind: str,
+    query: str,
+    mode: str = "contains",
+    branch_index: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+) -> pd.DataFrame:
+    df = inputs[kind]
+    if not query or BRANCH_COLS[kind] not in df.columns:
+        return df
+    partition = (branch_index or {}).get(kind)
+    if partition is None:
+        partition = branch_partition(df, BRANCH_COLS[kind])
+    return take_branch(df, partition, query, mode)
+
+
+def run_pipeline(
+    inputs: Dict[str, pd.DataFrame],
+    ngay_danh_gia,
+    dia_ban_kt: List[str],
+    chi_nhanh: str = "",
+    branch_match: str = "contains",
+    branch_index: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+    prof: Optional[StageProfiler] = None,
+    nam_cham_tra: Tuple[int, int] = NAM_CHAM_TRA,
+    engine: str = "pandas",
+    criteria: Optional[List[str]] = None,
+    tc3_so_ngay: int = TC3_SO_NGAY,
+    top_n: int = TOP_N,
+) -> Dict[str, object]:
+    """Chạy toàn bộ phân tích trên các bảng đã đọc; trả về dict kết quả cho UI/xuất file.
+
+    ``branch_index`` (từ ``build_branch_index``) giúp lọc chi nhánh không phải quét lại cả bảng.
+    ``prof`` (tuỳ chọn) ghi thời gian/bộ nhớ từng bước vào ``result["profile"]``.
+    ``nam_cham_tra`` = (năm đầu, năm cuối) các kỳ đến hạn xét ở tiêu chí 4.
+    ``engine``: "pandas" hoặc "duckdb" (ENGINES) cho các bước tổng hợp theo CIF.
+    ``criteria``: khoá trong ``CRITERIA`` cần chạy (None = tất cả).
+    ``tc3_so_ngay``: số ngày lệch tối đa giữa Giải ngân và Tất toán ở tiêu chí 3 (0 = cùng ngày).
+    ``top_n``: số hạng giữ lại ở các cột xếp hạng Top N.
+    """
+    prof = prof or StageProfiler(enabled=False)
+    frames = prepare_frames(inputs, chi_nhanh, branch_match, branch_index, prof)
+    return analyse_frames(frames, inputs, ngay_danh_gia, dia_ban_kt, prof, nam_cham_tra, engine, criteria, tc3_so_ngay, top_n)
+
+
+def prepare_frames(
+    inputs: Dict[str, pd.DataFrame],
+    chi_nhanh: str = "",
+    branch_match: str = "contains",
+    branch_index: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+    prof: Optional[StageProfiler] = None,
+) -> Dict[str, object]:
+    """Các bước theo từng dòng: lọc chi nhánh, chuẩn CIF, ánh xạ mã, enrich CRM32.
+
+    Trả về {"df_crm4", "df_crm32_filtered", "list_cif_cap_c", "cif_co_cau", "cif_vocab", "cif_codes",
+    "ma_chua_anh_xa"} cho ``analyse_frames``; ``cif_codes[loại]`` là mã CIF theo dòng (crm4, crm32,
+    muc55/56/57); ``ma_chua_anh_xa``: báo cáo ``unmapped_codes``.
+    """
+    prof = prof or StageProfiler(enabled=False)
+    with prof.stage("lọc chi nhánh", len(inputs["crm4"]) + len(inputs["crm32"])) as out:
+        df_crm4 = select_branch(inputs, "crm4", chi_nhanh, branch_match, branch_index)
+        df_crm32 = select_branch(inputs, "crm32", chi_nhanh, branch_match, branch_index)
+        out(rows=len(df_crm4) + len(df_crm32))
+
+    # Ánh xạ loại TSBĐ & mục đích vay (tra bảng mã đã biên dịch theo dòng)
+    with prof.stage("ánh xạ loại TSBĐ (CRM4)", len(df_crm4)) as out:
+        df_crm4 = add_loai_ts(df_crm4, inputs["code_tsbd"])
+        out(df_crm4)
+    with prof.stage("ánh xạ mục đích vay (CRM32)", len(df_crm32)) as out:
+        df_crm32 = add_muc_dich_crm32(df_crm32, inputs["code_mdsd"])
+        out(df_crm32)
+    with prof.stage("báo cáo mã chưa ánh xạ") as out:
+        ma_chua_anh_xa = unmapped_codes(df_crm4, df_crm32, inputs["code_tsbd"], inputs["code_mdsd"])
+        out(ma_chua_anh_xa)
+
+    # Chuẩn CIF một lần cho mọi bảng: mã int64 chung để so khớp; cột CIF giữ chuỗi đã chuẩn (hiển thị/xuất)
+    with prof.stage("chuẩn hoá CIF", len(df_crm4) + len(df_crm32)) as out:
+        bang = {"crm4": df_crm4, "crm32": df_crm32, **{k: inputs.get(k) for k in ["muc55", "muc56", "muc57"]}}
+        cif_vocab, cif_codes = encode_cifs({
+            kind: df[CIF_COLUMNS[kind]]
+            for kind, df in bang.items()
+            if df is not None and CIF_COLUMNS[kind] in df.columns
+        })
+        vocab = cif_vocab.to_numpy()
+        if "crm4" in cif_codes:
+            df_crm4 = df_crm4.assign(CIF_KH_VAY=vocab[cif_codes["crm4"]])
+        if "crm32" in cif_codes:
+            df_crm32 = df_crm32.assign(CUSTSEQLN=vocab[cif_codes["crm32"]])
+        out(rows=len(cif_vocab))
+
+    # CRM32 – cấp C & cơ cấu
+    with prof.stage("CRM32 cấp C & cơ cấu", len(df_crm32)) as out:
+        df_crm32_filtered, list_cif_cap_c, cif_co_cau = enrich_crm32(df_crm32)
+        out(df_crm32_filtered)
+
+    return {
+        "df_crm4": df_crm4,
+        "df_crm32_filtered": df_crm32_filtered,
+        "list_cif_cap_c": list_cif_cap_c,
+        "cif_co_cau": cif_co_cau,
+        "cif_vocab": cif_vocab,
+        "cif_codes": cif_codes,
+        "ma_chua_anh_xa": ma_chua_anh_xa,
+    }
+
+
+def analyse_frames(
+    frames: Dict[str, object],
+    inputs: Dict[str, pd.DataFrame],
+    ngay_danh_gia,
+    dia_ban_kt: List[str],
+    prof: Optional[StageProfiler] = None,
+    nam_cham_tra: Tuple[int, int] = NAM_CHAM_TRA,
+    engine: str = "pandas",
+    criteria: Optional[List[str]] = None,
+    tc3_so_ngay: int = TC3_SO_NGAY,
+    top_n: int = TOP_N,
+) -> Dict[str, object]:
+    """Các bước theo CIF trên kết quả ``prepare_frames``: pivot CRM4/CRM32, cờ & KPI.
+
+    ``engine="duckdb"``: pivot và tiêu chí theo dòng chạy SQL trên DuckDB (``crm_duckdb``).
+    """
+    prof = prof or StageProfiler(enabled=False)
+    df_crm4, df_crm32_filtered = frames["df_crm4"], frames["df_crm32_filtered"]
+    if engine == "duckdb":
+        import crm_duckdb as sql  # engine tuỳ chọn: chỉ nạp (và cần duckdb) khi được chọn
+    elif engine != "pandas":
+        raise ValueError(f"engine không hợp lệ: {engine!r} (chọn một trong {ENGINES})")
+    else:
+        sql = None
+
+    # Pivots CRM4 (tổng hợp một lượt, dùng lại cho các cờ)
+    with prof.stage("pivot CRM4", len(df_crm4)) as out:
+        crm4_agg = (
+            (sql.aggregate_crm4 if sql else aggregate_crm4)(df_crm4, frames["cif_codes"].get("crm4"), frames["cif_vocab"])
+            if all(c in df_crm4.columns for c in CRM4_PIVOT_COLS) else None
+        )
+        pivot_ts, pivot_no, pivot_merge, pivot_final = build_pivots(df_crm4, crm4_agg)
+        out(pivot_final)
+
+    # Pivot theo mục đích CRM32
+    with prof.stage("pivot CRM32 theo mục đích", len(df_crm32_filtered)) as out:
+        p_mucdich = (sql.pivot_muc_dich if sql else pivot_muc_dich)(df_crm32_filtered)
+        out(p_mucdich)
+
+    flag_codes = None
+    if sql and not pivot_final.empty:
+        with prof.stage("tiêu chí theo dòng (DuckDB)", len(df_crm4) + len(df_crm32_filtered)) as out:
+            flag_codes = sql.cif_flag_codes(
+                df_crm4, df_crm32_filtered, inputs["giai_ngan_tm"], pd.to_datetime(ngay_danh_gia),
+                frames["list_cif_cap_c"], frames["cif_co_cau"], frames["cif_vocab"], frames["cif_codes"],
+            )
+            out(rows=sum(len(v) for v in flag_codes.values()))
+
+    pivot_full, kpi = add_flags_and_joins(
+        pivot_final,
+        p_mucdich,
+        df_crm4,
+        df_crm32_filtered,
+        frames["list_cif_cap_c"],
+        frames["cif_co_cau"],
+        inputs["giai_ngan_tm"],
+        pd.to_datetime(ngay_danh_gia),
+        inputs["muc17"],
+        dia_ban_kt,
+        inputs["muc55"],
+        inputs["muc56"],
+        inputs["muc57"],
+        crm4_agg,
+        prof,
+        frames["cif_vocab"],
+        frames["cif_codes"],
+        nam_cham_tra,
+        flag_codes,
+        criteria,
+        tc3_so_ngay,
+        top_n,
+    )
+    return {
+        "df_crm4": df_crm4,
+        "df_crm32_filtered": df_crm32_filtered,
+        "pivot_final": pivot_final,
+        "pivot_merge": pivot_merge,
+        "p_mucdich": p_mucdich,
+        "pivot_full": pivot_full,
+        "kpi": kpi,
+        "ma_chua_anh_xa": frames.get("ma_chua_anh_xa", pd.DataFrame()),
+        "profile": prof.records,
+    }
+
+
+# ============================ EXPLORER ============================ #
+# Xem bảng kết quả trên UI: lọc/sắp xếp/cắt trang ở server, chỉ gửi trang đang xem
+EXPLORER_PAGE_SIZES = [50, 100, 500, 1000]
+EXPLORER_KEY_COLS = ["CIF_KH_VAY", "CUSTSEQLN"]  # cột tìm theo CIF (cột đầu tiên có trong bảng)
+
+
+def flag_columns(df: pd.DataFrame) -> List[str]:
+    """Các cột cờ của bảng (chỉ gồm "x"/"X"/"") — dùng làm bộ lọc trong trình xem."""
+    if df.empty:
+        return []
+    return [
+        c for c in df.columns
+        if df[c].dtype == object and set(pd.unique(df[c].to_numpy())) <= {"x", "X", ""}
+    ]
+
+
+def explore_page(
+    df: pd.DataFrame,
+    flags: Iterable[str] = (),
+    tim_cif: str = "",
+    sap_xep: Optional[str] = None,
+    giam_dan: bool = True,
+    trang: int = 1,
+    so_dong: int = 100,
+) -> Tuple[pd.DataFrame, int]:
+    """Một trang của ``df`` sau khi lọc & sắp xếp; trả về (trang, số dòng khớp).
+
+    ``flags``: chỉ giữ dòng có đánh dấu ở mọi cột cờ đã chọn. ``tim_cif``: CIF chứa chuỗi này.
+    ``sap_xep``: cột sắp xếp (ổn định, ô trống xếp cuối); None → giữ thứ tự bảng. Chỉ mảng vị trí
+    được lọc/sắp xếp, bảng gốc không bị chép; ``trang`` ngoài khoảng được kẹp về trang cuối/đầu.
+    """
+    khop = np.ones(len(df), dtype=bool)
+    for c in flags:
+        khop &= df[c].to_numpy() != ""
+    cot_cif = next((c for c in EXPLORER_KEY_COLS if c in df.columns), None)
+    if tim_cif and cot_cif is not None:
+        khop &= df[cot_cif].astype(str).str.contains(tim_cif.strip(), case=False, regex=False).to_numpy()
+    vi_tri = np.flatnonzero(khop)
+    if sap_xep is not None and sap_xep in df.columns:
+        khoa = pd.Series(df[sap_xep].to_numpy()[vi_tri])
+        try:
+            thu_tu = khoa.sort_values(ascending=not giam_dan, kind="stable", na_position="last")
+        except TypeError:  # cột object lẫn số & chuỗi → so theo chuỗi
+            thu_tu = khoa.where(khoa.isna(), khoa.astype(str)).sort_values(
+                ascending=not giam_dan, kind="stable", na_position="last"
+            )
+        vi_tri = vi_tri[thu_tu.index.to_numpy()]
+    so_trang = max(1, -(-len(vi_tri) // so_dong))
+    dau = (min(max(trang, 1), so_trang) - 1) * so_dong
+    return df.iloc[vi_tri[dau:dau + so_dong]], len(vi_tri)
+
+
+# ============================ EXPORT ============================ #
+# Giới hạn của Excel: 1.048.576 dòng/sheet (gồm dòng tiêu đề) → bảng lớn hơn được
+# tách thành nhiều sheet "<tên>", "<tên>_2", ...
+EXCEL_MAX_ROWS = 1_048_576
+EXPORT_CHUNK_ROWS = 50_000
+
+
+EXPORT_SHEETS = [
+    "df_crm4_LOAI_TS", "KQ_CRM4", "Pivot_crm4", "df_crm32_LOAI_TS", "KQ_KH", "Pivot_crm32",
+    "tieu chi 4", "tieu chi 3_dot3", "tieu chi 3_dot3_1", "tieu chi 3_cap", "ma_chua_anh_xa",
+]
+
+
+def result_sheets(result: Dict[str, object]) -> List[Tuple[str, pd.DataFrame]]:
+    """Các sheet có thể xuất (tên theo EXPORT_SHEETS, cùng thứ tự), bỏ bảng rỗng."""
+    kpi = result["kpi"]
+    frames = [
+        result["df_crm4"],
+        result["pivot_final"],
+        result["pivot_merge"],
+        result["df_crm32_filtered"],
+        result["pivot_full"],
+        result["p_mucdich"],
+        # Các sheet tiêu chí
+        kpi.get("df_delay_tieu_chi_4"),
+        kpi.get("df_gop_tieu_chi_3"),
+        kpi.get("df_count_tieu_chi_3"),
+        kpi.get("df_cap_tieu_chi_3"),
+        result.get("ma_chua_anh_xa"),
+    ]
+    return [(name, df) for name, df in zip(EXPORT_SHEETS, frames) if isinstance(df, pd.DataFrame) and not df.empty]
+
+
+def _sheet_parts(name: str, df: pd.DataFrame, max_rows: Optional[int] = None):
+    """Tách df thành các phần vừa một sheet Excel: (tên sheet, phần df); mặc định ``EXCEL_MAX_ROWS`` dòng/sheet."""
+    per_sheet = (max_rows or EXCEL_MAX_ROWS) - 1  # trừ dòng tiêu đề
+    for i, start in enumerate(range(0, max(len(df), 1), per_sheet)):
+        suffix = "" if i == 0 else f"_{i + 1}"
+        yield name[: 31 - len(suffix)] + suffix, df.iloc[start:start + per_sheet]
+
+
+def write_excel(result: Dict[str, object], target, include: Optional[List[str]] = None) -> None:
+    """Ghi workbook kết quả vào ``target`` (đường dẫn hoặc BytesIO) bằng pandas.ExcelWriter.
+
+    ``include`` là danh sách tên sheet cần xuất (mặc định: tất cả).
+    """
+    with pd.ExcelWriter(target, engine="openpyxl") as writer:
+        for name, df in result_sheets(result):
+            if include is not None and name not in include:
+                continue
+            for sheet, part in _sheet_parts(name, df):
+                part.to_excel(writer, sheet_name=sheet, index=False)
+
+
+def write_excel_streaming(
+    result: Dict[str, object], path, include: Optional[List[str]] = None, chunk_rows: int = EXPORT_CHUNK_ROWS
+) -> None:
+    """Ghi workbook bằng openpyxl write-only: ghi từng khối dòng thẳng xuống file ``path``.
+
+    Bộ nhớ chỉ phụ thuộc ``chunk_rows`` chứ không phụ thuộc kích thước bảng.
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    for name, df in result_sheets(result):
+        if include is not None and name not in include:
+            continue
+        for sheet, part in _sheet_parts(name, df):
+            ws = wb.create_sheet(title=sheet)
+            ws.append([str(c) for c in part.columns])
+            for start in range(0, len(part), chunk_rows):
+                chunk = part.iloc[start:start + chunk_rows].astype(object)
+                chunk = chunk.where(chunk.notna(), None)
+                for row in chunk.itertuples(index=False, name=None):
+                    ws.append(row)
+    if not wb.worksheets:
+        wb.create_sheet(title="KQ_KH")  # workbook phải có ít nhất một sheet
+    wb.save(path)
+
+
+# Định dạng tải về: Excel, hoặc zip gồm mỗi sheet một file Parquet / CSV.gz
+# (nhanh hơn nhiều khi chỉ cần nạp lại vào pandas).
+EXPORT_FORMATS = {
+    "xlsx": ("KQ_phan_tich_CRM.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "parquet": ("KQ_phan_tich_CRM_parquet.zip", "application/zip"),
+    "csv.gz": ("KQ_phan_tich_CRM_csv.zip", "application/zip"),
+}
+
+
+def export_bytes(
+    result: Dict[str, object], fmt: str = "xlsx", include: Optional[List[str]] = None, streaming: bool = True
+) -> bytes:
+    """Tạo nội dung file tải về theo ``fmt`` (khoá của EXPORT_FORMATS)."""
+    if fmt == "xlsx":
+        if not streaming:
+            buffer = io.BytesIO()
+            write_excel(result, buffer, include=include)
+            return buffer.getvalue()
+        fd, tmp_path = tempfile.mkstemp(suffix=".xlsx")
+        os.close(fd)
+        try:
+            write_excel_streaming(result, tmp_path, include=include)
+            with open(tmp_path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(tmp_path)
+
+    buffer = io.BytesIO()
+    # Parquet/gzip đã nén sẵn → zip chỉ đóng gói (ZIP_STORED)
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, df in result_sheets(result):
+            if include is not None and name not in include:
+                continue
+            part = io.BytesIO()
+            if fmt == "parquet":
+                normalize_dtypes(df).to_parquet(part, index=False)
+            else:
+                df.to_csv(part, index=False, compression={"method": "gzip"}, encoding="utf-8")
+            zf.writestr(f"{name}.{fmt}", part.getvalue())
+    return buffer.getvalue()
@@ -0,0 +1,182 @@
+# -------------------------------------------------------------
+# Engine DuckDB (tuỳ chọn) cho các bước tổng hợp theo CIF
+# Đăng ký các bảng đã đọc làm bảng DuckDB trong tiến trình (không chép dữ liệu) và tính
+# pivot CRM4, pivot CRM32 theo mục đích và các tiêu chí xét theo dòng bằng SQL chạy
+# đa luồng. Kết quả trả về đúng dạng của bản pandas trong crm_core để phần ghép cờ,
+# xuất file... dùng chung. Cần: pip install duckdb
+# -------------------------------------------------------------
+
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from crm_core import (
+    LOAI_NGOAI_VAY,
+    MA_CAP_C,
+    MA_CO_CAU,
+    NHOM_LOAI,
+    R34_QUY_TAC,
+    _wide_frame,
+    ensure_cols,
+    safe_str,
+)
+
+try:  # engine tuỳ chọn
+    import duckdb
+except ImportError:  # pragma: no cover
+    duckdb = None
+
+THREADS = int(os.environ.get("CRM_DUCKDB_THREADS", "0"))  # 0 = mọi lõi
+
+
+def available() -> bool:
+    return duckdb is not None
+
+
+def _connect(**tables: pd.DataFrame):
+    """Kết nối DuckDB trong bộ nhớ, đăng ký ``tables`` (tên → DataFrame) làm bảng."""
+    if duckdb is None:
+        raise RuntimeError("Chưa cài duckdb (pip install duckdb) — chọn engine pandas.")
+    con = duckdb.connect()
+    if THREADS > 0:
+        con.execute(f"SET threads = {THREADS}")
+    for name, df in tables.items():
+        con.register(name, df)
+    return con
+
+
+def _sql_list(values) -> str:
+    return ", ".join("'" + str(v).replace("'", "''") + "'" for v in values)
+
+
+def _wide(long: pd.DataFrame, row: str, col: str, value: str):
+    """Bảng dài (row, col, value) từ SQL → (khoá dòng đã sắp xếp, nhãn cột đã sắp xếp, ma trận)."""
+    row_codes, rows = pd.factorize(long[row].to_numpy(), sort=True)
+    col_codes, labels = pd.factorize(long[col].to_numpy(dtype=object), sort=True)
+    matrix = np.zeros((len(rows), len(labels)))
+    matrix[row_codes, col_codes] = long[value].to_numpy(dtype=float)
+    return rows, labels, matrix
+
+
+# ============================ PIVOTS ============================ #
+def aggregate_crm4(
+    df_crm4: pd.DataFrame, cif_codes: Optional[np.ndarray] = None, cif_vocab: Optional[pd.Index] = None
+) -> Dict[str, pd.DataFrame]:
+    """Như ``crm_core.aggregate_crm4`` (cùng bảng "no"/"ts"/"loai"), GROUP BY trên DuckDB."""
+    if cif_codes is None or cif_vocab is None:
+        cif_codes, cif_vocab = pd.factorize(df_crm4["CIF_KH_VAY"], sort=True)
+    crm4 = pd.DataFrame({
+        "ma": np.asarray(cif_codes, dtype=np.int64),
+        "loai": df_crm4["LOAI"].to_numpy(dtype=object),
+        "loai_ts": df_crm4["LOAI_TS"].astype(object).to_numpy(),
+        "no": pd.to_numeric(df_crm4["DU_NO_PHAN_BO_QUY_DOI"], errors="coerce").fillna(0).to_numpy(dtype=float),
+        "ts": pd.to_numeric(df_crm4["TS_KW_VND"], errors="coerce").fillna(0).to_numpy(dtype=float),
+    })
+    with _connect(crm4=crm4) as con:
+        # Dòng vay có LOAI_TS (pivot_table bỏ các dòng thiếu khoá); LOAI trống vẫn là dòng vay
+        vay = con.execute(f"""
+            SELECT ma, loai_ts, SUM(no) AS no, SUM(ts) AS ts
+            FROM crm4
+            WHERE ma >= 0 AND loai_ts IS NOT NULL AND (loai IS NULL OR loai NOT IN ({_sql_list(LOAI_NGOAI_VAY)}))
+            GROUP BY ALL
+        """).df()
+        theo_loai = con.execute(f"""
+            SELECT ma, CASE WHEN loai IN ({_sql_list(NHOM_LOAI)}) THEN loai ELSE '(blank)' END AS nhom, SUM(no) AS no
+            FROM crm4
+            WHERE ma >= 0
+            GROUP BY ALL
+        """).df()
+
+    ma_vay, ts_labels, wide_no = _wide(vay, "ma", "loai_ts", "no")
+    _, _, wide_ts = _wide(vay, "ma", "loai_ts", "ts")
+    ma_all, nhom_labels, wide_loai = _wide(theo_loai, "ma", "nhom", "no")
+    return {
+        "no": _wide_frame(cif_vocab[ma_vay], np.ones(len(ma_vay), dtype=bool), wide_no, ts_labels),
+        "ts": _wide_frame(cif_vocab[ma_vay], np.ones(len(ma_vay), dtype=bool), wide_ts, ts_labels),
+        "loai": _wide_frame(cif_vocab[ma_all], np.ones(len(ma_all), dtype=bool), wide_loai, nhom_labels),
+    }
+
+
+def pivot_muc_dich(df_crm32: pd.DataFrame) -> pd.DataFrame:
+    """Như ``crm_core.pivot_muc_dich``: dư nợ CRM32 theo CIF × mục đích vay, GROUP BY trên DuckDB."""
+    if df_crm32.empty:
+        return pd.DataFrame()
+    if not ensure_cols(df_crm32, ["CUSTSEQLN", "MUC DICH", "DU_NO_QUY_DOI"]):
+        return pd.DataFrame()
+    crm32 = pd.DataFrame({
+        "cif": df_crm32["CUSTSEQLN"].astype(object).to_numpy(),
+        "muc_dich": df_crm32["MUC DICH"].astype(object).to_numpy(),
+        "du_no": pd.to_numeric(df_crm32["DU_NO_QUY_DOI"], errors="coerce").to_numpy(dtype=float),
+    })
+    with _connect(crm32=crm32) as con:
+        long = con.execute("""
+            SELECT cif, muc_dich, COALESCE(SUM(du_no), 0) AS du_no
+            FROM crm32
+            WHERE cif IS NOT NULL AND muc_dich IS NOT NULL
+            GROUP BY ALL
+        """).df()
+    cifs, labels, matrix = _wide(long, "cif", "muc_dich", "du_no")
+    p = pd.DataFrame(matrix, columns=pd.Index(list(labels), name="MUC DICH"))
+    p.insert(0, "CUSTSEQLN", cifs)
+    p["DƯ NỢ CRM32"] = p.drop(columns=["CUSTSEQLN"]).sum(axis=1)
+    return p
+
+
+# ============================ TIÊU CHÍ THEO DÒNG ============================ #
+def cif_flag_codes(
+    df_crm4: pd.DataFrame,
+    df_crm32: pd.DataFrame,
+    giai_ngan_tm: Optional[pd.DataFrame],
+    ngay_danh_gia: pd.Timestamp,
+    list_cif_cap_c: np.ndarray,
+    cif_co_cau: np.ndarray,
+    cif_vocab: pd.Index,
+    cif_codes: Dict[str, np.ndarray],
+) -> Dict[str, np.ndarray]:
+    """{cột cờ: mã CIF} của các tiêu chí theo dòng trong ``crm_core.CRITERIA`` — mỗi tiêu chí một SELECT DISTINCT.
+
+    Chuẩn mã (``safe_str``, ép ngày) làm bằng pandas để giữ đúng ngữ nghĩa bản gốc;
+    ``list_cif_cap_c``/``cif_co_cau`` không dùng — xét lại trực tiếp trên CRM32.
+    """
+    n4, n32 = len(df_crm4), len(df_crm32)
+    crm4 = pd.DataFrame({
+        "ma": cif_codes.get("crm4", np.full(n4, -1, dtype=np.int64)),
+        "cap_2": df_crm4.get("CAP_2", pd.Series("", index=df_crm4.index)).astype(str).to_numpy(dtype=object),
+        "loai_ts": df_crm4.get("LOAI_TS", pd.Series("", index=df_crm4.index)).astype(object).to_numpy(),
+        "ngay_dinh_gia": pd.to_datetime(
+            df_crm4.get("VALUATION_DATE", pd.Series(pd.NaT, index=df_crm4.index)), errors="coerce"
+        ).to_numpy(),
+    })
+    crm32 = pd.DataFrame({
+        "ma": cif_codes.get("crm32", np.full(n32, -1, dtype=np.int64)),
+        "ma_phe_duyet": df_crm32.get("MA_PHE_DUYET", pd.Series("", index=df_crm32.index)).astype(object).to_numpy(),
+        "scheme_code": df_crm32.get("SCHEME_CODE", pd.Series(None, index=df_crm32.index, dtype=object)).astype(object).to_numpy(),
+        "khe_uoc": safe_str(df_crm32["KHE_UOC"]).to_numpy(dtype=object) if "KHE_UOC" in df_crm32.columns
+        else np.full(n32, None, dtype=object),
+    })
+    co_tm = giai_ngan_tm is not None and not giai_ngan_tm.empty and "FORACID" in giai_ngan_tm.columns
+    tm = pd.DataFrame({"foracid": safe_str(giai_ngan_tm["FORACID"]).to_numpy(dtype=object) if co_tm else np.array([], dtype=object)})
+    # Bảng quy tắc R34 → hạn theo loại TS: floor(số ngày) > N  ⇔  ngày định giá ≤ ngày đánh giá − (N + 1) ngày
+    r34 = pd.DataFrame({
+        "loai_ts": list(R34_QUY_TAC),
+        "han": [pd.Timestamp(ngay_danh_gia) - pd.Timedelta(days=n + 1) for n in R34_QUY_TAC.values()],
+    })
+
+    queries = {
+        "Chuyên gia PD cấp C duyệt": f"SELECT DISTINCT ma FROM crm32 WHERE ma_phe_duyet IN ({_sql_list(MA_CAP_C)})",
+        "NỢ CƠ_CẤU": f"SELECT DISTINCT ma FROM crm32 WHERE scheme_code IN ({_sql_list(MA_CO_CAU)})",
+        "Cầm cố tại TCTD khác": "SELECT DISTINCT ma FROM crm4 WHERE cap_2 ILIKE '%tctd%'",
+    }
+    if co_tm:
+        queries["GIẢI_NGÂN_TIEN_MAT"] = "SELECT DISTINCT ma FROM crm32 WHERE khe_uoc IN (SELECT foracid FROM tm)"
+    if "VALUATION_DATE" in df_crm4.columns:
+        queries["KH có TSBĐ quá hạn định giá"] = (
+            "SELECT DISTINCT ma FROM crm4 JOIN r34 USING (loai_ts) WHERE ngay_dinh_gia <= r34.han"
+        )
+    out = {}
+    with _connect(crm4=crm4, crm32=crm32, tm=tm, r34=r34) as con:
+        for name, sql in queries.items():
+            out[name] = con.execute(sql).fetchnumpy()["ma"].astype(np.int64)
+    return out
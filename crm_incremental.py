@@ -0,0 +1,460 @@
+# -------------------------------------------------------------
+# Chạy tăng dần theo kỳ (tháng này so với kỳ trước) cho pipeline CRM4 / CRM32
+# Lưu kết quả theo CIF của lần chạy trước và hash các dòng của từng CIF trên
+# mỗi bảng đầu vào; lần sau chỉ tính lại pivot & cờ cho CIF thay đổi/mới/bị xoá
+# rồi ghép vào kết quả cũ. Các bước theo dòng (lọc, chuẩn CIF, ánh xạ mã) và
+# các phần xếp hạng toàn bảng (Top 10, STT, KPI) luôn tính lại.
+# -------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from crm_core import (
+    CIF_COLUMNS,
+    CRITERIA,
+    LOAI_NGOAI_VAY,
+    NAM_CHAM_TRA,
+    NHOM_LOAI,
+    TC3_SO_NGAY,
+    TC4_COT,
+    TOP_N,
+    analyse_frames,
+    dong_theo_ma,
+    gop_tieu_chi_3,
+    kpi_summary,
+    mark_rankings,
+    mark_top10,
+    prepare_frames,
+    r34_qua_han,
+    safe_str,
+    tieu_chi_3,
+    tieu_chi_4,
+)
+from crm_io import CACHE_DIR, normalize_dtypes
+from crm_profile import StageProfiler
+
+STATE_DIR = Path(os.environ.get("CRM_STATE_DIR", CACHE_DIR / "incremental"))
+STATE_VERSION = "4"  # tăng khi đổi cách tính để bỏ trạng thái cũ
+# Quá nhiều CIF thay đổi → chạy lại toàn bộ (ghép không còn rẻ hơn)
+MAX_DIRTY_RATIO = float(os.environ.get("CRM_INCREMENTAL_MAX_DIRTY", "0.6"))
+
+# Bảng có khoá CIF: hash theo CIF (CRM4/CRM32 lấy sau prepare_frames → gồm cả cột đã ánh xạ mã)
+CIF_KEYS = CIF_COLUMNS
+# Bảng phụ không theo CIF: (khoá bảng phụ, bảng đã chuẩn bị, cột nối, cột CIF)
+SIDE_KEYS = {
+    "muc17": ("C01", "df_crm4", "SECU_SRL_NUM", "CIF_KH_VAY"),
+    "giai_ngan_tm": ("FORACID", "df_crm32_filtered", "KHE_UOC", "CUSTSEQLN"),
+}
+# Bảng kết quả theo CIF: cột khoá dùng để ghép
+RESULT_KEYS = {
+    "pivot_final": "CIF_KH_VAY",
+    "pivot_merge": "CIF_KH_VAY",
+    "p_mucdich": "CUSTSEQLN",
+    "pivot_full": "CIF_KH_VAY",
+    "df_count_tieu_chi_3": "CIF",
+    "df_cap_tieu_chi_3": "CIF",
+}
+# Bảng gộp tiêu chí 3 và bảng kỳ chậm trả tiêu chí 4 là phép chiếu dòng đầu vào: nhãn dòng và thứ tự
+# theo vị trí dòng trong Mục 55/56/57 hiện tại → lập lại trên toàn bảng, không ghép (``_row_tables``)
+KPI_FRAMES = ["df_gop_tieu_chi_3", "df_count_tieu_chi_3", "df_cap_tieu_chi_3", "df_delay_tieu_chi_4"]
+
+
+# ============================ HASH ============================ #
+def key_hashes(df: pd.DataFrame, key: str, cif: Optional[Tuple[pd.Index, np.ndarray]] = None) -> pd.Series:
+    """Hash (uint64) toàn bộ các dòng của mỗi giá trị khoá, có tính thứ tự dòng.
+
+    Khoá so theo ``safe_str`` như khi ghép cờ (NaN → "nan"); ``cif`` = (từ điển, mã theo dòng)
+    từ ``prepare_frames`` thì nhóm thẳng trên mã CIF, không factorize lại cột khoá.
+    """
+    if df is None or df.empty or key not in df.columns:
+        return pd.Series(dtype="uint64")
+    h = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    if cif is not None:
+        uniq, codes = np.unique(cif[1], return_inverse=True)
+        keys = cif[0][uniq]
+    else:
+        # Chuẩn chuỗi trên các giá trị khác nhau rồi ánh xạ lại (nhanh hơn safe_str cả cột)
+        codes, uniques = pd.factorize(df[key], use_na_sentinel=False)
+        code_map, keys = pd.factorize(safe_str(pd.Series(uniques, dtype=object)))
+        codes = code_map[codes]
+    # Gom theo khoá: sắp xếp ổn định, trọng số theo vị trí dòng trong nhóm, cộng modulo 2**64
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    pos = (np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        weighted = h[order] * (2 * pos + 1)
+    out = np.zeros(len(keys), dtype=np.uint64)
+    out[sorted_codes[starts]] = np.add.reduceat(weighted, starts)
+    return pd.Series(out, index=pd.Index(keys, name="KEY"))
+
+
+def cif_hash_table(frames: Dict[str, object], inputs: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Bảng hash: index CIF, mỗi cột một bảng đầu vào (0 = CIF không có dòng nào)."""
+    sources = {"crm4": frames["df_crm4"], "crm32": frames["df_crm32_filtered"]}
+    sources.update({k: inputs.get(k) for k in ["muc55", "muc56", "muc57"]})
+    vocab, codes = frames["cif_vocab"], frames["cif_codes"]
+    cols = {
+        kind: key_hashes(sources[kind], key, (vocab, codes[kind]) if kind in codes else None)
+        for kind, key in CIF_KEYS.items()
+    }
+    return pd.DataFrame(cols).fillna(0).astype("uint64")
+
+
+def changed_keys(old: pd.Series, new: pd.Series) -> pd.Index:
+    """Khoá mới, bị xoá hoặc có hash khác."""
+    idx = old.index.union(new.index)
+    return idx[old.reindex(idx, fill_value=0).to_numpy() != new.reindex(idx, fill_value=0).to_numpy()]
+
+
+# ============================ STATE ============================ #
+def state_key(chi_nhanh: str, branch_match: str) -> str:
+    """Mỗi cách chọn chi nhánh có trạng thái riêng."""
+    return hashlib.sha256(f"{branch_match}|{chi_nhanh}".encode()).hexdigest()[:16]
+
+
+def _columns(df: Optional[pd.DataFrame]) -> List[str]:
+    return [] if df is None or df.empty else [str(c) for c in df.columns]
+
+
+def column_labels(frames: Dict[str, object], inputs: Dict[str, pd.DataFrame]) -> Dict[str, object]:
+    """Những gì quyết định tập cột của kết quả: cột đầu vào và các nhãn thành cột pivot.
+
+    Khác kỳ trước → chạy lại toàn bộ (kết quả cũ có bộ cột khác).
+    """
+    df4, df32 = frames["df_crm4"], frames["df_crm32_filtered"]
+    labels: Dict[str, object] = {"columns": {k: _columns(v) for k, v in {**inputs, **frames}.items() if isinstance(v, pd.DataFrame)}}
+    if {"LOAI", "LOAI_TS"} <= set(df4.columns):
+        vay = ~df4["LOAI"].isin(LOAI_NGOAI_VAY) & df4["LOAI_TS"].notna()
+        labels["loai_ts"] = sorted(map(str, df4.loc[vay, "LOAI_TS"].unique()))
+        labels["loai_blank"] = bool((~df4["LOAI"].isin(NHOM_LOAI)).any())
+    if "MUC DICH" in df32.columns:
+        labels["muc_dich"] = sorted(map(str, df32["MUC DICH"].unique()))
+    for kind, col in [("muc55", "NGAY_TT"), ("muc56", "NGAY_GIAI_NGAN")]:
+        df = inputs.get(kind)
+        labels[f"{kind}_co_ngay"] = bool(df is not None and col in df.columns and pd.to_datetime(df[col], errors="coerce").notna().any())
+    return labels
+
+
+def load_state(path: Path) -> Optional[Dict[str, object]]:
+    manifest = path / "manifest.json"
+    if not manifest.exists():
+        return None
+    try:
+        meta = json.loads(manifest.read_text(encoding="utf-8"))
+        if meta.get("version") != STATE_VERSION:
+            return None
+        frames = {name: pd.read_parquet(path / f"{name}.parquet") if (path / f"{name}.parquet").exists() else pd.DataFrame()
+                  for name in [*RESULT_KEYS, "hashes", *SIDE_KEYS]}
+    except Exception:
+        return None  # trạng thái hỏng → coi như chưa có
+    frames["hashes"] = frames["hashes"].set_index("KEY") if not frames["hashes"].empty else frames["hashes"]
+    for kind in SIDE_KEYS:
+        df = frames[kind]
+        frames[kind] = df.set_index("KEY")["HASH"] if not df.empty else pd.Series(dtype="uint64")
+    return {"meta": meta, **frames}
+
+
+def save_manifest(path: Path, meta: Dict[str, object]) -> None:
+    """Chỉ cập nhật manifest (kết quả không đổi, ví dụ chạy lại cùng dữ liệu với ngày khác)."""
+    tmp = path / "manifest.json.tmp"
+    try:
+        tmp.write_text(json.dumps(meta, ensure_ascii=False, default=str), encoding="utf-8")
+        tmp.replace(path / "manifest.json")
+    except OSError:
+        pass
+
+
+def save_state(path: Path, meta: Dict[str, object], result: Dict[str, object],
+               hashes: pd.DataFrame, side: Dict[str, pd.Series]) -> None:
+    """Ghi vào thư mục tạm rồi đổi tên: lỗi giữa chừng không làm hỏng trạng thái cũ."""
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    frames = {name: result[name] if name in result else result["kpi"].get(name) for name in RESULT_KEYS}
+    frames["hashes"] = hashes.rename_axis("KEY").reset_index()
+    frames.update({kind: s.rename("HASH").rename_axis("KEY").reset_index() for kind, s in side.items()})
+    try:
+        for name, df in frames.items():
+            if isinstance(df, pd.DataFrame) and not df.empty:
+                try:
+                    # Giữ index mặc định: RangeIndex chỉ ghi metadata, và giữ được tên trục cột ("MUC DICH")
+                    df.to_parquet(tmp / f"{name}.parquet")
+                except Exception:  # cột object lẫn kiểu
+                    normalize_dtypes(df).to_parquet(tmp / f"{name}.parquet")
+        (tmp / "manifest.json").write_text(json.dumps(meta, ensure_ascii=False, default=str), encoding="utf-8")
+        shutil.rmtree(path, ignore_errors=True)
+        tmp.replace(path)
+    except Exception:
+        # Trạng thái chỉ để tăng tốc kỳ sau — lỗi ghi không được làm hỏng lần chạy
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# ============================ DIRTY CIF ============================ #
+def date_sensitive_cifs(
+    frames: Dict[str, object], df_muc57: Optional[pd.DataFrame], ngay_cu, ngay_moi,
+    nam_cham_tra: Tuple[int, int] = NAM_CHAM_TRA,
+) -> pd.Index:
+    """CIF có kết quả phụ thuộc ngày đánh giá và có thể khác giữa hai ngày:
+    TSBĐ đổi trạng thái quá hạn định giá (R34), kỳ Mục 57 chưa trả đã đến hạn ở một trong hai ngày."""
+    cifs = []
+    df4 = frames["df_crm4"]
+    if "VALUATION_DATE" in df4.columns:
+        qua_han = r34_qua_han(df4, [ngay_cu, ngay_moi])  # hai ngày trong một lượt
+        doi = qua_han[:, 0] != qua_han[:, 1]
+        cifs.append(df4.loc[doi, "CIF_KH_VAY"])
+    if df_muc57 is not None and {"CIF_ID", "NGAY_DEN_HAN_TT", "NGAY_THANH_TOAN"} <= set(df_muc57.columns):
+        den_han = pd.to_datetime(df_muc57["NGAY_DEN_HAN_TT"], errors="coerce")
+        chua_tra = pd.to_datetime(df_muc57["NGAY_THANH_TOAN"], errors="coerce").isna()
+        m = chua_tra & den_han.dt.year.between(*nam_cham_tra) & (den_han < max(ngay_cu, ngay_moi))
+        cifs.append(df_muc57.loc[m, "CIF_ID"])
+    return pd.Index(safe_str(pd.concat(cifs)).unique()) if cifs else pd.Index([])
+
+
+def side_dirty_cifs(frames: Dict[str, object], old: pd.Series, new: pd.Series, kind: str) -> pd.Index:
+    """CIF nối tới các dòng bảng phụ (Mục 17, Giải ngân TM) đã đổi."""
+    _, frame, col, cif_col = SIDE_KEYS[kind]
+    df = frames[frame]
+    doi = changed_keys(old, new)
+    if doi.empty or col not in df.columns:
+        return pd.Index([])
+    return pd.Index(df.loc[safe_str(df[col]).isin(doi), cif_col].unique())
+
+
+# ============================ MERGE ============================ #
+def _fill_value(s: pd.Series):
+    return 0 if pd.api.types.is_numeric_dtype(s) else ""
+
+
+def splice(old: pd.DataFrame, new: pd.DataFrame, key: str, dirty: pd.Index) -> pd.DataFrame:
+    """Bỏ dòng của CIF cần tính lại khỏi kết quả cũ, thêm dòng mới; cột theo kết quả cũ.
+
+    Cột nhóm pivot/cờ mà nhóm CIF tính lại không có → 0 (số) hoặc "" (cờ), như khi chạy toàn bộ.
+    """
+    if old.empty:
+        return new.reset_index(drop=True)
+    keep = old[~safe_str(old[key]).isin(dirty)]
+    if new.empty:
+        return keep.reset_index(drop=True)
+    new = new.copy()
+    for c in old.columns.difference(new.columns):
+        if c == "DƯ NỢ CRM32":
+            # Không có CRM32 → DƯ NỢ CRM32 chỉ gồm phần (blank) bổ sung từ CRM4
+            new[c] = new["(blank)"] if "(blank)" in new.columns else 0
+        else:
+            new[c] = _fill_value(old[c])
+    return pd.concat([keep, new[old.columns]], ignore_index=True)
+
+
+def _sort_like_full(result: Dict[str, object], df_crm4: pd.DataFrame) -> None:
+    """Sắp xếp lại như khi chạy toàn bộ: pivot_final/pivot_full theo thứ tự CIF xuất hiện
+    trong CRM4, pivot_merge/p_mucdich/tiêu chí theo khoá, rồi đánh lại STT."""
+    thu_tu = pd.Series(np.arange(df_crm4["CIF_KH_VAY"].nunique(dropna=False)), index=pd.unique(df_crm4["CIF_KH_VAY"]))
+    for name in ["pivot_final", "pivot_full"]:
+        df = result[name]
+        df = df.iloc[np.argsort(df["CIF_KH_VAY"].map(thu_tu).to_numpy(), kind="stable")].reset_index(drop=True)
+        df["STT"] = np.arange(1, len(df) + 1)
+        result[name] = df
+    for name, keys in [("pivot_merge", ["CIF_KH_VAY"]), ("p_mucdich", ["CUSTSEQLN"])]:
+        if not result[name].empty:
+            result[name] = result[name].sort_values(keys, kind="stable").reset_index(drop=True)
+    kpi = result["kpi"]
+    if not kpi["df_count_tieu_chi_3"].empty:
+        kpi["df_count_tieu_chi_3"] = kpi["df_count_tieu_chi_3"].sort_values(["CIF", "NGAY"], kind="stable").reset_index(drop=True)
+    if not kpi["df_cap_tieu_chi_3"].empty:
+        kpi["df_cap_tieu_chi_3"] = kpi["df_cap_tieu_chi_3"].sort_values(
+            ["CIF", "NGAY_GIAI_NGAN", "NGAY_TT"], kind="stable"
+        ).reset_index(drop=True)
+
+
+def _row_tables(
+    frames: Dict[str, object],
+    inputs: Dict[str, pd.DataFrame],
+    pivot_full: pd.DataFrame,
+    ngay: pd.Timestamp,
+    nam_cham_tra: Tuple[int, int],
+    criteria: Optional[List[str]],
+) -> Dict[str, pd.DataFrame]:
+    """Bảng gộp tiêu chí 3 và bảng kỳ chậm trả tiêu chí 4 trên toàn bộ đầu vào hiện tại (như khi chạy toàn bộ)."""
+    out = {"df_gop_tieu_chi_3": pd.DataFrame(), "df_delay_tieu_chi_4": pd.DataFrame()}
+    if criteria is None or "tieu_chi_3" in criteria:
+        out["df_gop_tieu_chi_3"] = gop_tieu_chi_3(inputs.get("muc55"), inputs.get("muc56"))
+    df_muc57 = inputs.get("muc57")
+    if (criteria is None or "tieu_chi_4" in criteria) and df_muc57 is not None and not df_muc57.empty \
+            and all(c in df_muc57.columns for c in TC4_COT):
+        vocab = frames["cif_vocab"]
+        dong_piv = dong_theo_ma(vocab.get_indexer(pivot_full["CIF_KH_VAY"]), len(vocab))
+        out["df_delay_tieu_chi_4"], _ = tieu_chi_4(
+            df_muc57, frames["cif_codes"]["muc57"], vocab, pivot_full, dong_piv, ngay, nam_cham_tra
+        )
+    return out
+
+
+# ============================ RUN ============================ #
+def run_incremental(
+    inputs: Dict[str, pd.DataFrame],
+    ngay_danh_gia,
+    dia_ban_kt: List[str],
+    chi_nhanh: str = "",
+    branch_match: str = "contains",
+    branch_index: Optional[Dict[str, Dict[str, np.ndarray]]] = None,
+    prof: Optional[StageProfiler] = None,
+    state_dir: Optional[Path] = None,
+    nam_cham_tra: Tuple[int, int] = NAM_CHAM_TRA,
+    engine: str = "pandas",
+    criteria: Optional[List[str]] = None,
+    tc3_so_ngay: int = TC3_SO_NGAY,
+    top_n: int = TOP_N,
+) -> Dict[str, object]:
+    """Như ``run_pipeline`` nhưng dùng lại kết quả kỳ trước (cùng cách chọn chi nhánh).
+
+    ``result["incremental"]`` cho biết chế độ đã chạy ("tăng dần"/"toàn bộ"), lý do và số CIF tính lại.
+    """
+    prof = prof or StageProfiler(enabled=False)
+    ngay = pd.Timestamp(ngay_danh_gia)
+    path = Path(state_dir or STATE_DIR) / state_key(chi_nhanh, branch_match)
+
+    frames = prepare_frames(inputs, chi_nhanh, branch_match, branch_index, prof)
+    with prof.stage("tăng dần: hash theo CIF") as out:
+        hashes = cif_hash_table(frames, inputs)
+        side = {kind: key_hashes(inputs.get(kind), SIDE_KEYS[kind][0]) for kind in SIDE_KEYS}
+        labels = column_labels(frames, inputs)
+        out(rows=len(hashes))
+    meta = {"version": STATE_VERSION, "ngay_danh_gia": ngay.isoformat(), "dia_ban_kt": sorted(dia_ban_kt),
+            "nam_cham_tra": list(nam_cham_tra), "tc3_so_ngay": tc3_so_ngay, "labels": labels,
+            "criteria": [k for k in CRITERIA if criteria is None or k in criteria]}
+
+    with prof.stage("tăng dần: đọc kết quả kỳ trước"):
+        state = load_state(path)
+    dirty, ly_do = None, ""
+    if state is None:
+        ly_do = "chưa có kết quả kỳ trước"
+    elif state["pivot_full"].empty or frames["df_crm4"].empty:
+        ly_do = "kết quả kỳ trước hoặc kỳ này rỗng"
+    elif state["meta"]["dia_ban_kt"] != meta["dia_ban_kt"]:
+        ly_do = "đổi địa bàn kiểm toán"
+    elif state["meta"].get("nam_cham_tra") != meta["nam_cham_tra"]:
+        ly_do = "đổi khoảng năm chậm trả (tiêu chí 4)"
+    elif state["meta"].get("tc3_so_ngay") != meta["tc3_so_ngay"]:
+        ly_do = "đổi cửa sổ ghép Giải ngân – Tất toán (tiêu chí 3)"
+    elif state["meta"].get("criteria") != meta["criteria"]:
+        ly_do = "đổi danh sách tiêu chí"
+    elif json.loads(json.dumps(labels, default=str)) != state["meta"]["labels"]:
+        ly_do = "đổi cột đầu vào hoặc nhóm LOAI_TS/mục đích"
+    else:
+        with prof.stage("tăng dần: xác định CIF thay đổi") as out:
+            old_hashes = state["hashes"].reindex(columns=hashes.columns, fill_value=0).astype("uint64")
+            idx = old_hashes.index.union(hashes.index)
+            a = old_hashes.reindex(idx, fill_value=0).to_numpy()
+            b = hashes.reindex(idx, fill_value=0).to_numpy()
+            parts = [idx[(a != b).any(axis=1)]]
+            parts += [side_dirty_cifs(frames, state[kind], side[kind], kind) for kind in SIDE_KEYS]
+            ngay_cu = pd.Timestamp(state["meta"]["ngay_danh_gia"])
+            if ngay_cu != ngay:
+                parts.append(date_sensitive_cifs(frames, inputs.get("muc57"), ngay_cu, ngay, nam_cham_tra))
+            dirty = pd.Index(np.unique(np.concatenate([np.asarray(p, dtype=object) for p in parts])))
+            out(rows=len(dirty))
+        if len(dirty) > MAX_DIRTY_RATIO * max(len(idx), 1):
+            ly_do, dirty = f"{len(dirty):,}/{len(idx):,} CIF thay đổi — chạy lại toàn bộ nhanh hơn", None
+
+    if dirty is None:
+        result = analyse_frames(frames, inputs, ngay, dia_ban_kt, prof, nam_cham_tra, engine, criteria, tc3_so_ngay, top_n)
+        che_do, so_cif = "toàn bộ", len(hashes)
+    else:
+        result = _analyse_dirty(frames, inputs, ngay, dia_ban_kt, prof, state, dirty, nam_cham_tra, engine, criteria, tc3_so_ngay, top_n)
+        if result is None:
+            ly_do = "kết quả nhóm CIF tính lại có cột mới"
+            result = analyse_frames(frames, inputs, ngay, dia_ban_kt, prof, nam_cham_tra, engine, criteria, tc3_so_ngay, top_n)
+            che_do, so_cif = "toàn bộ", len(hashes)
+        else:
+            che_do, so_cif = "tăng dần", len(dirty)
+
+    with prof.stage("tăng dần: lưu trạng thái"):
+        if che_do == "tăng dần" and not so_cif and _same_hashes(state, hashes, side):
+            save_manifest(path, meta)  # không CIF nào đổi → giữ nguyên các bảng đã lưu
+        else:
+            save_state(path, meta, result, hashes, side)
+    result["incremental"] = {"che_do": che_do, "ly_do": ly_do, "cif_tinh_lai": so_cif, "tong_cif": len(hashes)}
+    result["profile"] = prof.records
+    return result
+
+
+def _same_hashes(state: Dict[str, object], hashes: pd.DataFrame, side: Dict[str, pd.Series]) -> bool:
+    old = state["hashes"]
+    return (
+        list(old.columns) == list(hashes.columns)
+        and old.index.equals(hashes.index)
+        and (old.to_numpy() == hashes.to_numpy()).all()
+        and all(changed_keys(state[kind], side[kind]).empty for kind in SIDE_KEYS)
+    )
+
+
+def _analyse_dirty(
+    frames: Dict[str, object],
+    inputs: Dict[str, pd.DataFrame],
+    ngay: pd.Timestamp,
+    dia_ban_kt: List[str],
+    prof: StageProfiler,
+    state: Dict[str, object],
+    dirty: pd.Index,
+    nam_cham_tra: Tuple[int, int] = NAM_CHAM_TRA,
+    engine: str = "pandas",
+    criteria: Optional[List[str]] = None,
+    tc3_so_ngay: int = TC3_SO_NGAY,
+    top_n: int = TOP_N,
+) -> Optional[Dict[str, object]]:
+    """Tính pivot & cờ cho các CIF ``dirty`` rồi ghép vào kết quả cũ; None nếu không ghép được."""
+    # Lọc theo mã CIF: bảng tra "mã thuộc nhóm tính lại" trên từ điển chung
+    vocab, codes = frames["cif_vocab"], frames["cif_codes"]
+    can_tinh = np.zeros(len(vocab), dtype=bool)
+    ma_dirty = vocab.get_indexer(dirty)
+    can_tinh[ma_dirty[ma_dirty >= 0]] = True
+    sub_frames = {**frames, "cif_codes": {kind: c[can_tinh[c]] for kind, c in codes.items()}}
+    for name, kind in [("df_crm4", "crm4"), ("df_crm32_filtered", "crm32")]:
+        if kind in codes:
+            sub_frames[name] = frames[name][can_tinh[codes[kind]]]
+    sub_inputs = dict(inputs)
+    for kind in ["muc55", "muc56", "muc57"]:
+        if kind in codes:
+            sub_inputs[kind] = inputs[kind][can_tinh[codes[kind]]]
+    sub = analyse_frames(sub_frames, sub_inputs, ngay, dia_ban_kt, prof, nam_cham_tra, engine, criteria, tc3_so_ngay, top_n) if not sub_frames["df_crm4"].empty else None
+
+    with prof.stage("tăng dần: ghép kết quả") as out:
+        # Tiêu chí 3 gồm cả CIF không có trong CRM4 → tính riêng, không qua pivot
+        fresh = {name: sub[name] if sub else pd.DataFrame() for name in ["pivot_final", "pivot_merge", "p_mucdich", "pivot_full"]}
+        if criteria is None or "tieu_chi_3" in criteria:
+            sub_codes = sub_frames["cif_codes"]
+            _, tc3 = tieu_chi_3(
+                sub_inputs["muc55"], sub_inputs["muc56"], sub_codes.get("muc55"), sub_codes.get("muc56"), vocab, tc3_so_ngay
+            )
+            fresh.update({name: tc3[name] for name in ["df_count_tieu_chi_3", "df_cap_tieu_chi_3"]})
+        else:
+            fresh.update({name: pd.DataFrame() for name in ["df_count_tieu_chi_3", "df_cap_tieu_chi_3"]})
+        if any(not df.empty and not set(df.columns) <= set(state[name].columns) and not state[name].empty
+               for name, df in fresh.items()):
+            return None
+        merged = {name: splice(state[name], fresh[name], RESULT_KEYS[name], dirty) for name in RESULT_KEYS}
+        result = {
+            "df_crm4": frames["df_crm4"],
+            "df_crm32_filtered": frames["df_crm32_filtered"],
+            "ma_chua_anh_xa": frames["ma_chua_anh_xa"],
+            **{name: merged[name] for name in ["pivot_final", "pivot_merge", "p_mucdich", "pivot_full"]},
+            "kpi": {name: merged[name] for name in ["df_count_tieu_chi_3", "df_cap_tieu_chi_3"]},
+        }
+        _sort_like_full(result, frames["df_crm4"])
+        kpi = {**result["kpi"], **_row_tables(frames, inputs, result["pivot_full"], ngay, nam_cham_tra, criteria)}
+        result["kpi"] = {name: kpi[name] for name in KPI_FRAMES}  # thứ tự khoá như khi chạy toàn bộ
+        if criteria is None or "top10" in criteria:
+            mark_top10(result["pivot_full"])
+        if criteria is None or "xep_hang" in criteria:
+            mark_rankings(result["pivot_full"], top_n)
+        result["kpi"] = {**kpi_summary(result["pivot_full"]), **result["kpi"]}
+        out(result["pivot_full"])
+    return result
@@ -0,0 +1,373 @@
+# -------------------------------------------------------------
+# Đọc dữ liệu đầu vào cho app CRM4 / CRM32
+# - Cache Parquet trên đĩa theo hash nội dung file
+# - Đọc song song nhiều file Excel bằng ProcessPoolExecutor
+# - Schema khai báo theo loại đầu vào: chỉ đọc cột cần dùng + ép kiểu
+# Tách khỏi app_crm.py để tiến trình con import được (không chạy lại UI).
+# -------------------------------------------------------------
+
+import hashlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import streamlit as st
+
+# ============================ INGEST CACHE ============================ #
+# Cache đọc file trên đĩa: mỗi file upload được băm theo nội dung (sha256),
+# parse Excel một lần rồi lưu Parquet; các lần chạy sau (đổi chi nhánh, ngày...)
+# đọc thẳng Parquet, không parse Excel lại. Dọn theo LRU khi vượt dung lượng.
+CACHE_DIR = Path(os.environ.get("CRM_CACHE_DIR", Path.home() / ".cache" / "crm_dashboard"))
+CACHE_MAX_BYTES = int(float(os.environ.get("CRM_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+CACHE_VERSION = "2"  # tăng khi đổi cách parse/chuẩn hoá để vô hiệu cache cũ
+
+
+def file_bytes(file) -> bytes:
+    """Lấy toàn bộ bytes của file upload (không phụ thuộc vị trí con trỏ)."""
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    if hasattr(file, "seek"):
+        file.seek(0)
+    return file.read()
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(data: bytes, kind: Optional[str] = None, project: bool = True) -> str:
+    key = f"{content_hash(data)}-v{CACHE_VERSION}"
+    if kind in SCHEMAS:
+        key += f"-{kind}-s{SCHEMA_VERSION}" + ("p" if project else "")
+    return key
+
+
+def normalize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Chuẩn kiểu để ghi Parquet: cột object lẫn kiểu → str (giữ NaN), tên cột → str.
+
+    Cột object chỉ một kiểu (toàn str, toàn datetime.date...) giữ nguyên — Parquet ghi được.
+    """
+    df = df.copy()
+    df.columns = pd.Index([str(c) for c in df.columns], name=df.columns.name)
+    for c in df.columns:
+        s = df[c]
+        if s.dtype != object:
+            continue
+        notna = s.notna()
+        kinds = set(map(type, s[notna]))
+        if len(kinds) > 1:
+            df[c] = s.where(~notna, s[notna].astype(str))
+    return df
+
+
+def _cache_path(key: str) -> Path:
+    return CACHE_DIR / f"{key}.parquet"
+
+
+def cache_get(key: str) -> Optional[pd.DataFrame]:
+    path = _cache_path(key)
+    if not path.exists():
+        return None
+    try:
+        df = pd.read_parquet(path)
+    except Exception:
+        path.unlink(missing_ok=True)
+        return None
+    os.utime(path)  # đánh dấu vừa dùng (LRU)
+    return df
+
+
+def cache_put(key: str, df: pd.DataFrame) -> None:
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = _cache_path(key).with_suffix(".tmp")
+        df.to_parquet(tmp, index=False)
+        tmp.replace(_cache_path(key))
+    except Exception:
+        # Cache chỉ để tăng tốc — lỗi ghi không được làm hỏng lần chạy
+        return
+    evict_lru(CACHE_MAX_BYTES)
+
+
+def evict_lru(max_bytes: int) -> None:
+    """Xoá file cache ít dùng nhất cho tới khi tổng dung lượng <= max_bytes."""
+    files = sorted(CACHE_DIR.glob("*.parquet"), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in files)
+    for p in files:
+        if total <= max_bytes:
+            break
+        total -= p.stat().st_size
+        p.unlink(missing_ok=True)
+
+# ============================ SCHEMAS ============================ #
+# Mỗi loại đầu vào khai báo các cột pipeline dùng và kiểu đích:
+#   key      : mã khoá (mã TS, khế ước, mã code...) → str, giữ NaN
+#   int_key  : mã CIF — dạng số (kể cả chuỗi số) → int → str, như to_str_intlike
+#   float    : số tiền → float64
+#   date     : ngày → datetime64
+#   category : cột ít giá trị lặp nhiều → category
+#   other    : cột giữ nguyên kiểu (tên KH, nhóm nợ...)
+# Khi project=True chỉ các cột này được đọc (usecols); cột không có trong file bị bỏ qua.
+# NHOM_NO/CUSTTPCD giữ nguyên kiểu: pipeline so sánh theo giá trị gốc và fillna(0) sau merge.
+SCHEMA_VERSION = "1"  # tăng khi đổi SCHEMAS để vô hiệu cache cũ
+SCHEMAS = {
+    "crm4": {
+        "int_key": ["CIF_KH_VAY"],
+        "key": ["CAP_2", "SECU_SRL_NUM"],
+        "float": ["TS_KW_VND", "DU_NO_PHAN_BO_QUY_DOI"],
+        "date": ["VALUATION_DATE"],
+        "category": ["LOAI", "BRANCH_VAY"],
+        "other": ["TEN_KH_VAY", "CUSTTPCD", "NHOM_NO"],
+    },
+    "crm32": {
+        "int_key": ["CUSTSEQLN"],
+        "key": ["KHE_UOC", "MUC_DICH_VAY_CAP_4", "CAP_PHE_DUYET"],
+        "float": ["DU_NO_QUY_DOI"],
+        "category": ["BRCD", "SCHEME_CODE"],
+    },
+    "code_tsbd": {
+        "key": ["CODE CAP 2", "CAP_2"],
+        "other": ["CODE", "LOAI_TS"],
+    },
+    "code_mdsd": {
+        "key": ["CODE_MDSDV4"],
+        "other": ["GROUP"],
+    },
+    "giai_ngan_tm": {
+        "key": ["FORACID"],
+    },
+    "muc17": {
+        "key": ["C01"],
+        "category": ["C02"],
+        "other": ["C19"],
+    },
+    "muc55": {
+        "int_key": ["CUSTSEQLN"],
+        "key": ["KHE_UOC"],
+        "float": ["SOTIENGIAINGAN"],
+        "date": ["NGAYGN", "NGAYDH", "NGAY_TT"],
+        "category": ["LOAITIEN"],
+        "other": ["NMLOC"],
+    },
+    "muc56": {
+        "int_key": ["CIF"],
+        "key": ["KHE_UOC"],
+        "float": ["SO_TIEN_GIAI_NGAN_VND"],
+        "date": ["NGAY_GIAI_NGAN", "NGAY_DAO_HAN"],
+        "category": ["LOAI_TIEN_HD"],
+        "other": ["TEN_KHACH_HANG"],
+    },
+    "muc57": {
+        "int_key": ["CIF_ID"],
+        "date": ["NGAY_DEN_HAN_TT", "NGAY_THANH_TOAN"],
+    },
+}
+
+
+def schema_columns(kind: str) -> List[str]:
+    return [c for cols in SCHEMAS[kind].values() for c in cols]
+
+
+def to_key_str(series: pd.Series, intlike_strings: bool = False) -> pd.Series:
+    """Chuẩn mã khoá về str (giữ NaN).
+
+    Giá trị số nguyên (123.0) → "123". Với ``intlike_strings=True`` cả chuỗi số
+    cũng được chuẩn ("00123" → "123"), giống ``to_str_intlike`` cho mã CIF.
+    """
+    out = series.astype(str).str.strip().where(series.notna())
+    if intlike_strings or pd.api.types.is_numeric_dtype(series):
+        num = pd.to_numeric(series, errors="coerce")
+        intlike = num.notna() & (num == num.round())
+        out[intlike] = num[intlike].astype("int64").astype(str)
+    return out.astype(object)
+
+
+def apply_schema(df: pd.DataFrame, kind: Optional[str], project: bool = True) -> pd.DataFrame:
+    """Chiếu cột & ép kiểu theo SCHEMAS[kind]; kind không khai báo → trả nguyên df."""
+    if kind not in SCHEMAS or df.empty:
+        return df
+    spec = SCHEMAS[kind]
+    if project:
+        df = df[[c for c in df.columns if c in set(schema_columns(kind))]]
+    df = df.copy()
+    for c in spec.get("int_key", []):
+        if c in df.columns:
+            df[c] = to_key_str(df[c], intlike_strings=True)
+    for c in spec.get("key", []):
+        if c in df.columns:
+            df[c] = to_key_str(df[c])
+    for c in spec.get("float", []):
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").astype("float64")
+    for c in spec.get("date", []):
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c], errors="coerce")
+    for c in spec.get("category", []):
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    return df
+
+# ============================ READERS ============================ #
+# Số tiến trình đọc song song (mặc định = số CPU) và ngưỡng để đọc song song:
+# ít file hoặc tổng dung lượng nhỏ thì đọc tuần tự (chi phí khởi tạo pool > lợi ích).
+INGEST_WORKERS = int(os.environ.get("CRM_INGEST_WORKERS", "0")) or (os.cpu_count() or 1)
+PARALLEL_MIN_FILES = 2
+PARALLEL_MIN_BYTES = int(float(os.environ.get("CRM_PARALLEL_MIN_MB", "5")) * 1024 * 1024)
+
+
+def csv_dtypes(kind: Optional[str]) -> dict:
+    """Bản xuất CSV: cột mã đọc dạng chuỗi (giữ số 0 đầu), cột khác để pandas tự nhận kiểu."""
+    spec = SCHEMAS.get(kind, {})
+    return {c: str for c in spec.get("key", []) + spec.get("int_key", [])}
+
+
+def parse_excel_bytes(data: bytes, name: str, usecols=None, kind: Optional[str] = None) -> pd.DataFrame:
+    bio = io.BytesIO(data)
+    if name.endswith(".csv"):
+        return pd.read_csv(bio, usecols=usecols, dtype=csv_dtypes(kind))
+    if name.endswith(".xls"):
+        # pandas>=2 cần xlrd để đọc .xls
+        return pd.read_excel(bio, engine="xlrd", usecols=usecols)
+    return pd.read_excel(bio, usecols=usecols)
+
+
+def _usecols(kind: Optional[str], project: bool) -> Optional[Callable[[object], bool]]:
+    """Bộ lọc cột cho usecols: chỉ các cột khai báo trong SCHEMAS[kind] (None = mọi cột)."""
+    if project and kind in SCHEMAS:
+        wanted = set(schema_columns(kind))
+        return lambda c: str(c).strip() in wanted
+    return None
+
+
+def _parse_job(job: Tuple[bytes, str, Optional[str], bool]) -> Tuple[Optional[pd.DataFrame], str]:
+    """Chạy trong tiến trình con: trả về (df đã chuẩn kiểu, "") hoặc (None, thông báo lỗi)."""
+    data, name, kind, project = job
+    usecols = _usecols(kind, project)
+    try:
+        df = parse_excel_bytes(data, name, usecols, kind)
+        df.columns = [str(c).strip() for c in df.columns]
+        return apply_schema(normalize_dtypes(df), kind, project), ""
+    except Exception as e:
+        return None, str(e)
+
+
+def read_excel_any(file, kind: Optional[str] = None, project: bool = True) -> pd.DataFrame:
+    """Đọc Excel từ streamlit uploader (hỗ trợ .xls/.xlsx), qua cache Parquet theo nội dung.
+
+    ``kind`` là khoá trong SCHEMAS (crm4, crm32, muc17...) để chiếu cột & ép kiểu.
+    """
+    if file is None:
+        return pd.DataFrame()
+    name = getattr(file, "name", "").lower()
+    data = file_bytes(file)
+    key = cache_key(data, kind, project)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached
+    df, err = _parse_job((data, name, kind, project))
+    if df is None:
+        st.error(f"Không đọc được file **{name}**: {err}")
+        return pd.DataFrame()
+    cache_put(key, df)
+    return df
+
+
+def read_excel_multi(
+    files: List, kind: Optional[str] = None, project: bool = True, max_workers: Optional[int] = None
+) -> List[pd.DataFrame]:
+    """Đọc nhiều file, giữ đúng thứ tự upload.
+
+    File đã có trong cache được lấy ngay; các file còn lại được parse song song
+    trên ``max_workers`` tiến trình (mặc định ``INGEST_WORKERS``), trừ khi quá ít
+    file/dữ liệu thì parse tuần tự.
+    """
+    files = [f for f in files or [] if f is not None]
+    frames: List[Optional[pd.DataFrame]] = [None] * len(files)
+    pending = []  # (vị trí, key, bytes, tên)
+    for i, f in enumerate(files):
+        data = file_bytes(f)
+        key = cache_key(data, kind, project)
+        cached = cache_get(key)
+        if cached is not None:
+            frames[i] = cached
+        else:
+            pending.append((i, key, data, getattr(f, "name", "").lower()))
+
+    workers = min(max_workers or INGEST_WORKERS, len(pending))
+    total_bytes = sum(len(p[2]) for p in pending)
+    jobs = [(data, name, kind, project) for _, _, data, name in pending]
+    if workers > 1 and len(pending) >= PARALLEL_MIN_FILES and total_bytes >= PARALLEL_MIN_BYTES:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(_parse_job, jobs))
+    else:
+        results = [_parse_job(j) for j in jobs]
+
+    for (i, key, _, name), (df, err) in zip(pending, results):
+        if df is None:
+            st.error(f"Không đọc được file **{name}**: {err}")
+            continue
+        cache_put(key, df)
+        frames[i] = df
+    return [df for df in frames if df is not None and not df.empty]
+
+# ============================ STREAMING ============================ #
+# Đọc theo khối cho file CRM rất lớn: mỗi khối được chiếu cột, ép kiểu (và lọc
+# chi nhánh ở crm_core) ngay khi đọc, nên bảng thô đầy đủ không bao giờ nằm
+# trọn trong bộ nhớ. .xlsx: openpyxl read-only; .csv: read_csv(chunksize);
+# .xls: xlrd không đọc từng phần được → đọc cả file rồi cắt khối.
+STREAM_CHUNK_ROWS = int(os.environ.get("CRM_STREAM_CHUNK_ROWS", "100000"))
+
+
+def _cell(v):
+    # Như pandas.read_excel (openpyxl): số thực nguyên → int
+    return int(v) if isinstance(v, float) and v.is_integer() else v
+
+
+def _iter_xlsx(data: bytes, usecols, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    import openpyxl
+
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        names = [str(c).strip() if c is not None else f"Unnamed: {i}" for i, c in enumerate(header)]
+        keep = [i for i, c in enumerate(names) if usecols is None or usecols(c)]
+        cols = [names[i] for i in keep]
+        buf = []
+        for row in rows:
+            vals = [_cell(row[i]) if i < len(row) else None for i in keep]
+            if any(v is not None for v in vals):  # bỏ dòng trống như read_excel
+                buf.append(vals)
+            if len(buf) >= chunk_rows:
+                yield pd.DataFrame(buf, columns=cols)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=cols)
+    finally:
+        wb.close()
+
+
+def iter_chunks(
+    data: bytes, name: str, kind: Optional[str] = None, project: bool = True, chunk_rows: Optional[int] = None
+) -> Iterator[pd.DataFrame]:
+    """Các khối dòng (tối đa ``chunk_rows``) đã chiếu cột & ép kiểu theo SCHEMAS[kind].
+
+    CSV và .xlsx đọc dần từng khối; .xls (xlrd) không đọc dần được nên phải đọc cả file rồi cắt khối.
+    """
+    chunk_rows = chunk_rows or STREAM_CHUNK_ROWS
+    usecols = _usecols(kind, project)
+    if name.endswith(".csv"):
+        raw = pd.read_csv(io.BytesIO(data), usecols=usecols, dtype=csv_dtypes(kind), chunksize=chunk_rows)
+    elif name.endswith(".xls"):
+        df = parse_excel_bytes(data, name, usecols, kind)
+        raw = (df.iloc[i:i + chunk_rows] for i in range(0, len(df), chunk_rows))
+    else:
+        raw = _iter_xlsx(data, usecols, chunk_rows)
+    for chunk in raw:
+        chunk.columns = [str(c).strip() for c in chunk.columns]
+        yield apply_schema(normalize_dtypes(chunk), kind, project)
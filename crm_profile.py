@@ -0,0 +1,184 @@
+# -------------------------------------------------------------
+# Đo hiệu năng từng bước của pipeline CRM4 / CRM32
+# Ghi thời gian, số dòng vào/ra, RSS hiện tại, mức tăng và đỉnh RSS của từng bước,
+# dung lượng DataFrame; khi tracemalloc đang bật thì ghi thêm đỉnh cấp phát của từng bước.
+# -------------------------------------------------------------
+
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+def _rss_mb() -> Optional[float]:
+    """RSS hiện tại của tiến trình (MB), đọc từ /proc; None nếu không hỗ trợ."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _reset_peak_rss() -> bool:
+    """Đặt lại RSS đỉnh (VmHWM) về RSS hiện tại; False nếu hệ thống không hỗ trợ (ngoài Linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb(since_reset: bool) -> Optional[float]:
+    """RSS đỉnh (MB) từ lần ``_reset_peak_rss`` thành công; None nếu không đặt lại được.
+
+    ``ru_maxrss`` là đỉnh của cả đời tiến trình nên không dùng để gán cho một bước.
+    """
+    if not since_reset:
+        return None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 2**10, 1)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _alloc_peak_mb() -> Optional[float]:
+    """Đỉnh bộ nhớ cấp phát từ lần đo trước (MB) rồi đặt lại mốc; None nếu tracemalloc tắt."""
+    if not tracemalloc.is_tracing():
+        return None
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    return round(peak / 2**20, 1)
+
+
+def frame_mb(df) -> Optional[float]:
+    if not isinstance(df, pd.DataFrame):
+        return None
+    return round(df.memory_usage(index=True).sum() / 2**20, 2)
+
+
+STAGE_COLUMNS = [
+    "stage", "seconds", "rows_in", "rows_out", "df_mb", "rss_mb", "rss_delta_mb", "peak_rss_mb", "alloc_peak_mb",
+]
+
+
+def _max(*values) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+class StageProfiler:
+    """Ghi nhận các bước: ``stage`` (khối with) hoặc ``lap`` (thời gian từ mốc trước).
+
+    Mỗi mốc (``start``/``stage``/``lap``) đặt lại đỉnh RSS và đỉnh tracemalloc, nên
+    ``peak_rss_mb``/``alloc_peak_mb`` là đỉnh trong bước đó và ``rss_delta_mb`` là RSS
+    cuối bước trừ RSS đầu bước. ``stage`` lồng nhau được: đỉnh của bước con được gộp lên
+    các khối ``stage`` đang mở.
+    ``enabled=False`` → mọi lời gọi đều bỏ qua, nên các hàm luôn nhận được một profiler.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.records: List[Dict[str, object]] = []
+        self._open: List[Dict[str, Optional[float]]] = []  # các khối stage đang mở
+        self._set_mark()
+
+    def _set_mark(self) -> None:
+        self._rss0 = _rss_mb() if self.enabled else None
+        self._peak_reset = self.enabled and _reset_peak_rss()
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self._mark = time.perf_counter()
+
+    def _record(self, name: str, seconds: float, rows_in=None, rows_out=None, df=None,
+                rss0=None, inner=None, per_stage=True) -> Dict[str, object]:
+        rss = _rss_mb()
+        delta = peak = alloc = None
+        if per_stage:
+            inner = inner or {}
+            delta = round(rss - rss0, 1) if rss is not None and rss0 is not None else None
+            peak = _max(_peak_rss_mb(self._peak_reset), inner.get("peak"))
+            alloc = _max(_alloc_peak_mb(), inner.get("alloc"))
+            for frame in self._open:
+                frame["peak"], frame["alloc"] = _max(frame["peak"], peak), _max(frame["alloc"], alloc)
+        rec = {
+            "stage": name,
+            "seconds": round(seconds, 4),
+            "rows_in": rows_in,
+            "rows_out": rows_out,
+            "df_mb": frame_mb(df),
+            "rss_mb": rss,
+            "rss_delta_mb": delta,
+            "peak_rss_mb": peak,
+            "alloc_peak_mb": alloc,
+        }
+        self.records.append(rec)
+        return rec
+
+    @contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None):
+        """Đo một khối; trong khối gọi ``out(df)`` trên đối tượng trả về để ghi kết quả."""
+        if not self.enabled:
+            yield _NullOut()
+            return
+        out = _StageOut()
+        self._set_mark()
+        frame = {"rss0": self._rss0, "peak": None, "alloc": None}
+        self._open.append(frame)
+        t0 = self._mark
+        try:
+            yield out
+        finally:
+            self._open.pop()
+            rows_out = len(out.df) if out.df is not None else out.rows
+            self._record(name, time.perf_counter() - t0, rows_in, rows_out, out.df, rss0=frame["rss0"], inner=frame)
+            self._set_mark()
+
+    def start(self) -> None:
+        """Đặt mốc cho chuỗi ``lap``."""
+        self._set_mark()
+
+    def lap(self, name: str, df=None, rows_in: Optional[int] = None) -> None:
+        """Ghi một bước kết thúc ngay lúc gọi, tính từ mốc trước (``start``/``lap``/``stage``)."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self._record(name, now - self._mark, rows_in, len(df) if df is not None else None, df, rss0=self._rss0)
+        self._set_mark()
+
+    def add(self, name: str, seconds: float, rows_in: Optional[int] = None, rows_out: Optional[int] = None) -> None:
+        """Ghi một bước đã tự đo thời gian (vd. chạy trong luồng con, không dùng được ``stage``/``lap``).
+
+        Các bước chạy song song dùng chung bộ nhớ tiến trình nên không ghi mức tăng/đỉnh bộ nhớ.
+        """
+        if self.enabled:
+            self._record(name, seconds, rows_in, rows_out, per_stage=False)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records, columns=STAGE_COLUMNS)
+
+    def to_json(self, **meta) -> str:
+        """JSON để lưu theo dõi xu hướng: {"meta": {...}, "stages": [...]}."""
+        return json.dumps({"meta": meta, "stages": self.records}, ensure_ascii=False, indent=2, default=str)
+
+
+class _StageOut:
+    def __init__(self):
+        self.df = None
+        self.rows = None
+
+    def __call__(self, df=None, rows: Optional[int] = None) -> None:
+        self.df, self.rows = df, rows
+
+
+class _NullOut:
+    def __call__(self, df=None, rows: Optional[int] = None) -> None:
+        return None
@@ -0,0 +1,158 @@
+# -------------------------------------------------------------
+# Chuẩn tỉnh/thành từ địa chỉ tự do (Mục 17 — TSBĐ khác địa bàn)
+# Bỏ dấu, bỏ tiền tố "TP."/"Tỉnh"/"Thành phố", tra bảng viết tắt ("TP.HCM",
+# "Sài Gòn", "BR-VT"...) rồi so với danh sách 63 tỉnh/thành. Chỉ xử lý các địa
+# chỉ khác nhau; kết quả nhớ trên đĩa để các lần chạy sau không tính lại.
+# -------------------------------------------------------------
+
+import os
+import threading
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from crm_io import CACHE_DIR
+
+RESOLVER_VERSION = "1"  # tăng khi đổi bảng tỉnh/viết tắt để bỏ cache cũ
+MEMO_PATH = CACHE_DIR / f"tinh_thanh_v{RESOLVER_VERSION}.parquet"
+MEMO_MAX_ENTRIES = int(os.environ.get("CRM_PROVINCE_MEMO_MAX", "500000"))
+
+# Tên chuẩn: không dấu, chữ thường (63 tỉnh/thành trước sáp nhập — tên sau sáp nhập đều nằm trong số này)
+TINH_THANH = [
+    "an giang", "ba ria vung tau", "bac giang", "bac kan", "bac lieu", "bac ninh", "ben tre",
+    "binh dinh", "binh duong", "binh phuoc", "binh thuan", "ca mau", "can tho", "cao bang",
+    "da nang", "dak lak", "dak nong", "dien bien", "dong nai", "dong thap", "gia lai", "ha giang",
+    "ha nam", "ha noi", "ha tinh", "hai duong", "hai phong", "hau giang", "ho chi minh", "hoa binh",
+    "hung yen", "khanh hoa", "kien giang", "kon tum", "lai chau", "lam dong", "lang son", "lao cai",
+    "long an", "nam dinh", "nghe an", "ninh binh", "ninh thuan", "phu tho", "phu yen", "quang binh",
+    "quang nam", "quang ngai", "quang ninh", "quang tri", "soc trang", "son la", "tay ninh",
+    "thai binh", "thai nguyen", "thanh hoa", "thua thien hue", "tien giang", "tra vinh",
+    "tuyen quang", "vinh long", "vinh phuc", "yen bai",
+]
+# Viết tắt / cách viết khác (đã bỏ dấu, bỏ tiền tố) → tên chuẩn
+BI_DANH = {
+    "hcm": "ho chi minh", "tphcm": "ho chi minh", "hcmc": "ho chi minh", "ho chi minh city": "ho chi minh",
+    "sai gon": "ho chi minh", "saigon": "ho chi minh", "sg": "ho chi minh",
+    "hn": "ha noi", "hanoi": "ha noi",
+    "hp": "hai phong", "danang": "da nang", "cantho": "can tho",
+    "hue": "thua thien hue", "tt hue": "thua thien hue", "tth": "thua thien hue",
+    "brvt": "ba ria vung tau", "br vt": "ba ria vung tau", "vung tau": "ba ria vung tau",
+    "daklak": "dak lak", "dac lac": "dak lak", "dak lac": "dak lak", "daknong": "dak nong", "dac nong": "dak nong",
+    "bac can": "bac kan", "kontum": "kon tum", "khanh hoa nha trang": "khanh hoa",
+}
+# Đoạn địa chỉ bỏ qua khi tìm tỉnh từ cuối lên
+QUOC_GIA = {"viet nam", "vietnam", "vn"}
+_TIEN_TO = r"^(?:thanh pho|tinh|tp)\s+"
+
+
+def normalize_text(s: pd.Series) -> pd.Series:
+    """Bỏ dấu (kể cả đ), chữ thường, dấu câu → khoảng trắng, gộp khoảng trắng."""
+    return (
+        s.str.normalize("NFD")
+        .str.replace("[\u0300-\u036f]", "", regex=True)
+        .str.lower()
+        .str.replace("đ", "d")
+        .str.replace(r"[^0-9a-z]+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def _canonical(doan: pd.Series) -> pd.Series:
+    """Đoạn địa chỉ đã chuẩn → tên tỉnh chuẩn nếu nhận ra, ngược lại NaN."""
+    ten = doan.str.replace(_TIEN_TO, "", regex=True)
+    ten = ten.map(BI_DANH).fillna(ten)
+    return ten.where(ten.isin(TINH_THANH))
+
+
+def resolve_unique(addresses: Iterable[str]) -> List[str]:
+    """Tỉnh/thành cho các địa chỉ (chuỗi) khác nhau — xử lý theo cột trên cả danh sách.
+
+    Duyệt các đoạn (phân cách dấu phẩy) từ cuối lên, bỏ đoạn tên nước, lấy đoạn đầu tiên
+    nhận ra là tỉnh/thành. Không nhận ra → đoạn cuối đã chuẩn (như cách cũ); rỗng → "".
+    """
+    dia_chi = pd.Series(list(addresses), dtype=object)
+    if dia_chi.empty:
+        return []
+    doan = dia_chi.str.split(",").explode()
+    vi_tri = doan.index.to_numpy()
+    doan = normalize_text(doan.reset_index(drop=True))
+    doan = doan[~doan.isin(QUOC_GIA) & doan.ne("")]
+    vi_tri = vi_tri[doan.index.to_numpy()]
+    tinh = _canonical(doan).to_numpy()
+
+    out = np.full(len(dia_chi), "", dtype=object)
+    # Đoạn cuối còn lại của mỗi địa chỉ (dự phòng khi không nhận ra tỉnh)
+    cuoi = np.r_[vi_tri[1:] != vi_tri[:-1], True] if len(vi_tri) else np.array([], dtype=bool)
+    out[vi_tri[cuoi]] = doan.to_numpy()[cuoi]
+    # Đoạn nhận ra gần cuối nhất: ghi theo thứ tự đoạn → đoạn sau ghi đè đoạn trước
+    nhan_ra = pd.notna(tinh)
+    out[vi_tri[nhan_ra]] = tinh[nhan_ra]
+    return out.tolist()
+
+
+# ============================ MEMO ============================ #
+_MEMO: Dict[str, str] = {}
+_MEMO_LOADED = False
+_MEMO_LOCK = threading.Lock()  # nhiều phiên Streamlit / luồng dùng chung _MEMO
+
+
+def _load_memo() -> None:
+    """Nạp bộ nhớ đệm từ đĩa một lần (gọi khi đang giữ ``_MEMO_LOCK``)."""
+    global _MEMO_LOADED
+    if _MEMO_LOADED:
+        return
+    _MEMO_LOADED = True
+    try:
+        df = pd.read_parquet(MEMO_PATH)
+        _MEMO.update(zip(df["DIA_CHI"], df["TINH"]))
+    except Exception:
+        pass  # chưa có / hỏng → tính lại
+
+
+def _save_memo() -> None:
+    """Ghi bộ nhớ đệm (gọi khi đang giữ ``_MEMO_LOCK`` để bản cũ không ghi đè bản mới hơn).
+
+    File tạm mang pid + mã luồng nên các tiến trình chạy lô song song không ghi chung một file.
+    """
+    tmp = MEMO_PATH.with_name(f"{MEMO_PATH.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        MEMO_PATH.parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame({"DIA_CHI": list(_MEMO), "TINH": list(_MEMO.values())}).to_parquet(tmp, index=False)
+        tmp.replace(MEMO_PATH)
+    except Exception:
+        tmp.unlink(missing_ok=True)  # cache chỉ để tăng tốc
+
+
+def resolve_provinces(addresses: pd.Series, memo: bool = True) -> pd.Series:
+    """Tỉnh/thành chuẩn cho từng địa chỉ (ô không phải chuỗi → "").
+
+    Chỉ các địa chỉ khác nhau chưa có trong bộ nhớ đệm mới được tính; ``memo=True`` ghi
+    kết quả mới xuống ``MEMO_PATH`` cho các lần chạy sau.
+    """
+    codes, uniques = pd.factorize(addresses.astype(object))
+    la_chuoi = np.array([isinstance(u, str) for u in uniques], dtype=bool)
+    ket_qua = np.full(len(uniques), "", dtype=object)
+    if memo:
+        with _MEMO_LOCK:
+            _load_memo()
+            da_co = np.array([u in _MEMO for u in uniques], dtype=bool) & la_chuoi
+            ket_qua[da_co] = [_MEMO[u] for u in uniques[da_co]]
+    else:
+        da_co = np.zeros(len(uniques), dtype=bool)
+    moi = la_chuoi & ~da_co
+    if moi.any():
+        ket_qua[moi] = resolve_unique(uniques[moi])
+        if memo:
+            with _MEMO_LOCK:
+                if len(_MEMO) + int(moi.sum()) > MEMO_MAX_ENTRIES:
+                    _MEMO.clear()
+                _MEMO.update(zip(uniques[moi], ket_qua[moi]))
+                _save_memo()
+    out = np.where(codes >= 0, ket_qua[np.maximum(codes, 0)] if len(ket_qua) else "", "")
+    return pd.Series(out, index=addresses.index, dtype=object)
+
+
+def resolve_dia_ban(dia_ban_kt: List[str]) -> List[str]:
+    """Danh sách tỉnh/thành của đơn vị kiểm toán theo cùng cách chuẩn với địa chỉ TSBĐ."""
+    return [t for t in resolve_unique(dia_ban_kt) if t]
@@ -0,0 +1,35 @@
+# Chạy test từ thư mục gốc repo:  python -m pytest -q
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from crm_batch import quiet_streamlit  # noqa: E402
+from crm_bench import make_dataset  # noqa: E402
+
+quiet_streamlit()
+
+NGAY_DANH_GIA = "2025-08-31"
+DIA_BAN = ["hồ chí minh", "long an"]
+
+
+@pytest.fixture(autouse=True)
+def _cache_tam(tmp_path, monkeypatch):
+    # Cache đọc file / trạng thái tăng dần / bộ nhớ đệm tỉnh ghi vào thư mục tạm của từng test
+    import crm_incremental
+    import crm_io
+    import crm_province
+
+    monkeypatch.setattr(crm_io, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(crm_incremental, "STATE_DIR", tmp_path / "state")
+    monkeypatch.setattr(crm_province, "MEMO_PATH", tmp_path / "cache" / crm_province.MEMO_PATH.name)
+    monkeypatch.setattr(crm_province, "_MEMO", {})
+    monkeypatch.setattr(crm_province, "_MEMO_LOADED", False)
+
+
+@pytest.fixture(scope="session")
+def inputs():
+    """Bộ đầu vào tổng hợp nhỏ (đủ mọi loại file), dùng chung — test không được sửa tại chỗ."""
+    return make_dataset(3000, seed=1)
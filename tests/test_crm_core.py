@@ -0,0 +1,592 @@
+# Đối chiếu ánh xạ LOAI_TS và các cờ đã vector hoá với logic theo dòng của bản gốc
+import io
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import crm_core
+import crm_io
+from conftest import DIA_BAN, NGAY_DANH_GIA
+from crm_core import (
+    R34_QUY_TAC, add_flags_and_joins, add_loai_ts, branch_partition, build_pivots, dong_theo_ma, encode_cifs,
+    explore_page, flag_columns, gop_tieu_chi_3, load_inputs, match_branches, prepare_frames, r34_qua_han,
+    r34_so_ngay_qua_han, rank_col, rank_top_n, ranking_columns, run_pipeline, select_branch, take_branch, tc3_col,
+    tieu_chi_3, tieu_chi_4, unmapped_codes, write_excel, write_excel_streaming,
+)
+
+CO_CAC_CO = ["no_nhom", "cap_c", "co_cau", "bao_lanh_lc", "tctd_khac", "top10"]
+COT_CO = ["Nợ nhóm 2", "Nợ xấu", "Chuyên gia PD cấp C duyệt", "NỢ CƠ_CẤU",
+          "DƯ_NỢ_BẢO_LÃNH", "DƯ_NỢ_LC", "Cầm cố tại TCTD khác", "Top 10 dư nợ KHCN", "Top 10 dư nợ KHDN"]
+
+
+# ============================ THAM CHIẾU (THEO DÒNG) ============================ #
+def _ref_add_loai_ts(df_crm4, df_code_tsbd):
+    tmp = df_code_tsbd[["CODE CAP 2", "CODE"]].copy()
+    tmp.columns = ["CAP_2", "LOAI_TS"]
+    df = df_crm4.merge(tmp.drop_duplicates(), how="left", on="CAP_2")
+    df["LOAI_TS"] = df.apply(
+        lambda r: "Không TS" if pd.isna(r.get("CAP_2")) or str(r.get("CAP_2", "")).strip() == "" else r.get("LOAI_TS"),
+        axis=1,
+    )
+    df["GHI_CHU_TSBD"] = df.apply(
+        lambda r: "MỚI" if str(r.get("CAP_2", "")).strip() != "" and pd.isna(r.get("LOAI_TS")) else "",
+        axis=1,
+    )
+    return df
+
+
+def _ref_flags(piv, df_crm4, list_cif_cap_c, cif_co_cau):
+    out = pd.DataFrame(index=piv.index)
+    cif = piv["CIF_KH_VAY"].astype(str)
+    out["Nợ nhóm 2"] = piv["NHOM_NO"].apply(lambda x: "x" if str(x).strip() == "2" else "")
+    out["Nợ xấu"] = piv["NHOM_NO"].apply(lambda x: "x" if str(x).strip() in ["3", "4", "5"] else "")
+    # Bản gốc viết ``list_cif_cap_c or []`` — lỗi với ndarray, nên tham chiếu dùng list(...)
+    cap_c, co_cau = set(map(str, list(list_cif_cap_c))), set(map(str, list(cif_co_cau)))
+    out["Chuyên gia PD cấp C duyệt"] = cif.apply(lambda x: "x" if x in cap_c else "")
+    out["NỢ CƠ_CẤU"] = cif.apply(lambda x: "x" if x in co_cau else "")
+    for loai, col in [("Bao lanh", "DƯ_NỢ_BẢO_LÃNH"), ("LC", "DƯ_NỢ_LC")]:
+        tong = df_crm4[df_crm4["LOAI"] == loai].groupby("CIF_KH_VAY")["DU_NO_PHAN_BO_QUY_DOI"].sum()
+        out[col] = piv["CIF_KH_VAY"].map(tong).fillna(0).astype(float)
+    cc = set(df_crm4[df_crm4["CAP_2"].astype(str).str.contains("TCTD", case=False, na=False)]["CIF_KH_VAY"].astype(str))
+    out["Cầm cố tại TCTD khác"] = cif.apply(lambda x: "x" if x in cc else "")
+    for loai_kh, col in [("Ca nhan", "Top 10 dư nợ KHCN"), ("Doanh nghiep", "Top 10 dư nợ KHDN")]:
+        top = set(piv[piv["CUSTTPCD"] == loai_kh].nlargest(10, "DƯ NỢ")["CIF_KH_VAY"].astype(str))
+        out[col] = cif.apply(lambda x: "x" if x in top else "")
+    return out
+
+
+# ============================ DỮ LIỆU NHỎ ============================ #
+@pytest.fixture
+def code_tsbd():
+    return pd.DataFrame({"CODE CAP 2": ["BĐS01", "BĐS02", "PTVT01", "TCTD01", "BĐS01"],
+                         "CODE": ["BĐS", "BĐS", "PTVT", "Khác", "BĐS"]})
+
+
+@pytest.fixture
+def crm4():
+    # 26 CIF chuỗi (có chữ), LOAI lẫn nhóm & NaN, CAP_2 có mã lạ / rỗng / NaN / chứa TCTD
+    n = 26
+    cif = [f"KH{i:03d}" if i % 3 else str(10000 + i) for i in range(n)]
+    loai = ["Cho vay", "Bao lanh", "LC", np.nan, "Cho vay", "Khac"]
+    cap_2 = ["BĐS01", "BĐS02", "PTVT01", "XYZ99", np.nan, "  ", "TCTD01", "BĐS01", ""]
+    rows = []
+    for i in range(n):
+        for j in range(1 + i % 3):
+            rows.append({
+                "CIF_KH_VAY": cif[i],
+                "TEN_KH_VAY": f"KH {cif[i]}",
+                "CUSTTPCD": "Ca nhan" if i % 2 else "Doanh nghiep",
+                "NHOM_NO": ["1", "2", "3", "5", "1 ", np.nan][i % 6],
+                "LOAI": loai[(i + j) % len(loai)],
+                "CAP_2": cap_2[(i * 2 + j) % len(cap_2)],
+                "TS_KW_VND": 1e6 * (i + 1),
+                "DU_NO_PHAN_BO_QUY_DOI": 1e5 * (i * 7 % 26 + 1) + j,
+            })
+    return pd.DataFrame(rows)
+
+
+# ============================ TEST ============================ #
+def test_add_loai_ts_khop_ban_goc(crm4, code_tsbd):
+    moi = add_loai_ts(crm4, code_tsbd)
+    ref = _ref_add_loai_ts(crm4, code_tsbd)
+    assert_frame_equal(moi, ref)
+    assert set(moi["LOAI_TS"].dropna()) == {"BĐS", "PTVT", "Khác", "Không TS"}
+    assert (moi["GHI_CHU_TSBD"] == "MỚI").sum() == (crm4["CAP_2"] == "XYZ99").sum()
+
+
+def test_co_vector_hoa_khop_ban_goc(crm4, code_tsbd):
+    df4 = add_loai_ts(crm4, code_tsbd)
+    pivot_final = build_pivots(df4)[3]
+    list_cif_cap_c = np.array(["KH001", "10003", "KH404"], dtype=object)  # ndarray, có CIF không tồn tại
+    cif_co_cau = np.array(["10000", "KH014"], dtype=object)
+    piv, _ = add_flags_and_joins(
+        pivot_final, pd.DataFrame(), df4, pd.DataFrame({"CUSTSEQLN": list_cif_cap_c}), list_cif_cap_c, cif_co_cau,
+        None, pd.Timestamp("2025-08-31"), None, [], None, None, None, criteria=CO_CAC_CO,
+    )
+    ref = _ref_flags(pivot_final, df4, list_cif_cap_c, cif_co_cau)
+    assert_frame_equal(piv[COT_CO], ref[COT_CO], check_dtype=False)
+    for col in COT_CO:
+        if not col.startswith("DƯ_NỢ"):
+            assert (piv[col] == "x").any(), col
+
+
+def test_add_flags_and_joins_khong_ma_cif_khop_pipeline(inputs):
+    # Gọi trực tiếp, không truyền cif_vocab/cif_codes → tự mã hoá mọi bảng (cả Mục 55/56)
+    kq = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN)
+    frames = prepare_frames(inputs)
+    piv, kpi = add_flags_and_joins(
+        kq["pivot_final"], kq["p_mucdich"], kq["df_crm4"], kq["df_crm32_filtered"],
+        frames["list_cif_cap_c"], frames["cif_co_cau"], inputs["giai_ngan_tm"], pd.Timestamp(NGAY_DANH_GIA),
+        inputs["muc17"], DIA_BAN, inputs["muc55"], inputs["muc56"], inputs["muc57"],
+    )
+    assert (piv[tc3_col()] == "x").any()
+    assert_frame_equal(piv, kq["pivot_full"])
+    assert_frame_equal(kpi["df_cap_tieu_chi_3"], kq["kpi"]["df_cap_tieu_chi_3"])
+
+
+@pytest.mark.parametrize("so_ngay", [0, 3])
+def test_tieu_chi_3_dem_tu_su_kien_khop_groupby(inputs, so_ngay):
+    frames = prepare_frames(inputs)
+    ma_cap, bang = tieu_chi_3(
+        inputs["muc55"], inputs["muc56"], frames["cif_codes"]["muc55"], frames["cif_codes"]["muc56"],
+        frames["cif_vocab"], so_ngay,
+    )
+    df_gop = bang["df_gop_tieu_chi_3"]
+    ref = df_gop.groupby(["CIF", "NGAY", "GIAI_NGAN_TT"]).size().unstack(fill_value=0).reset_index()
+    ref["CO_CA_GN_VA_TT"] = ((ref["Giải ngân"] > 0) & (ref["Tất toán"] > 0)).astype(int)
+    assert_frame_equal(bang["df_count_tieu_chi_3"], ref)
+    assert len(df_gop) == inputs["muc55"]["NGAY_TT"].notna().sum() + inputs["muc56"]["NGAY_GIAI_NGAN"].notna().sum()
+    assert set(frames["cif_vocab"][ma_cap]) == set(bang["df_cap_tieu_chi_3"]["CIF"])
+
+
+def _muc_tc3(cif, ngay_tt, ngay_gn):
+    muc55 = pd.DataFrame({"CUSTSEQLN": cif, "NMLOC": "A", "KHE_UOC": "TT", "SOTIENGIAINGAN": 1e6,
+                          "NGAYGN": "2025-01-01", "NGAYDH": "2026-01-01", "NGAY_TT": ngay_tt, "LOAITIEN": "VND"})
+    muc56 = pd.DataFrame({"CIF": cif, "TEN_KHACH_HANG": "A", "KHE_UOC": "GN", "SO_TIEN_GIAI_NGAN_VND": 2e6,
+                          "NGAY_GIAI_NGAN": ngay_gn, "NGAY_DAO_HAN": "2026-03-05", "LOAI_TIEN_HD": "VND"})
+    return muc55, muc56
+
+
+def test_tieu_chi_3_cung_ngay_khac_gio():
+    # GN 09:00 và TT 15:30 cùng ngày: một dòng đếm có cả hai, khớp với cặp được gắn cờ
+    muc55, muc56 = _muc_tc3(["100", "200"], ["2025-03-05 15:30", "2025-03-07 08:00"],
+                            ["2025-03-05 09:00", "2025-03-05 10:00"])
+    vocab, ma = encode_cifs({"muc55": muc55["CUSTSEQLN"], "muc56": muc56["CIF"]})
+    ma_cap, bang = tieu_chi_3(muc55, muc56, ma["muc55"], ma["muc56"], vocab, 0)
+    assert list(vocab[ma_cap]) == ["100"]
+    dem = bang["df_count_tieu_chi_3"]
+    assert len(dem) == 3
+    assert dem.loc[dem["CIF"] == "100", "CO_CA_GN_VA_TT"].tolist() == [1]
+    assert (dem["NGAY"] == dem["NGAY"].dt.normalize()).all()
+    assert bang["df_cap_tieu_chi_3"]["SO_NGAY_LECH"].tolist() == [0]
+
+
+def test_tieu_chi_3_thieu_muc_55_khong_canh_bao():
+    _, muc56 = _muc_tc3(["100"], ["2025-03-05"], ["2025-03-05"])
+    vocab, ma = encode_cifs({"muc56": muc56["CIF"]})
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        ma_cap, bang = tieu_chi_3(pd.DataFrame(), muc56, None, ma["muc56"], vocab, 0)
+        assert gop_tieu_chi_3(None, None).empty
+    assert len(ma_cap) == 0 and len(bang["df_gop_tieu_chi_3"]) == 1
+    assert bang["df_count_tieu_chi_3"]["CO_CA_GN_VA_TT"].tolist() == [0]
+
+
+def test_compile_code_map_nhieu_luong(monkeypatch):
+    # Nhiều luồng biên dịch/loại bỏ cùng lúc: mỗi lời gọi nhận đúng bảng của mình, bộ nhớ không vượt giới hạn
+    monkeypatch.setattr(crm_core, "_CODE_MAPS", {})
+    monkeypatch.setattr(crm_core, "CODE_MAPS_MAX", 4)
+    bang = [pd.DataFrame({"MA": [f"M{k}", f"M{k}", "X"], "GIA_TRI": [k, k, -k]}) for k in range(12)]
+
+    def dich(k):
+        return k, crm_core.compile_code_map(bang[k % 12], "MA", "GIA_TRI")
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        for k, (ma, trung) in ex.map(dich, range(96)):
+            assert ma.to_dict() == {f"M{k % 12}": k % 12, "X": -(k % 12)} and trung.empty
+    assert len(crm_core._CODE_MAPS) <= 4
+
+
+# ============================ ĐĂNG KÝ TIÊU CHÍ ============================ #
+def test_criteria_chi_chay_tap_con(inputs):
+    goc = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN, criteria=[])["pivot_full"]
+    day_du = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN)["pivot_full"]
+    con = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN, criteria=["no_nhom", "tieu_chi_3"])["pivot_full"]
+    them = [c for c in con.columns if c not in goc.columns]
+    assert them == ["Nợ nhóm 2", "Nợ xấu", tc3_col()]
+    assert_frame_equal(con[them], day_du[them])
+    with pytest.raises(ValueError, match="khong_co"):
+        run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN, criteria=["khong_co"])
+
+
+def test_criteria_mot_luong_khop_nhieu_luong(inputs, monkeypatch):
+    kq = {}
+    for workers in (1, 8):
+        monkeypatch.setattr(crm_core, "CRITERIA_WORKERS", workers)
+        kq[workers] = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN)
+    assert_frame_equal(kq[1]["pivot_full"], kq[8]["pivot_full"])
+    for name, df in kq[1]["kpi"].items():
+        if isinstance(df, pd.DataFrame):
+            assert_frame_equal(df, kq[8]["kpi"][name], obj=name)
+
+
+def test_criteria_chay_theo_dot_sau(monkeypatch):
+    # "tong" khai báo sau=["a", "b"] nên chỉ chạy khi cả hai đã xong, dù "a" chậm
+    def a(ctx):
+        time.sleep(0.05)
+        return {"A": np.array([1, 0, 1])}, {}
+
+    def b(ctx):
+        return {"B": np.array([0, 1, 1])}, {"bang_b": "b"}
+
+    def tong(ctx):
+        kq = ctx["ket_qua"]
+        return {"TONG": kq["a"][0]["A"] + kq["b"][0]["B"]}, {}
+
+    registry = {
+        "tong": {"ten": "tổng", "dau_vao": [], "sau": ["a", "b"], "fn": tong},
+        "a": {"ten": "a", "dau_vao": [], "sau": [], "fn": a},
+        "b": {"ten": "b", "dau_vao": [], "sau": [], "fn": b},
+    }
+    monkeypatch.setattr(crm_core, "CRITERIA", registry)
+    monkeypatch.setattr(crm_core, "CRITERIA_WORKERS", 4)
+    ctx = {"piv": pd.DataFrame(index=range(3))}
+    cols, extras = crm_core.run_criteria(ctx)
+    assert list(cols) == ["TONG", "A", "B"]  # thứ tự theo registry, không theo đợt
+    assert cols["TONG"].tolist() == [1, 1, 2] and extras == {"bang_b": "b"}
+    assert list(crm_core.run_criteria(ctx, ["b"])[0]) == ["B"]
+    registry["a"]["sau"] = ["tong"]
+    with pytest.raises(ValueError, match="vòng tròn"):
+        crm_core.run_criteria(ctx)
+
+
+# ============================ ĐỌC THEO KHỐI ============================ #
+def _file(name, data):
+    f = io.BytesIO(data)
+    f.name = name
+    return f
+
+
+@pytest.fixture(scope="module")
+def file_crm(inputs, tmp_path_factory):
+    # CRM4 thành hai file (.xlsx và .csv), CRM32 một file .xlsx
+    thu_muc = tmp_path_factory.mktemp("crm")
+    crm4 = inputs["crm4"]
+    crm4.iloc[:1800].to_excel(thu_muc / "crm4a.xlsx", index=False)
+    crm4.iloc[1800:].to_csv(thu_muc / "crm4b.csv", index=False)
+    inputs["crm32"].to_excel(thu_muc / "crm32.xlsx", index=False)
+    return {name: (thu_muc / name).read_bytes() for name in ["crm4a.xlsx", "crm4b.csv", "crm32.xlsx"]}
+
+
+def _doc(file_crm, **kw):
+    files = {"crm4": [_file("crm4a.xlsx", file_crm["crm4a.xlsx"]), _file("crm4b.csv", file_crm["crm4b.csv"])],
+             "crm32": [_file("crm32.xlsx", file_crm["crm32.xlsx"])]}
+    kq = load_inputs(files, **kw)
+    return {kind: kq[kind] for kind in files}
+
+
+@pytest.mark.parametrize("chi_nhanh", ["", "001"])
+def test_doc_theo_khoi_khop_doc_thuong(file_crm, chi_nhanh, tmp_path, monkeypatch):
+    monkeypatch.setattr(crm_io, "STREAM_CHUNK_ROWS", 500)
+    # Mỗi lần đọc một thư mục cache riêng → cả hai đều parse file (không so bảng đọc lại từ Parquet)
+    monkeypatch.setattr(crm_io, "CACHE_DIR", tmp_path / "thuong")
+    thuong = _doc(file_crm)
+    monkeypatch.setattr(crm_io, "CACHE_DIR", tmp_path / "khoi")
+    khoi = _doc(file_crm, stream=True, chi_nhanh=chi_nhanh)
+    for kind, df in thuong.items():
+        mong_doi = select_branch(thuong, kind, chi_nhanh).reset_index(drop=True)
+        assert len(mong_doi) < len(df) if chi_nhanh else len(mong_doi) == len(df)
+        # Bảng đọc theo khối chỉ biết các chi nhánh đã giữ lại → so category sau khi bỏ giá trị không dùng
+        cat = khoi[kind].select_dtypes("category").columns
+        assert_frame_equal(
+            khoi[kind].apply(lambda s: s.cat.remove_unused_categories() if s.name in cat else s),
+            mong_doi.apply(lambda s: s.cat.remove_unused_categories() if s.name in cat else s),
+            obj=kind,
+        )
+
+
+def test_doc_theo_khoi_khong_chi_nhanh_doc_binh_thuong(file_crm, monkeypatch):
+    # Không chọn chi nhánh → không đi qua load_streaming (giữ mọi khối rồi ghép tốn gấp đôi bộ nhớ)
+    def khong_goi(*args, **kwargs):
+        raise AssertionError("load_streaming không được gọi khi chưa chọn chi nhánh")
+
+    monkeypatch.setattr(crm_core, "load_streaming", khong_goi)
+    assert len(_doc(file_crm, stream=True)["crm4"]) == 3000
+
+
+# ============================ LỌC CHI NHÁNH ============================ #
+TEN_CN = ["001 - HANOI", "0010 - CN X", "10 - CN Y", "1 - CN Z", "hcm", "HCM - CN 2", np.nan, "002 - hanoi"]
+
+
+@pytest.fixture(params=["object", "category"])
+def df_cn(request):
+    ten = [TEN_CN[(i * 5) % len(TEN_CN)] for i in range(40)]
+    return pd.DataFrame({"BRANCH_VAY": pd.Series(ten, dtype=request.param), "STT": range(40)})
+
+
+def _loc_cu(df, chi_nhanh):
+    # Bản gốc: astype(str).str.upper().str.contains(chi_nhanh)
+    return df[df["BRANCH_VAY"].astype(str).str.upper().str.contains(chi_nhanh)]
+
+
+@pytest.mark.parametrize("chi_nhanh", ["001", "HANOI", "HCM", "CN", "1", "NAN", "KHONG_CO"])
+def test_loc_chi_nhanh_contains_khop_ban_goc(df_cn, chi_nhanh):
+    moi = take_branch(df_cn, branch_partition(df_cn, "BRANCH_VAY"), chi_nhanh, "contains")
+    assert_frame_equal(moi, _loc_cu(df_cn, chi_nhanh))
+
+
+def test_loc_chi_nhanh_nhieu_gia_tri(df_cn):
+    moi = take_branch(df_cn, branch_partition(df_cn, "BRANCH_VAY"), " 001, hcm ,", "contains")
+    cu = pd.concat([_loc_cu(df_cn, "001"), _loc_cu(df_cn, "HCM")]).sort_index()
+    assert_frame_equal(moi, cu[~cu.index.duplicated()])
+
+
+@pytest.mark.parametrize("mode, chi_nhanh, mong_doi", [
+    # exact: trùng cả tên, hoặc cùng mã SOL theo số (bỏ số 0 đầu: "1" = "001" ≠ "0010")
+    ("exact", "1", ["001 - HANOI", "1 - CN Z"]),
+    ("exact", "001", ["001 - HANOI", "1 - CN Z"]),
+    ("exact", "010", ["0010 - CN X", "10 - CN Y"]),
+    ("exact", "HCM", ["HCM"]),
+    ("exact", "hcm - cn 2", ["HCM - CN 2"]),
+    ("exact", "HANOI", []),
+    # prefix: tên hoặc mã SOL bắt đầu bằng giá trị (giữ nguyên số 0 đầu)
+    ("prefix", "00", ["001 - HANOI", "0010 - CN X", "002 - HANOI"]),
+    ("prefix", "001", ["001 - HANOI", "0010 - CN X"]),
+    ("prefix", "1", ["10 - CN Y", "1 - CN Z"]),
+    ("prefix", "HCM", ["HCM", "HCM - CN 2"]),
+    ("prefix", "002,1 -", ["1 - CN Z", "002 - HANOI"]),
+])
+def test_match_branches_exact_prefix(mode, chi_nhanh, mong_doi, df_cn):
+    ten = [t.upper() for t in TEN_CN if isinstance(t, str)] + ["NAN"]
+    assert match_branches(ten, chi_nhanh, mode) == mong_doi
+    # take_branch lấy đúng các dòng đó, theo thứ tự gốc
+    moi = take_branch(df_cn, branch_partition(df_cn, "BRANCH_VAY"), chi_nhanh, mode)
+    assert_frame_equal(moi, df_cn[df_cn["BRANCH_VAY"].astype(str).str.upper().isin(mong_doi)])
+
+
+# ============================ R34 ============================ #
+def test_r34_nhieu_ngay_khop_tung_ngay():
+    loai = ["BĐS", "MMTB", "PTVT", "Khác", "Không TS", np.nan, "bđs"]
+    dinh_gia = ["2023-01-15", "2024-07-30 18:00", None, "không phải ngày", pd.Timestamp("2020-02-29"), "2024-07-31"]
+    df = pd.DataFrame({
+        "LOAI_TS": [loai[i % len(loai)] for i in range(84)],
+        "VALUATION_DATE": [dinh_gia[i % len(dinh_gia)] for i in range(84)],
+    })
+    ngay = [pd.Timestamp("2024-12-31"), pd.Timestamp("2025-08-30"), pd.Timestamp("2025-08-31"), pd.Timestamp("2030-01-01")]
+
+    nhieu = r34_so_ngay_qua_han(df, ngay)
+    assert nhieu.shape == (len(df), len(ngay))
+    for k, d in enumerate(ngay):
+        np.testing.assert_array_equal(nhieu[:, k], r34_so_ngay_qua_han(df, d))
+        # Bản gốc: (ngày đánh giá − ngày định giá).days − 365 > 30 với BĐS/MMTB/PTVT
+        vd = pd.to_datetime(df["VALUATION_DATE"], errors="coerce")
+        ref = df["LOAI_TS"].isin(R34_QUY_TAC) & ((d - vd).dt.days - 365 > 30)
+        np.testing.assert_array_equal(r34_qua_han(df, d), ref.to_numpy())
+
+    co = r34_qua_han(df, ngay)
+    thieu_ngay = pd.to_datetime(df["VALUATION_DATE"], errors="coerce").isna().to_numpy()
+    khong_xet = ~df["LOAI_TS"].isin(R34_QUY_TAC).to_numpy() | thieu_ngay
+    assert khong_xet.any() and not co[khong_xet].any()
+    assert np.isnan(nhieu[khong_xet]).all()
+    # Ngưỡng 395 ngày: 2024-07-31 quá hạn từ 2025-08-31, chưa quá hạn ngày 2025-08-30
+    dong = ((df["VALUATION_DATE"] == "2024-07-31") & (df["LOAI_TS"] == "BĐS")).to_numpy()
+    assert dong.any() and co[dong].tolist() == [[False, False, True, True]] * dong.sum()
+
+
+# ============================ TRÌNH XEM KẾT QUẢ ============================ #
+@pytest.fixture
+def bang_xem():
+    n = 23
+    return pd.DataFrame({
+        "CIF_KH_VAY": [1000 + i for i in range(n)],  # CIF số → tìm theo chuỗi
+        "DƯ NỢ": [float(i % 5) if i % 7 else np.nan for i in range(n)],
+        "LAN": [i if i % 3 else f"m{i}" for i in range(n)],  # object lẫn số & chuỗi
+        "Nợ xấu": ["x" if i % 2 else "" for i in range(n)],
+        "Top 10": ["X" if i % 3 == 0 else "" for i in range(n)],
+    })
+
+
+def test_explore_page_loc_co_va_tim_cif(bang_xem):
+    assert flag_columns(bang_xem) == ["Nợ xấu", "Top 10"]
+    trang, tong = explore_page(bang_xem, flags=["Nợ xấu", "Top 10"])
+    assert tong == 4 and trang.index.tolist() == [3, 9, 15, 21]  # AND các cờ, giữ thứ tự bảng
+    trang, tong = explore_page(bang_xem, flags=["Nợ xấu"], tim_cif=" 101")
+    assert tong == 5 and trang["CIF_KH_VAY"].tolist() == [1011, 1013, 1015, 1017, 1019]
+    assert explore_page(bang_xem, tim_cif="khong")[1] == 0
+
+
+def test_explore_page_sap_xep(bang_xem):
+    trang, _ = explore_page(bang_xem, sap_xep="DƯ NỢ", so_dong=100)
+    du_no = trang["DƯ NỢ"]
+    assert du_no.iloc[:-4].is_monotonic_decreasing and du_no.iloc[-4:].isna().all()  # ô trống xếp cuối
+    assert trang.index[:5].tolist() == [4, 9, 19, 3, 8]  # cùng giá trị giữ thứ tự gốc (ổn định)
+    trang, _ = explore_page(bang_xem, sap_xep="DƯ NỢ", giam_dan=False)
+    assert trang["DƯ NỢ"].iloc[:-4].is_monotonic_increasing and trang["DƯ NỢ"].iloc[-4:].isna().all()
+    # Cột lẫn kiểu → so theo chuỗi thay vì lỗi
+    trang, _ = explore_page(bang_xem, sap_xep="LAN", giam_dan=False)
+    assert trang["LAN"].astype(str).tolist() == sorted(bang_xem["LAN"].astype(str))
+    # Cột không có → giữ thứ tự bảng
+    assert explore_page(bang_xem, sap_xep="KHONG_CO")[0].index.tolist() == list(range(23))
+
+
+@pytest.mark.parametrize("trang, mong_doi", [(1, [0, 1, 2, 3, 4]), (5, [20, 21, 22]), (99, [20, 21, 22]),
+                                             (0, [0, 1, 2, 3, 4]), (-3, [0, 1, 2, 3, 4])])
+def test_explore_page_kep_trang(bang_xem, trang, mong_doi):
+    ket_qua, tong = explore_page(bang_xem, trang=trang, so_dong=5)
+    assert tong == 23 and ket_qua.index.tolist() == mong_doi
+
+
+def test_explore_page_khong_khop():
+    bang = pd.DataFrame({"CUSTSEQLN": ["A1", "B2"], "Nợ xấu": ["", ""]})
+    trang, tong = explore_page(bang, flags=["Nợ xấu"], trang=3)
+    assert tong == 0 and trang.empty and list(trang.columns) == list(bang.columns)
+    assert explore_page(bang, tim_cif="b")[0]["CUSTSEQLN"].tolist() == ["B2"]
+
+
+# ============================ XUẤT EXCEL ============================ #
+def _ket_qua_nho():
+    df_crm4 = pd.DataFrame({
+        "CIF_KH_VAY": [f"KH{i:02d}" for i in range(25)],
+        "DU_NO": [float(i) if i % 4 else np.nan for i in range(25)],
+        "NGAY": pd.date_range("2025-01-01", periods=25),
+    })
+    rong = pd.DataFrame()
+    return {
+        "df_crm4": df_crm4, "pivot_final": rong, "pivot_merge": rong, "df_crm32_filtered": rong,
+        "pivot_full": df_crm4.iloc[:10], "p_mucdich": rong, "kpi": {},
+    }
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_xuat_excel_tach_sheet(tmp_path, monkeypatch, streaming):
+    # Giới hạn 11 dòng/sheet (10 dòng dữ liệu + tiêu đề)
+    monkeypatch.setattr(crm_core, "EXCEL_MAX_ROWS", 11)
+    ket_qua, path = _ket_qua_nho(), tmp_path / "kq.xlsx"
+    if streaming:
+        write_excel_streaming(ket_qua, path, chunk_rows=3)
+    else:
+        write_excel(ket_qua, path)
+    sheets = pd.read_excel(path, sheet_name=None)
+    assert {k: len(v) for k, v in sheets.items()} == {
+        "df_crm4_LOAI_TS": 10, "df_crm4_LOAI_TS_2": 10, "df_crm4_LOAI_TS_3": 5, "KQ_KH": 10,
+    }
+    ghep = pd.concat([sheets[f"df_crm4_LOAI_TS{s}"] for s in ["", "_2", "_3"]], ignore_index=True)
+    assert_frame_equal(ghep, ket_qua["df_crm4"], check_dtype=False)
+
+
+def test_xuat_excel_streaming_chon_sheet_va_ten_dai(tmp_path, monkeypatch):
+    monkeypatch.setattr(crm_core, "EXCEL_MAX_ROWS", 4)
+    ket_qua = _ket_qua_nho()
+    ket_qua["kpi"]["df_count_tieu_chi_3"] = pd.DataFrame({"CIF": range(7)})
+    path = tmp_path / "kq.xlsx"
+    write_excel_streaming(ket_qua, path, include=["tieu chi 3_dot3_1"])
+    sheets = pd.read_excel(path, sheet_name=None)
+    assert {k: len(v) for k, v in sheets.items()} == {
+        "tieu chi 3_dot3_1": 3, "tieu chi 3_dot3_1_2": 3, "tieu chi 3_dot3_1_3": 1,
+    }
+    # Không còn sheet nào → vẫn ghi một sheet trống hợp lệ
+    write_excel_streaming(ket_qua, path, include=[])
+    assert list(pd.read_excel(path, sheet_name=None)) == ["KQ_KH"]
+    # Tên sheet tối đa 31 ký tự: cắt bớt tên để thêm hậu tố
+    ten = [t for t, _ in crm_core._sheet_parts("T" * 31, pd.DataFrame({"a": range(7)}))]
+    assert ten == ["T" * 31, "T" * 29 + "_2", "T" * 29 + "_3"]
+
+
+# ============================ XẾP HẠNG TOP N ============================ #
+@pytest.fixture
+def bang_hang():
+    rng = np.random.default_rng(5)
+    n = 60
+    du_no = rng.integers(0, 6, n).astype(float)  # nhiều giá trị bằng nhau
+    du_no[rng.choice(n, 12, replace=False)] = np.nan
+    nhom = rng.choice(np.array(["Ca nhan", "Doanh nghiep", "Khac", None], dtype=object), n, p=[0.45, 0.35, 0.1, 0.1])
+    return pd.DataFrame({"DƯ NỢ": du_no, "CUSTTPCD": nhom, "LECH": rng.normal(size=n)}, index=rng.permutation(n) + 100)
+
+
+def _hang_tham_chieu(piv, chi_so, nhom, n, na_cuoi):
+    # Tham chiếu: sắp ổn định giảm dần trong từng nhóm (nhóm NaN bỏ qua), NaN cuối hoặc bỏ
+    hang = pd.Series(0, index=piv.index)
+    nhom_cua = piv.groupby(nhom, sort=False) if nhom else [(None, piv)]
+    for _, g in nhom_cua:
+        g = g if na_cuoi else g[g[chi_so].notna()]
+        top = g.sort_values(chi_so, ascending=False, kind="stable", na_position="last").head(n)
+        hang[top.index] = np.arange(1, len(top) + 1)
+    return hang.to_numpy()
+
+
+@pytest.mark.parametrize("nhom", ["CUSTTPCD", None])
+@pytest.mark.parametrize("n", [1, 5, 40])
+@pytest.mark.parametrize("na_cuoi", [False, True])
+def test_rank_top_n_khop_tham_chieu(bang_hang, nhom, n, na_cuoi):
+    hang = rank_top_n(bang_hang, "DƯ NỢ", nhom, n, na_cuoi=na_cuoi)
+    np.testing.assert_array_equal(hang, _hang_tham_chieu(bang_hang, "DƯ NỢ", nhom, n, na_cuoi))
+    # na_cuoi: tập dòng trong top như nlargest(n) của bản gốc — nhóm thiếu số liệu lấy thêm dòng NaN
+    for _, g in (bang_hang.groupby(nhom) if nhom and na_cuoi else []):
+        top = g.nlargest(n, "DƯ NỢ", keep="first")
+        if len(top) < n:
+            top = pd.concat([top, g[g["DƯ NỢ"].isna()].iloc[: n - len(top)]])
+        assert set(g.index[hang[bang_hang.index.get_indexer(g.index)] > 0]) == set(top.index)
+    if nhom:
+        assert not hang[bang_hang["CUSTTPCD"].isna().to_numpy()].any()  # nhóm NaN không xếp hạng
+    if not na_cuoi:
+        assert not hang[bang_hang["DƯ NỢ"].isna().to_numpy()].any()
+
+
+def test_rank_top_n_bang_nhau_giu_thu_tu():
+    piv = pd.DataFrame({"DƯ NỢ": [5.0, 7.0, 5.0, np.nan, 5.0, 7.0], "CUSTTPCD": ["A", "B", "A", "A", "B", "A"]})
+    assert rank_top_n(piv, "DƯ NỢ", n=3).tolist() == [3, 1, 0, 0, 0, 2]
+    assert rank_top_n(piv, "DƯ NỢ", "CUSTTPCD", n=2).tolist() == [2, 1, 0, 0, 2, 1]
+    assert rank_top_n(piv, "DƯ NỢ", "CUSTTPCD", n=4, na_cuoi=True).tolist() == [2, 1, 3, 4, 2, 1]
+
+
+def test_ranking_columns(bang_hang):
+    cols = ranking_columns(bang_hang, n=3)
+    # "GIÁ TRỊ TS" không có trong bảng → bỏ qua
+    assert list(cols) == [rank_col("DƯ NỢ", "CUSTTPCD"), rank_col("LECH")] == ["Hạng DƯ NỢ theo CUSTTPCD", "Hạng LECH"]
+    lech = cols["Hạng LECH"]
+    assert str(lech.dtype) == "Int64" and lech.isna().sum() == len(bang_hang) - 3
+    assert lech[np.argsort(-bang_hang["LECH"].to_numpy())[:3]].tolist() == [1, 2, 3]
+    theo_nhom = pd.Series(cols["Hạng DƯ NỢ theo CUSTTPCD"]).groupby(bang_hang["CUSTTPCD"].to_numpy()).count()
+    assert theo_nhom.to_dict() == {"Ca nhan": 3, "Doanh nghiep": 3, "Khac": min(3, bang_hang.loc[
+        bang_hang["CUSTTPCD"] == "Khac", "DƯ NỢ"].notna().sum())}
+
+
+# ============================ MÃ CHƯA ÁNH XẠ ============================ #
+def test_unmapped_codes_bao_cao_ma_moi_va_ma_trung(code_tsbd):
+    code_tsbd = pd.concat([code_tsbd, pd.DataFrame({"CODE CAP 2": ["DUP1", "DUP1"], "CODE": ["A", "B"]})])
+    df_crm4 = pd.DataFrame({"CAP_2": ["BĐS01", "XYZ99", "BĐS01", "", np.nan, "DUP1", "XYZ99", "  ", "XYZ99", "MOI2"]})
+    df_crm32 = pd.DataFrame({"MUC_DICH_VAY_CAP_4": ["M1", "M9", "M9", np.nan, "M1"]})
+    code_mdsd = pd.DataFrame({"CODE_MDSDV4": ["M1", "M2"], "GROUP": ["Tiêu dùng", "SXKD"]})
+
+    bao_cao = unmapped_codes(df_crm4, df_crm32, code_tsbd, code_mdsd)
+    chua_co, trung = "chưa có trong bảng mã", "trùng mã trong bảng mã (lấy giá trị đầu tiên)"
+    assert bao_cao.to_dict("records") == [
+        {"BANG": "CRM4", "COT_MA": "CAP_2", "MA": "XYZ99", "SO_DONG": 3, "GHI_CHU": chua_co},
+        {"BANG": "CRM4", "COT_MA": "CAP_2", "MA": "MOI2", "SO_DONG": 1, "GHI_CHU": chua_co},
+        {"BANG": "CRM4", "COT_MA": "CAP_2", "MA": "DUP1", "SO_DONG": 1, "GHI_CHU": trung},
+        {"BANG": "CRM32", "COT_MA": "MUC_DICH_VAY_CAP_4", "MA": "M9", "SO_DONG": 2, "GHI_CHU": chua_co},
+    ]
+    # Khớp với các dòng add_loai_ts đánh dấu "MỚI"
+    moi = add_loai_ts(df_crm4, code_tsbd)
+    crm4_chua_co = bao_cao.loc[(bao_cao["BANG"] == "CRM4") & (bao_cao["GHI_CHU"] == chua_co), "MA"]
+    assert set(moi.loc[moi["GHI_CHU_TSBD"] == "MỚI", "CAP_2"]) == set(crm4_chua_co)
+    assert moi.loc[moi["CAP_2"] == "DUP1", "LOAI_TS"].tolist() == ["A"]  # mã trùng lấy giá trị đầu tiên
+
+
+def test_unmapped_codes_thieu_bang():
+    rong = unmapped_codes(pd.DataFrame(), pd.DataFrame({"KHAC": [1]}), pd.DataFrame(), pd.DataFrame({"X": [1]}))
+    assert rong.empty and list(rong.columns) == ["BANG", "COT_MA", "MA", "SO_DONG", "GHI_CHU"]
+    # Bảng mã dùng tên cột đã chuẩn (CAP_2/LOAI_TS) cũng được nhận
+    bao_cao = unmapped_codes(pd.DataFrame({"CAP_2": ["A", "B"]}), pd.DataFrame(),
+                             pd.DataFrame({"CAP_2": ["A"], "LOAI_TS": ["BĐS"]}), pd.DataFrame())
+    assert bao_cao[["MA", "SO_DONG"]].to_dict("records") == [{"MA": "B", "SO_DONG": 1}]
+
+
+# ============================ TIÊU CHÍ 4 ============================ #
+@pytest.mark.parametrize("nam_cham_tra, mong_doi", [
+    ((2023, 2025), [0, 3, 2, 0, 1, 0]),  # đầu khoảng 2023-01-01 và cuối khoảng 2025-12-31 đều được xét
+    ((2026, 2026), [0, 0, 0, 3, 0, 0]),
+    ((2022, 2022), [3, 0, 0, 0, 0, 0]),
+    ((2024, 2024), [0, 0, 0, 0, 1, 0]),
+])
+def test_tieu_chi_4_bien_nam(nam_cham_tra, mong_doi):
+    piv = pd.DataFrame({"CIF_KH_VAY": list("ABCDEF"), "DƯ NỢ": 1e6, "NHOM_NO": [1, 1, 1, 1, 1, 2]})
+    muc57 = pd.DataFrame({
+        "CIF_ID": list("ABCDEF"),
+        "NGAY_DEN_HAN_TT": ["2022-12-31", "2023-01-01", "2025-12-31", "2026-01-01", "2024-06-01", "2024-06-01"],
+        "NGAY_THANH_TOAN": ["2023-01-15", "2023-01-16", "2026-01-06", "2026-01-21", None, None],
+    })
+    vocab, ma = encode_cifs({"crm4": piv["CIF_KH_VAY"], "muc57": muc57["CIF_ID"]})
+    df_delay, muc = tieu_chi_4(muc57, ma["muc57"], vocab, piv, dong_theo_ma(ma["crm4"], len(vocab)),
+                               pd.Timestamp("2024-06-03"), nam_cham_tra)
+    assert muc.tolist() == mong_doi
+    # Bảng xuất: chỉ KH nợ nhóm 1 có chậm trả trong khoảng năm, mức cao trước
+    assert df_delay["CIF_ID"].tolist() == [c for _, c in sorted(
+        (-m, c) for m, c in zip(mong_doi, "ABCDEF") if m)]
+    assert set(df_delay["CAP_CHAM_TRA"]) <= {"<4", "4-9", ">=10"}
+    assert df_delay["NGAY_DEN_HAN_TT"].dt.year.between(*nam_cham_tra).all()
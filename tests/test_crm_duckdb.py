@@ -0,0 +1,24 @@
+# Engine DuckDB (tuỳ chọn) phải cho cùng kết quả với pandas; bỏ qua nếu chưa cài duckdb
+import numpy as np
+import pytest
+from pandas.testing import assert_frame_equal
+
+from conftest import DIA_BAN, NGAY_DANH_GIA
+from crm_core import run_pipeline
+
+pytest.importorskip("duckdb")
+
+
+@pytest.mark.parametrize("chi_nhanh", ["", "001"])
+def test_duckdb_khop_pandas(inputs, chi_nhanh):
+    kq_pd = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN, chi_nhanh)
+    kq_db = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN, chi_nhanh, engine="duckdb")
+    assert not kq_pd["pivot_full"].empty
+    for k in ["pivot_final", "pivot_merge", "p_mucdich", "pivot_full"]:
+        assert_frame_equal(kq_db[k], kq_pd[k], obj=k)
+    assert kq_db["kpi"].keys() == kq_pd["kpi"].keys()
+    for k, v in kq_pd["kpi"].items():
+        if hasattr(v, "columns"):
+            assert_frame_equal(kq_db["kpi"][k], v, obj=k)
+        else:
+            assert np.isclose(kq_db["kpi"][k], v), k
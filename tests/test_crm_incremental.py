@@ -0,0 +1,65 @@
+# Chạy tăng dần phải cho đúng kết quả (cả thứ tự dòng, nhãn index, tên trục cột) như chạy toàn bộ
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from conftest import DIA_BAN, NGAY_DANH_GIA
+from crm_core import run_pipeline
+import crm_incremental
+from crm_incremental import run_incremental
+
+BANG = ["pivot_final", "pivot_merge", "p_mucdich", "pivot_full"]
+
+
+def _ky_sau(inputs, seed=1):
+    """Kỳ sau giả lập: đổi dư nợ / bỏ / thêm CIF ở CRM4, sửa CRM32, Mục 17, giải ngân TM, Mục 55/57."""
+    r = np.random.default_rng(seed)
+    out = {k: v.copy() if isinstance(v, pd.DataFrame) else v for k, v in inputs.items()}
+    c4 = out["crm4"]
+    cifs = c4["CIF_KH_VAY"].unique()
+    c4.loc[c4["CIF_KH_VAY"].isin(r.choice(cifs, len(cifs) // 20, replace=False)), "DU_NO_PHAN_BO_QUY_DOI"] *= 1.1
+    c4 = c4[~c4["CIF_KH_VAY"].isin(r.choice(cifs, len(cifs) // 100, replace=False))]
+    moi = out["crm4"].sample(30, random_state=seed)
+    moi["CIF_KH_VAY"] = moi["CIF_KH_VAY"].astype(str) + "9"
+    out["crm4"] = pd.concat([c4, moi], ignore_index=True)
+    c32 = out["crm32"]
+    c32.loc[c32["CUSTSEQLN"].isin(r.choice(c32["CUSTSEQLN"].unique(), 50)), "DU_NO_QUY_DOI"] += 5
+    m17 = out["muc17"]
+    m17.iloc[r.choice(len(m17), 30, replace=False), m17.columns.get_loc("C19")] = "X, Hà Nội"
+    out["giai_ngan_tm"] = pd.concat(
+        [out["giai_ngan_tm"].iloc[10:], c32[["KHE_UOC"]].sample(20, random_state=seed).rename(columns={"KHE_UOC": "FORACID"})],
+        ignore_index=True,
+    )
+    out["muc57"] = pd.concat([out["muc57"], out["muc57"].sample(30, random_state=seed)], ignore_index=True)
+    out["muc55"] = out["muc55"].iloc[20:].reset_index(drop=True)  # dịch vị trí mọi dòng Mục 55 còn lại
+    return out
+
+
+def _khop(kq_tang_dan, kq_toan_bo):
+    for k in BANG:
+        assert_frame_equal(kq_tang_dan[k], kq_toan_bo[k], obj=k)
+        assert kq_tang_dan[k].columns.name == kq_toan_bo[k].columns.name, k
+    assert list(kq_tang_dan["kpi"]) == list(kq_toan_bo["kpi"])
+    for k, v in kq_toan_bo["kpi"].items():
+        if isinstance(v, pd.DataFrame):
+            assert_frame_equal(kq_tang_dan["kpi"][k], v, obj=k)
+            assert kq_tang_dan["kpi"][k].columns.name == v.columns.name, k
+        else:
+            assert np.isclose(kq_tang_dan["kpi"][k], v), k
+
+
+@pytest.mark.parametrize("tc3_so_ngay", [0, 3])
+def test_tang_dan_khop_toan_bo(inputs, tmp_path, monkeypatch, tc3_so_ngay):
+    monkeypatch.setattr(crm_incremental, "MAX_DIRTY_RATIO", 1.0)  # bộ dữ liệu nhỏ: luôn ghép, không chạy lại
+    run_incremental(inputs, "2025-07-31", DIA_BAN, state_dir=tmp_path, tc3_so_ngay=tc3_so_ngay)
+    ky_sau = _ky_sau(inputs)
+    kq = run_incremental(ky_sau, NGAY_DANH_GIA, DIA_BAN, state_dir=tmp_path, tc3_so_ngay=tc3_so_ngay)
+    assert kq["incremental"]["che_do"] == "tăng dần"
+    assert 0 < kq["incremental"]["cif_tinh_lai"] < kq["incremental"]["tong_cif"]
+    _khop(kq, run_pipeline(ky_sau, NGAY_DANH_GIA, DIA_BAN, tc3_so_ngay=tc3_so_ngay))
+
+    # Chạy lại cùng dữ liệu: không CIF nào tính lại, kết quả vẫn như chạy toàn bộ
+    kq = run_incremental(ky_sau, NGAY_DANH_GIA, DIA_BAN, state_dir=tmp_path, tc3_so_ngay=tc3_so_ngay)
+    assert kq["incremental"]["cif_tinh_lai"] == 0
+    _khop(kq, run_pipeline(ky_sau, NGAY_DANH_GIA, DIA_BAN, tc3_so_ngay=tc3_so_ngay))
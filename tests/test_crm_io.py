@@ -0,0 +1,78 @@
+import datetime
+import io
+import zipfile
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import crm_io
+from conftest import DIA_BAN, NGAY_DANH_GIA
+from crm_core import export_bytes, run_pipeline
+from crm_io import normalize_dtypes, read_excel_multi
+
+
+def test_normalize_dtypes_chi_ep_cot_lan_kieu():
+    df = pd.DataFrame({
+        1: ["a", "b", None],
+        "ngay": [datetime.date(2025, 1, 1), None, datetime.date(2025, 3, 1)],
+        "lan": [1, "x", np.nan],
+    })
+    out = normalize_dtypes(df)
+    assert list(out.columns) == ["1", "ngay", "lan"]
+    assert out["ngay"].tolist()[::2] == [datetime.date(2025, 1, 1), datetime.date(2025, 3, 1)]
+    assert out["lan"].tolist()[:2] == ["1", "x"] and pd.isna(out["lan"][2])
+    assert out["1"].equals(df[1].rename("1"))
+
+
+def test_parquet_export_giu_kieu_ngay(inputs):
+    result = run_pipeline(inputs, NGAY_DANH_GIA, DIA_BAN)
+    assert not result["kpi"]["df_delay_tieu_chi_4"].empty
+    with zipfile.ZipFile(io.BytesIO(export_bytes(result, "parquet", include=["tieu chi 4"]))) as zf:
+        df = pd.read_parquet(io.BytesIO(zf.read("tieu chi 4.parquet")))
+    assert all(isinstance(v, datetime.date) for v in df["NGAY"].dropna())
+
+
+def _file(name, data):
+    f = io.BytesIO(data)
+    f.name = name
+    return f
+
+
+def test_read_excel_multi_song_song_khop_tuan_tu(inputs, tmp_path, monkeypatch):
+    crm4 = inputs["crm4"]
+    parts = [crm4.iloc[:1000], crm4.iloc[1000:2200], crm4.iloc[2200:]]
+    data = []
+    for k, part in enumerate(parts):
+        if k == 1:
+            data.append((f"crm4_{k}.csv", part.to_csv(index=False).encode()))
+        else:
+            buf = io.BytesIO()
+            part.to_excel(buf, index=False)
+            data.append((f"crm4_{k}.xlsx", buf.getvalue()))
+    data.insert(2, ("hong.xlsx", b"khong phai excel"))  # file hỏng bị bỏ qua, không làm lệch thứ tự
+
+    so_pool = []
+
+    class _Pool(crm_io.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            so_pool.append(kwargs.get("max_workers"))
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(crm_io, "ProcessPoolExecutor", _Pool)
+    monkeypatch.setattr(crm_io, "PARALLEL_MIN_BYTES", 0)
+    kq = {}
+    for workers in (1, 3):
+        # Mỗi lần một thư mục cache riêng → cả hai lần đều parse
+        monkeypatch.setattr(crm_io, "CACHE_DIR", tmp_path / f"w{workers}")
+        kq[workers] = read_excel_multi([_file(n, d) for n, d in data], kind="crm4", max_workers=workers)
+    assert so_pool == [3]  # chỉ lần max_workers=3 chạy trên tiến trình con
+
+    assert len(kq[1]) == len(kq[3]) == 3
+    for tuan_tu, song_song, part in zip(kq[1], kq[3], parts):
+        assert_frame_equal(tuan_tu, song_song)
+        assert len(song_song) == len(part)
+        assert song_song["CIF_KH_VAY"].astype(str).tolist() == part["CIF_KH_VAY"].astype(str).tolist()
+    # Lần đọc lại lấy từ cache Parquet, không mở pool
+    lai = read_excel_multi([_file(n, d) for n, d in data], kind="crm4", max_workers=3)
+    assert so_pool == [3] and len(lai) == 3
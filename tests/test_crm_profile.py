@@ -0,0 +1,84 @@
+# StageProfiler: bản ghi từng bước, đỉnh bộ nhớ theo bước và JSON xuất ra
+import json
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from crm_profile import STAGE_COLUMNS, StageProfiler, _reset_peak_rss
+
+
+def test_stage_ghi_so_dong_va_thoi_gian():
+    prof = StageProfiler()
+    df = pd.DataFrame({"a": np.arange(100_000)})
+    with prof.stage("lọc", rows_in=200_000) as out:
+        out(df)
+    with prof.stage("đếm") as out:
+        out(rows=7)
+    prof.start()
+    prof.lap("lap", df)
+    prof.add("luồng con", 0.5, rows_out=3)
+
+    frame = prof.to_frame()
+    assert list(frame.columns) == STAGE_COLUMNS
+    assert frame["stage"].tolist() == ["lọc", "đếm", "lap", "luồng con"]
+    assert [r["rows_in"] for r in prof.records[:2]] == [200_000, None]
+    assert frame["rows_out"].tolist() == [100_000, 7, 100_000, 3]
+    assert frame.loc[0, "df_mb"] > 0 and (frame["seconds"][:3] >= 0).all()
+    assert frame.loc[3, "seconds"] == 0.5
+    assert frame.loc[3, ["rss_delta_mb", "peak_rss_mb", "alloc_peak_mb"]].isna().all()
+
+
+def test_stage_tat_khong_ghi():
+    prof = StageProfiler(enabled=False)
+    with prof.stage("x") as out:
+        out(pd.DataFrame({"a": [1]}))
+    prof.lap("y")
+    prof.add("z", 1.0)
+    assert prof.records == []
+
+
+@pytest.mark.skipif(not _reset_peak_rss(), reason="không đặt lại được VmHWM (ngoài Linux)")
+def test_dinh_rss_theo_tung_buoc():
+    prof = StageProfiler()
+    with prof.stage("cấp phát lớn"):
+        buf = np.ones(64 * 2**20 // 8)  # ~64 MB, giải phóng trong bước
+        del buf
+    with prof.stage("nhỏ"):
+        pass
+    lon, nho = prof.records
+    # Đỉnh của bước sau không mang theo đỉnh của bước trước (khác ru_maxrss)
+    assert lon["peak_rss_mb"] - lon["rss_mb"] > 40
+    assert nho["peak_rss_mb"] - nho["rss_mb"] < 20
+    assert abs(lon["rss_delta_mb"]) < 20
+
+
+def test_stage_long_nhau_gop_dinh_cua_buoc_con():
+    tracemalloc.start()
+    try:
+        prof = StageProfiler()
+        with prof.stage("tổng"):
+            with prof.stage("con"):
+                buf = bytearray(16 * 2**20)
+                del buf
+            with prof.stage("con nhỏ"):
+                pass
+    finally:
+        tracemalloc.stop()
+    con, con_nho, tong = prof.records
+    assert con["alloc_peak_mb"] >= 16 and con_nho["alloc_peak_mb"] < 1
+    assert tong["alloc_peak_mb"] >= con["alloc_peak_mb"]
+    if tong["peak_rss_mb"] is not None:
+        assert tong["peak_rss_mb"] >= con["peak_rss_mb"]
+
+
+def test_to_json():
+    prof = StageProfiler()
+    with prof.stage("bước 1", rows_in=5) as out:
+        out(rows=5)
+    data = json.loads(prof.to_json(so_chi_nhanh=2, ngay=pd.Timestamp("2025-08-31")))
+    assert data["meta"] == {"so_chi_nhanh": 2, "ngay": "2025-08-31 00:00:00"}
+    assert [s["stage"] for s in data["stages"]] == ["bước 1"]
+    assert set(data["stages"][0]) == set(STAGE_COLUMNS)
+    assert "bước 1" in prof.to_json()  # giữ nguyên chữ tiếng Việt (ensure_ascii=False)
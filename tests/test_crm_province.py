@@ -0,0 +1,62 @@
+# Chuẩn tỉnh/thành từ địa chỉ TSBĐ (Mục 17) và bộ nhớ đệm dùng chung giữa các luồng
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import crm_province
+from crm_province import resolve_dia_ban, resolve_provinces, resolve_unique
+
+
+def test_bo_nho_dem_nhieu_luong():
+    dia_chi = [pd.Series([f"Số {i}, Phường {k}, Quận 1, TP.HCM" for i in range(200)] + ["Long An"])
+               for k in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        kq = list(ex.map(resolve_provinces, dia_chi))
+    for s in kq:
+        assert s.iloc[:-1].eq("ho chi minh").all() and s.iloc[-1] == "long an"
+    # Ảnh chụp cuối cùng đọc lại được, không để lại file tạm
+    path = crm_province.MEMO_PATH
+    assert not list(path.parent.glob("*.tmp"))
+    assert len(pd.read_parquet(path)) == len(crm_province._MEMO) == 8 * 200 + 1
+
+
+@pytest.mark.parametrize("dia_chi, tinh", [
+    ("12 Lê Lợi, Quận 1, TPHCM", "ho chi minh"),
+    ("12 Lê Lợi, Q.1, TP.HCM, Việt Nam", "ho chi minh"),
+    ("Phường 7, Thành phố Hồ Chí Minh", "ho chi minh"),
+    ("Sài Gòn", "ho chi minh"),
+    ("Phường 1, TP Vũng Tàu, BR-VT", "ba ria vung tau"),
+    ("Xã Long Hải, Bà Rịa - Vũng Tàu", "ba ria vung tau"),
+    ("Ấp 3, xã Mỹ Yên, huyện Bến Lức, tỉnh Long An", "long an"),
+    ("Tỉnh Đắk Lắk", "dak lak"),
+    ("Đà Nẵng, VN", "da nang"),
+    # Đường mang tên Hồ Chí Minh ở tỉnh khác: tỉnh là đoạn nhận ra gần cuối nhất
+    ("45 đường Hồ Chí Minh, Phường 2, Đà Lạt, Lâm Đồng", "lam dong"),
+    ("Hồ Chí Minh, Gia Nghĩa, Đắk Nông", "dak nong"),
+    ("Thôn 2, xã ABC", "xa abc"),  # không nhận ra → đoạn cuối đã chuẩn như cách cũ
+    ("", ""),
+])
+def test_resolve_provinces(dia_chi, tinh):
+    assert resolve_unique([dia_chi]) == [tinh]
+    assert resolve_provinces(pd.Series([dia_chi]), memo=False).tolist() == [tinh]
+
+
+def test_resolve_provinces_giu_chi_muc_va_o_khong_phai_chuoi():
+    dia_chi = pd.Series(["TPHCM", np.nan, 12, "tỉnh Long An", "TPHCM"], index=[10, 11, 12, 13, 14])
+    for memo in (False, True, True):  # lần hai đọc từ bộ nhớ đệm
+        kq = resolve_provinces(dia_chi, memo=memo)
+        assert kq.index.tolist() == [10, 11, 12, 13, 14]
+        assert kq.tolist() == ["ho chi minh", "", "", "long an", "ho chi minh"]
+    assert crm_province._MEMO == {"TPHCM": "ho chi minh", "tỉnh Long An": "long an"}
+
+
+def test_resolve_dia_ban():
+    assert resolve_dia_ban(["hồ chí minh", "TP.HCM", "tỉnh Long An", "BR-VT", " "]) == [
+        "ho chi minh", "ho chi minh", "long an", "ba ria vung tau",
+    ]
+    # Địa bàn và địa chỉ TSBĐ chuẩn cùng một cách → so khớp trực tiếp
+    dia_ban = set(resolve_dia_ban(["TPHCM", "Long An"]))
+    ngoai = ~resolve_provinces(pd.Series(["Q.1, Sài Gòn", "Bến Lức, Long An", "Đường Hồ Chí Minh, Lâm Đồng"])).isin(dia_ban)
+    assert ngoai.tolist() == [False, False, True]